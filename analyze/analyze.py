@@ -0,0 +1,86 @@
+import argparse
+import json
+import logging
+import sys
+import os
+import time
+
+# プロジェクトのルートディレクトリをシステムパスに追加
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from utils.logging_config import setup_logging
+from evaluators.analytics import RANKING, kendall_tau_matrix, load_results_array, summarize
+
+def print_summary(rows: list, confidence: float) -> None:
+    criteria = {}
+    for row in rows:
+        criteria.setdefault((row['criterion_id'], row['criterion']), []).append(row)
+
+    for (criterion_id, name), criterion_rows in criteria.items():
+        print(f"== Criterion {criterion_id}: {name.strip()} ==")
+        header = f"{'model':<16} {'condition':<10} {'items':>6} {'win_rate':>9} {f'{confidence:.0%} CI':>17} {'mean_rank':>10} {'borda':>9}"
+        print(header)
+        print("-" * len(header))
+        for row in criterion_rows:
+            lower, upper = row['win_rate_ci']
+            interval = f"[{lower:.3f}, {upper:.3f}]" if lower is not None else "n/a"
+            mean_rank = f"{row['mean_rank']:.2f}" if row['mean_rank'] is not None else "-"
+            borda = f"{row['borda']:.0f}" if row['borda'] is not None else "-"
+            win_rate = f"{row['win_rate']:.3f}" if row['win_rate'] is not None else "n/a"
+            print(f"{row['model']:<16} {row['condition']:<10} {row['items']:>6} {win_rate:>9} {interval:>17} {mean_rank:>10} {borda:>9}")
+        print()
+
+def print_agreement(results, matrix) -> None:
+    ranking = [k for k, kind in enumerate(results.criterion_kinds) if kind == RANKING]
+    if len(ranking) < 2:
+        return
+    print("== Kendall's tau-b agreement between ranking criteria ==")
+    print(f"{'':>10}" + "".join(f"{f'c{results.criterion_ids[k]}':>8}" for k in ranking))
+    for a in ranking:
+        print(f"{f'c{results.criterion_ids[a]}':>10}" + "".join(f"{matrix[a, b]:>8.3f}" for b in ranking))
+    print()
+
+def main():
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Win rates, mean ranks, Borda scores, Kendall's tau and bootstrap confidence intervals over evaluation results")
+    parser.add_argument("--input", type=str, required=True, help="Path to evaluation results JSON or JSONL file (output of evaluate.py)")
+    parser.add_argument("--output", type=str, help="Path to write the summary as JSON")
+    parser.add_argument("--cache", type=str, help="Path to the parsed-array cache (default: <input>.analytics.npz)")
+    parser.add_argument("--no-cache", action="store_true", help="Parse the evaluation results without reading or writing the cache")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="Number of bootstrap resamples over items (0 to skip confidence intervals)")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the bootstrap intervals")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the bootstrap")
+    args = parser.parse_args()
+
+    cache_path = None if args.no_cache else (args.cache or f"{args.input}.analytics.npz")
+    started_at = time.time()
+    results = load_results_array(args.input, cache_path)
+    logging.info(f"Loaded {results.values.shape[0]} items x {len(results.models)} models x {len(results.conditions)} conditions x {len(results.criterion_ids)} criteria in {time.time() - started_at:.2f}s")
+
+    started_at = time.time()
+    rows = summarize(results, args.bootstrap, args.confidence, args.seed)
+    agreement = kendall_tau_matrix(results)
+    logging.info(f"Computed statistics in {time.time() - started_at:.2f}s")
+
+    print_summary(rows, args.confidence)
+    print_agreement(results, agreement)
+
+    if args.output:
+        report = {
+            "items": results.values.shape[0],
+            "bootstrap": args.bootstrap,
+            "confidence": args.confidence,
+            "rows": rows,
+            "kendall_tau": {
+                "criterion_ids": results.criterion_ids,
+                "matrix": [[None if value != value else float(value) for value in row] for row in agreement],
+            },
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Analytics saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/bin/bash
+
+set -e
+
+# ===============================
+# 変数の設定
+# ===============================
+
+# 入力ファイルのパス（evaluate.py の出力）
+INPUT_FILE="evaluation_results.json"
+
+# 集計結果の出力ファイル
+OUTPUT_FILE="analytics_report.json"
+
+# ブートストラップの反復回数と信頼水準
+BOOTSTRAP=1000
+CONFIDENCE=0.95
+
+# ===============================
+# スクリプトの実行
+# ===============================
+
+# 解析済みの配列は INPUT_FILE.analytics.npz にキャッシュされ、入力が変わらなければ再利用される
+python3 analyze/analyze.py \
+  --input "$INPUT_FILE" \
+  --output "$OUTPUT_FILE" \
+  --bootstrap "$BOOTSTRAP" \
+  --confidence "$CONFIDENCE"
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# プロジェクトのルートディレクトリをシステムパスに追加
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from utils.logging_config import setup_logging
+from bench.mock_server import add_server_arguments, start_server
+
+BENCH_CONFIG = '''openai_api_key = "sk-mock"
+groq_api_key = "gsk-mock"
+prompt_path = {prompt_path!r}
+evaluation_index_path = {evaluation_index_path!r}
+evaluation_prompt_path = {evaluation_prompt_path!r}
+models = {{
+    "mini": {{"client_type": "openai", "model": "gpt-4o-mini"}},
+    "gpt": {{"client_type": "openai", "model": "gpt-4o"}},
+    "llama": {{"client_type": "groq", "model": "llama-3.1-70b-versatile"}},
+}}
+'''
+
+def write_bench_config(directory: str) -> None:
+    """モックサーバー用の config.py を一時ディレクトリに作成します。"""
+    with open(os.path.join(directory, "config.py"), 'w', encoding='utf-8') as f:
+        f.write(BENCH_CONFIG.format(
+            prompt_path=os.path.join(project_root, "prompt.json"),
+            evaluation_index_path=os.path.join(project_root, "evaluation_index.json"),
+            evaluation_prompt_path=os.path.join(project_root, "evaluate_prompt.json"),
+        ))
+
+def write_synthetic_input(source_path: str, size: int, output_path: str) -> None:
+    """入力ファイルの項目を繰り返して size 件のデータセットを作成します。"""
+    with open(source_path, 'r', encoding='utf-8') as f:
+        source = json.load(f)
+    items = [dict(source[index % len(source)], id=index) for index in range(size)]
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(items, f, ensure_ascii=False)
+
+def server_request(base_url: str, path: str, method: str = "GET") -> dict:
+    request = urllib.request.Request(base_url + path, data=b"{}" if method == "POST" else None, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def run_script(name: str, command: list, env: dict, base_url: str) -> dict:
+    server_request(base_url, "/reset", "POST")
+    started_at = time.time()
+    completed = subprocess.run(command, cwd=project_root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall_time = time.time() - started_at
+    stats = server_request(base_url, "/stats")
+    if completed.returncode != 0:
+        print(f"{name} failed with exit code {completed.returncode}:\n{completed.stderr[-2000:]}", file=sys.stderr)
+    return {
+        "script": name,
+        "returncode": completed.returncode,
+        "wall_time": wall_time,
+        "requests": stats["requests"],
+        "requests_per_second": stats["requests"] / wall_time if wall_time else 0.0,
+        "status_counts": stats["status_counts"],
+        "steps": stats["steps"],
+    }
+
+def print_report(results: list) -> None:
+    print(f"{'script':<10} {'items':>6} {'conc':>5} {'wall(s)':>9} {'reqs':>6} {'req/s':>8}  step latency p50/p95/p99 (s)")
+    for result in results:
+        steps = ", ".join(
+            f"{step} {values['p50']:.2f}/{values['p95']:.2f}/{values['p99']:.2f}"
+            for step, values in sorted(result["steps"].items())
+        )
+        status = "" if result["returncode"] == 0 else "  [failed]"
+        print(f"{result['script']:<10} {result['items']:>6} {result['concurrency']:>5} {result['wall_time']:>9.2f} {result['requests']:>6} {result['requests_per_second']:>8.2f}  {steps}{status}")
+
+def main():
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Benchmark generate.py, evaluate.py and whole/main.py against the local mock server")
+    parser.add_argument("--sizes", nargs='+', type=int, default=[5, 20], help="Dataset sizes (number of items) to benchmark")
+    parser.add_argument("--concurrency", nargs='+', type=int, default=[1, 8], help="Concurrency levels to benchmark")
+    parser.add_argument("--models", nargs='+', default=["mini", "gpt", "llama"], help="AI models to use")
+    parser.add_argument("--conditions", nargs='+', default=["x1", "x2", "x3", "x4", "x5", "x6", "x7"], help="Conditions to use")
+    parser.add_argument("--criteria-ids", nargs='+', type=int, default=[1, 2, 3, 4, 5, 6, 7, 8], help="IDs of evaluation criteria to use")
+    parser.add_argument("--scripts", nargs='+', choices=["generate", "evaluate", "whole"], default=["generate", "evaluate", "whole"], help="Entry points to benchmark")
+    parser.add_argument("--input", type=str, default=os.path.join(project_root, "input.json"), help="Source items for the synthetic datasets")
+    parser.add_argument("--report", type=str, help="Path to write the benchmark results as JSON")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server, _ = start_server(args)
+    host, port = server.server_address[:2]
+    base_url = f"http://{host}:{port}"
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        write_bench_config(work_dir)
+        env = dict(os.environ)
+        env.update({
+            "OPENAI_BASE_URL": f"{base_url}/v1",
+            "GROQ_BASE_URL": base_url,
+            "PYTHONPATH": os.pathsep.join([work_dir, project_root, env.get("PYTHONPATH", "")]),
+        })
+
+        for size in args.sizes:
+            input_path = os.path.join(work_dir, f"input_{size}.json")
+            write_synthetic_input(args.input, size, input_path)
+            for concurrency in args.concurrency:
+                generated_path = os.path.join(work_dir, f"generated_{size}_{concurrency}.json")
+                commands = {
+                    "generate": [
+                        sys.executable, "generate/generate.py",
+                        "--models", *args.models, "--temperature", "0", "--max-tokens", "150",
+                        "--conditions", *args.conditions, "--input", input_path, "--output", generated_path,
+                        "--concurrency", str(concurrency),
+                    ],
+                    "evaluate": [
+                        sys.executable, "evaluate/evaluate.py",
+                        "--input", generated_path, "--output", os.path.join(work_dir, f"evaluated_{size}_{concurrency}.json"),
+                        "--criteria-ids", *map(str, args.criteria_ids), "--temperature", "0", "--max-tokens", "1000",
+                        "--concurrency", str(concurrency), "--criteria-concurrency", str(concurrency),
+                    ],
+                    "whole": [
+                        sys.executable, "whole/main.py",
+                        "--models", *args.models, "--temperature", "0", "--max-tokens", "150",
+                        "--conditions", *args.conditions, "--input", input_path,
+                        "--output", os.path.join(work_dir, f"whole_{size}_{concurrency}.json"),
+                        "--criteria-ids", *map(str, args.criteria_ids),
+                        "--generation-workers", str(concurrency), "--evaluation-workers", str(concurrency),
+                        "--criteria-concurrency", str(concurrency),
+                    ],
+                }
+                for script in args.scripts:
+                    result = run_script(script, commands[script], env, base_url)
+                    result.update({"items": size, "concurrency": concurrency})
+                    results.append(result)
+                    print_report([result])
+
+    server.shutdown()
+
+    print()
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Benchmark results saved to {args.report}")
+
+if __name__ == "__main__":
+    main()
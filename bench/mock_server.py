@@ -0,0 +1,375 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# プロジェクトのルートディレクトリをシステムパスに追加
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from utils.logging_config import setup_logging
+from utils.file_handlers import load_prompts, load_evaluation_prompts
+
+GENERATION_STEP_NAMES = {
+    "premise_generation_prompt": "premise_generation",
+    "premise_decision_prompt": "premise_decision",
+    "counter-argument_generation_prompt": "counterargument_generation",
+}
+
+WORDS = (
+    "the argument assumes premise evidence however this claim overlooks policy risk benefit cost "
+    "society children parents medical practice research shows that consequences are uncertain and "
+    "therefore the conclusion does not follow from its stated reasons because context matters"
+).split()
+
+class StepClassifier:
+    """最後のユーザーメッセージがどのプロンプトから作られたかを判定し、ステップ名を返します。"""
+
+    def __init__(self, prompts: dict, evaluation_prompts: dict):
+        self.exact = {}
+        self.markers = []
+        for condition, condition_prompts in prompts.items():
+            if not isinstance(condition_prompts, dict):
+                continue
+            for key, template in condition_prompts.items():
+                self._add_template(template, GENERATION_STEP_NAMES.get(key, key), r"#topic#|#argument#|###premise_list###")
+        # 全モデルをまとめて評価する joint_ のプロンプトも同じステップとして数える
+        for prefix in ("", "joint_"):
+            if prefix + 'analysis_user_prompt' in evaluation_prompts:
+                self.exact[evaluation_prompts[prefix + 'analysis_user_prompt']] = "analysis"
+                # prefix レイアウトでは分析の依頼の後ろにトピックや反論が続く
+                self.markers.append((evaluation_prompts[prefix + 'analysis_user_prompt'], "analysis"))
+            for key, step in (("selection_user_prompt_template", "selection"), ("ranking_user_prompt_template", "ranking"), ("multi_criteria_user_prompt_template", "multi_criteria")):
+                if prefix + key in evaluation_prompts:
+                    self._add_template(evaluation_prompts[prefix + key], step, r"\{[a-z_]+\}")
+
+    def _add_template(self, template: str, step: str, placeholder: str) -> None:
+        parts = [part for part in re.split(placeholder, template) if part.strip()]
+        if len(parts) == 1 and parts[0] == template:
+            self.exact[template] = step
+        else:
+            # プレースホルダーを含まない最長の断片をマーカーとして使う
+            # prefix レイアウトでは段落の順序が変わるため、前後の空白を除いて照合する
+            self.markers.append((max(parts, key=len).strip(), step))
+        # 長いマーカーを優先して照合する
+        self.markers.sort(key=lambda marker: len(marker[0]), reverse=True)
+
+    def classify(self, messages: list) -> str:
+        content = messages[-1]['content'] if messages else ""
+        if content in self.exact:
+            return self.exact[content]
+        for marker, step in self.markers:
+            if marker in content:
+                return step
+        return "other"
+
+# プロンプトキャッシュを判定する単位（文字数）。トークン数は文字数の1/4と見積もる
+PROMPT_CACHE_BLOCK_CHARS = 512
+
+class MockState:
+    """遅延・エラーの注入設定と、ステップごとのリクエスト統計を保持します。"""
+
+    def __init__(self, args, classifier: StepClassifier):
+        self.args = args
+        self.classifier = classifier
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started_at = time.time()
+            self.latencies = {}
+            self.status_counts = {}
+            self.prompt_prefixes = set()
+
+    def sample_latency(self) -> float:
+        args = self.args
+        with self.lock:
+            if args.latency_dist == "fixed":
+                latency = args.latency_mean
+            elif args.latency_dist == "uniform":
+                latency = self.random.uniform(max(0.0, args.latency_mean - args.latency_stddev), args.latency_mean + args.latency_stddev)
+            elif args.latency_dist == "normal":
+                latency = self.random.gauss(args.latency_mean, args.latency_stddev)
+            else:
+                # 平均と標準偏差が指定した値になる対数正規分布
+                variance = args.latency_stddev ** 2
+                mean = max(args.latency_mean, 1e-6)
+                sigma = (max(0.0, math.log(1 + variance / mean ** 2))) ** 0.5
+                mu = math.log(mean) - sigma ** 2 / 2
+                latency = self.random.lognormvariate(mu, sigma)
+        return max(0.0, latency)
+
+    def prompt_cache_tokens(self, messages: list) -> int:
+        """OpenAI のプロンプトキャッシュを模して、以前のリクエストと一致する先頭部分のトークン数を返します。
+
+        会話を PROMPT_CACHE_BLOCK_CHARS 文字（約128トークン）ごとに区切り、先頭から一致したブロックの分だけを数えます。
+        """
+        text = "".join(f"{message.get('role')}\x00{message.get('content') or ''}\x00" for message in messages)
+        digest = hashlib.sha256()
+        prefixes = []
+        for start in range(0, len(text) - PROMPT_CACHE_BLOCK_CHARS + 1, PROMPT_CACHE_BLOCK_CHARS):
+            digest.update(text[start:start + PROMPT_CACHE_BLOCK_CHARS].encode("utf-8"))
+            prefixes.append(digest.hexdigest())
+        with self.lock:
+            matched = 0
+            while matched < len(prefixes) and prefixes[matched] in self.prompt_prefixes:
+                matched += 1
+            self.prompt_prefixes.update(prefixes)
+        cached_tokens = matched * PROMPT_CACHE_BLOCK_CHARS // 4
+        return cached_tokens if cached_tokens >= self.args.prompt_cache_min_tokens else 0
+
+    def sample_failure(self):
+        with self.lock:
+            value = self.random.random()
+        if value < self.args.rate_limit_rate:
+            return 429
+        if value < self.args.rate_limit_rate + self.args.error_rate:
+            return 500
+        return None
+
+    def record(self, step: str, status: int, latency: float) -> None:
+        with self.lock:
+            self.status_counts[str(status)] = self.status_counts.get(str(status), 0) + 1
+            if status == 200:
+                self.latencies.setdefault(step, []).append(latency)
+
+    def stats(self) -> dict:
+        with self.lock:
+            steps = {}
+            for step, latencies in self.latencies.items():
+                ordered = sorted(latencies)
+                steps[step] = {
+                    "count": len(ordered),
+                    "p50": percentile(ordered, 50),
+                    "p95": percentile(ordered, 95),
+                    "p99": percentile(ordered, 99),
+                }
+            return {
+                "elapsed": time.time() - self.started_at,
+                "requests": sum(self.status_counts.values()),
+                "status_counts": dict(self.status_counts),
+                "steps": steps,
+            }
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+COUNTER_ARGUMENTS_PATTERN = re.compile(r"Counter-arguments:\n(.*?)(?:\n\n|\Z)", re.DOTALL)
+
+def count_counter_arguments(messages: list) -> int:
+    """評価のメッセージに番号付きで並んだ反論の数を返します。見つからなければ従来どおり7とします。"""
+    for message in messages:
+        match = COUNTER_ARGUMENTS_PATTERN.search(message.get('content') or "")
+        if match is not None:
+            numbers = [int(number) for number in re.findall(r"^(\d+)\. ", match.group(1), re.MULTILINE)]
+            if numbers:
+                return max(numbers)
+    return 7
+
+def canned_output(messages: list, max_tokens: int, response_format=None, choice_index: int = 0):
+    """メッセージのハッシュ（と n を指定された場合は応答の番号）から決定的な応答を作ります。(content, finish_reason) を返します。"""
+    digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")).digest()
+    rng = random.Random(digest + choice_index.to_bytes(4, "big") if choice_index else digest)
+    last_message = messages[-1]['content'] if messages else ""
+    num_counter_arguments = count_counter_arguments(messages)
+
+    if response_format is not None:
+        criteria = re.findall(r"^(\d+)\. \((\w+)", last_message, re.MULTILINE)
+        results = []
+        for criterion_id, kind in criteria:
+            numbers = list(range(1, num_counter_arguments + 1))
+            rng.shuffle(numbers)
+            # ランキングは全ての反論を並べ、選択は一部を選ぶ
+            results.append({"id": int(criterion_id), "result": numbers if kind == "Ranking" else sorted(numbers[:rng.randint(0, num_counter_arguments)])})
+        return json.dumps({"results": results}), "stop"
+
+    if "Python list" in last_message:
+        numbers = list(range(1, num_counter_arguments + 1))
+        rng.shuffle(numbers)
+        if "select" in last_message.lower() and "rank all" not in last_message.lower():
+            numbers = sorted(numbers[:rng.randint(0, num_counter_arguments)])
+        return json.dumps(numbers), "stop"
+
+    length = rng.randint(40, 160)
+    finish_reason = "stop"
+    if max_tokens is not None and length > max_tokens:
+        length = max_tokens
+        finish_reason = "length"
+    words = [rng.choice(WORDS) for _ in range(length)]
+    return " ".join(words).capitalize() + ".", finish_reason
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def _send_json(self, status: int, body: dict, headers: dict = None) -> None:
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def _send_stream(self, body: dict, completion_id: str, content: str, finish_reason: str, usage: dict) -> None:
+            """応答を Server-Sent Events で単語ごとに送ります。単語の間隔は --tokens-per-second で決まります。"""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def event(delta: dict, chunk_finish_reason=None, chunk_usage=None) -> bytes:
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": chunk_finish_reason}] if delta is not None else [],
+                }
+                if chunk_usage is not None:
+                    chunk["usage"] = chunk_usage
+                return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+            delay = 1.0 / state.args.tokens_per_second if state.args.tokens_per_second > 0 else 0.0
+            try:
+                self._send_chunk(event({"role": "assistant", "content": ""}))
+                for index, piece in enumerate(re.findall(r"\S+\s*", content)):
+                    if index > 0 and delay > 0:
+                        time.sleep(delay)
+                    self._send_chunk(event({"content": piece}))
+                self._send_chunk(event({}, finish_reason))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self._send_chunk(event(None, chunk_usage=usage))
+                self._send_chunk(b"data: [DONE]\n\n")
+                self._send_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # クライアントが停止規則で受信を打ち切った
+                self.close_connection = True
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                self._send_json(200, state.stats())
+            else:
+                self._send_json(404, {"error": {"message": "Not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            if self.path.rstrip("/") == "/reset":
+                state.reset()
+                self._send_json(200, {"status": "ok"})
+                return
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": "Not found"}})
+                return
+
+            messages = body.get("messages", [])
+            step = state.classifier.classify(messages)
+            latency = state.sample_latency()
+            time.sleep(latency)
+
+            failure = state.sample_failure()
+            if failure == 429:
+                state.record(step, 429, latency)
+                self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}, {"Retry-After": str(state.args.retry_after)})
+                return
+            if failure == 500:
+                state.record(step, 500, latency)
+                self._send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+                return
+
+            outputs = [canned_output(messages, body.get("max_tokens"), body.get("response_format"), index) for index in range(body.get("n") or 1)]
+            prompt_tokens = sum(len(message.get("content") or "") for message in messages) // 4
+            completion_tokens = sum(max(1, len(content) // 4) for content, _ in outputs)
+            cached_tokens = min(prompt_tokens, state.prompt_cache_tokens(messages))
+            choices = [
+                {"index": index, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}
+                for index, (content, finish_reason) in enumerate(outputs)
+            ]
+            content = outputs[0][0]
+            completion_id = f"chatcmpl-mock-{hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]}"
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            }
+            state.record(step, 200, latency)
+            if body.get("stream"):
+                self._send_stream(body, completion_id, content, outputs[0][1], usage)
+                return
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": choices,
+                "usage": usage,
+            })
+
+    return Handler
+
+def add_server_arguments(parser) -> None:
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "normal", "lognormal"], default="lognormal", help="Distribution of injected response latency")
+    parser.add_argument("--latency-mean", type=float, default=0.5, help="Mean injected latency in seconds")
+    parser.add_argument("--latency-stddev", type=float, default=0.2, help="Standard deviation (or half-width for uniform) of injected latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429 responses")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latency and failure injection")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Rate at which streamed responses (stream=true) send words after the injected latency; 0 sends them at once")
+    parser.add_argument("--prompt-cache-min-tokens", type=int, default=1024, help="Report cached_tokens only when the matching prompt prefix is at least this long (OpenAI caches prompts of 1024+ tokens)")
+
+def start_server(args, host: str = "127.0.0.1", port: int = 0):
+    """モックサーバーをバックグラウンドスレッドで起動し、(server, state) を返します。"""
+    classifier = StepClassifier(load_prompts(os.path.join(project_root, "prompt.json")), load_evaluation_prompts(os.path.join(project_root, "evaluate_prompt.json")))
+    state = MockState(args, classifier)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def main():
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Local OpenAI/Groq-compatible chat completions server for benchmarks")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server, _ = start_server(args, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"Mock server listening on http://{host}:{port}")
+    print(f"  export OPENAI_BASE_URL=http://{host}:{port}/v1")
+    print(f"  export GROQ_BASE_URL=http://{host}:{port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
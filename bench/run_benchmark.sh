@@ -0,0 +1,37 @@
+#!/bin/bash
+
+set -e
+
+# ===============================
+# 変数の設定
+# ===============================
+
+# ベンチマークするデータセットのサイズ（アイテム数）
+SIZES="5 20 100"
+
+# ベンチマークする並列数
+CONCURRENCY="1 8 32"
+
+# モックサーバーの応答遅延（秒）
+LATENCY_MEAN=0.5
+LATENCY_STDDEV=0.2
+
+# 429 / 500 エラーを返す割合
+RATE_LIMIT_RATE=0.02
+ERROR_RATE=0.01
+
+# 結果の出力ファイル
+REPORT_FILE="bench_report.json"
+
+# ===============================
+# スクリプトの実行
+# ===============================
+
+python3 bench/benchmark.py \
+  --sizes $SIZES \
+  --concurrency $CONCURRENCY \
+  --latency-mean "$LATENCY_MEAN" \
+  --latency-stddev "$LATENCY_STDDEV" \
+  --rate-limit-rate "$RATE_LIMIT_RATE" \
+  --error-rate "$ERROR_RATE" \
+  --report "$REPORT_FILE"
@@ -1,5 +1,4 @@
 import argparse
-import json
 import logging
 import sys
 import os
@@ -12,27 +11,127 @@ from config import (
     evaluation_prompt_path
 )
 from utils.logging_config import setup_logging
-from utils.file_handlers import load_evaluation_index, load_evaluation_prompts
+from utils.response_cache import add_cache_arguments, configure_cache_from_args, log_cache_stats
+from utils.token_budget import add_token_budget_arguments, configure_token_budget_from_args, log_truncation_stats
+from utils.tracing import add_tracing_arguments, configure_tracing_from_args, finish_tracing, trace_tags
+from utils.prompt_templates import add_layout_arguments
+from utils.file_handlers import JsonlIndex, JsonlSink, iter_items, load_evaluation_index, load_evaluation_prompts, read_jsonl, write_items
 
-from models.ai_models import get_ai_client
-from evaluators.argument_evaluator import evaluate_arguments
+from models.ai_models import add_client_arguments, configure_clients_from_args, get_ai_client
+from models.request_layer import add_request_arguments, configure_requests_from_args
+from evaluators.argument_evaluator import build_counter_arguments_text, count_counter_arguments, evaluate_arguments, evaluation_input_hash, validate_evaluation_prompts
+from evaluators.joint import add_model_mode_arguments, build_joint_counter_arguments, evaluate_item_jointly, joint_evaluation_prompts, validate_joint_evaluation_prompts
+from evaluators.batch import collect_evaluation_results, export_evaluation_stage, import_evaluation_results, init_evaluation_state, remaining_groups
+from utils.batch_api import load_batch_state, read_batch_results, save_batch_state, write_batch_requests
+from utils.concurrency import ordered_map
+from utils.sharding import add_shard_arguments, make_item_filter, parse_shard
 
-def load_generated_data(file_path: str) -> list:
+def iter_generated_data(file_path: str):
+    """生成結果のファイル（JSON配列または JSONL）を1件ずつ読み込みます。"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        if not isinstance(data, list):
-            raise ValueError("Generated data JSON must be a list")
-        return data
+        yield from iter_items(file_path)
     except Exception as e:
         logging.error(f"Error loading generated data from {file_path}: {e}")
         sys.exit(1)
 
-def extract_counterargument(counter_arg):
-    for step in counter_arg['steps']:
-        if step['step'] == 'counterargument_generation':
-            return step['output']
-    return None
+def iter_selected_items(file_path: str, is_selected):
+    """処理対象の (アイテムキー, 項目) を1件ずつ返します。ID のない項目はファイル内の位置をキーにします。"""
+    for index, item in enumerate(iter_generated_data(file_path)):
+        item_key = item.get('id', index)
+        if is_selected(item_key):
+            yield item_key, item
+
+def load_previous_evaluations(file_path: str) -> dict:
+    """以前の評価結果ファイルから (item, model) ごとの入力ハッシュと評価結果を読み込みます。"""
+    if not os.path.exists(file_path):
+        logging.warning(f"No previous evaluation results found at {file_path}; evaluating everything")
+        return {}
+    previous = {}
+    for index, item in enumerate(iter_generated_data(file_path)):
+        item_key = item.get('id', index)
+        hashes = item.get('evaluation_hashes', {})
+        for model_name, evaluation_results in item.get('evaluation_results', {}).items():
+            if model_name in hashes:
+                previous[(item_key, model_name)] = {"input_hash": hashes[model_name], "evaluation_results": evaluation_results}
+    return previous
+
+def compact_checkpoint(checkpoint_path: str, input_path: str, is_selected):
+    """チェックポイントの評価結果を生成結果の各項目に書き戻し、1件ずつ返します。"""
+    with JsonlIndex(checkpoint_path, key=lambda record: (record['id'], record['model'])) as evaluated:
+        yield from attach_evaluation_results(iter_selected_items(input_path, is_selected), evaluated.get)
+
+def attach_evaluation_results(keyed_items, lookup):
+    """lookup((item, model)) が返す評価レコード（evaluation_results と input_hash）を各項目に付けます。"""
+    for item_key, item in keyed_items:
+        item['evaluation_results'] = {}
+        item.pop('evaluation_hashes', None)
+        hashes = {}
+        for model_name in item['counterarguments']:
+            record = lookup((item_key, model_name))
+            if record is None:
+                continue
+            item['evaluation_results'][model_name] = record['evaluation_results']
+            if record.get('input_hash'):
+                hashes[model_name] = record['input_hash']
+        if hashes:
+            item['evaluation_hashes'] = hashes
+        yield item
+
+def run_batch_stage(args, evaluation_prompts: dict, selected_criteria: list, is_selected) -> None:
+    """バッチAPI用に分析・評価指標のリクエストを1段階ずつ書き出し、結果を取り込みます。"""
+    state_path = args.batch_state or f"{args.output}.batch_state.json"
+    state = load_batch_state(state_path)
+
+    if args.batch == "import":
+        if state is None:
+            logging.error(f"No batch state found at {state_path}; run --batch export first")
+            sys.exit(1)
+        imported = import_evaluation_results(state, read_batch_results(args.batch_results))
+        save_batch_state(state_path, state)
+        remaining = remaining_groups(state)
+        print(f"Imported {imported} batch results; {remaining} evaluations remaining")
+        if remaining == 0:
+            evaluated = {key: {"evaluation_results": results} for key, results in collect_evaluation_results(state).items()}
+            write_items(args.output, attach_evaluation_results(iter_selected_items(args.input, is_selected), evaluated.get))
+            print(f"Evaluation results saved to {args.output}")
+        return
+
+    if state is None:
+        groups = []
+        for item_key, item in iter_selected_items(args.input, is_selected):
+            if args.model_mode == "joint":
+                counter_arguments_text, labels = build_joint_counter_arguments(item)
+                if counter_arguments_text is not None:
+                    groups.append({
+                        "id": item_key,
+                        "model": "joint",
+                        "topic": item['topic'],
+                        "affirmative_argument": item['affirmative_argument'],
+                        "counter_arguments": counter_arguments_text,
+                        "labels": labels,
+                    })
+                continue
+            for model_name, model_counterarguments in item['counterarguments'].items():
+                counter_arguments_text = build_counter_arguments_text(model_counterarguments, model_name, item['topic'])
+                if counter_arguments_text is None:
+                    continue
+                groups.append({
+                    "id": item_key,
+                    "model": model_name,
+                    "topic": item['topic'],
+                    "affirmative_argument": item['affirmative_argument'],
+                    "counter_arguments": counter_arguments_text,
+                })
+        state = init_evaluation_state(groups, args.evaluation_model, selected_criteria, args.temperature, args.max_tokens, args.message_layout, args.model_mode)
+    requests_path = args.batch_requests or f"{args.output}.batch_requests.jsonl"
+    written = write_batch_requests(requests_path, export_evaluation_stage(state, evaluation_prompts))
+    # 書き出したファイルを記録し、取り込み時に結果の足りないファイルを示す
+    state["batch_files"] = written
+    save_batch_state(state_path, state)
+    if written:
+        print(f"Batch requests written to {', '.join(written.values())}; run with --batch import --batch-results <files> when the batches finish")
+    else:
+        print(f"All evaluations are complete; run with --batch import to write {args.output}")
 
 def main():
     setup_logging()
@@ -40,13 +139,38 @@ def main():
     evaluation_prompts = load_evaluation_prompts(evaluation_prompt_path)
 
     parser = argparse.ArgumentParser(description="Counter-Argument Evaluator")
-    parser.add_argument("--input", type=str, required=True, help="Path to generated counterarguments JSON file")
-    parser.add_argument("--output", type=str, default='evaluation_results.json', help="Path to output JSON file")
+    parser.add_argument("--input", type=str, required=True, help="Path to generated counterarguments JSON or JSONL file")
+    parser.add_argument("--output", type=str, default='evaluation_results.json', help="Path to output JSON file (written as JSONL if it ends with .jsonl)")
     parser.add_argument("--evaluation-model", type=str, default='gpt-4o-2024-08-06', help="Model to use for evaluation")
     parser.add_argument("--criteria-ids", nargs='+', type=int, required=True, help="IDs of evaluation criteria to use")
     parser.add_argument("--temperature", type=float, required=True, help="Temperature for evaluation")
     parser.add_argument("--max-tokens", type=int, required=True, help="Max tokens for evaluation")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of (item, model) evaluations to run in parallel")
+    parser.add_argument("--criteria-concurrency", type=int, default=1, help="Number of per-criterion calls to run in parallel after the shared analysis")
+    parser.add_argument("--criteria-mode", choices=["separate", "combined"], default="separate", help="Evaluate each criterion in its own request, or all criteria in one structured request")
+    parser.add_argument("--request-timeout", type=float, default=None, help="Timeout in seconds for each evaluation request")
+    parser.add_argument("--checkpoint", type=str, help="Path to the append-only JSONL checkpoint (default: <output>.checkpoint.jsonl)")
+    parser.add_argument("--resume", action="store_true", help="Skip evaluations already recorded in the checkpoint")
+    parser.add_argument("--incremental", action="store_true", help="Only evaluate (item, model) pairs whose inputs changed since the previous results, copying the rest forward")
+    parser.add_argument("--previous", type=str, help="Previous evaluation results used by --incremental (default: --output)")
+    parser.add_argument("--batch", choices=["export", "import"], help="Export the next evaluation stage as a batch JSONL file, or import batch results")
+    parser.add_argument("--batch-state", type=str, help="Path to the batch progress state (default: <output>.batch_state.json)")
+    parser.add_argument("--batch-requests", type=str, help="Batch request file prefix; one file per provider and model is written (default: <output>.batch_requests.jsonl)")
+    parser.add_argument("--batch-results", nargs='+', default=[], help="Batch result JSONL files to import")
+    add_shard_arguments(parser)
+    add_model_mode_arguments(parser)
+    add_layout_arguments(parser)
+    add_cache_arguments(parser)
+    add_request_arguments(parser)
+    add_client_arguments(parser)
+    add_token_budget_arguments(parser)
+    add_tracing_arguments(parser)
     args = parser.parse_args()
+    configure_cache_from_args(args)
+    configure_requests_from_args(args)
+    configure_clients_from_args(args)
+    configure_tracing_from_args(args)
+    configure_token_budget_from_args(args)
 
     # APIキーの設定
     os.environ['OPENAI_API_KEY'] = openai_api_key
@@ -62,42 +186,139 @@ def main():
         logging.error(f"No evaluation criteria matched the specified IDs: {args.criteria_ids}")
         sys.exit(1)
 
-    generated_data = load_generated_data(args.input)
+    is_selected = make_item_filter(shard=parse_shard(args.shard))
 
-    for item in generated_data:
-        topic = item['topic']
-        affirmative_argument = item['affirmative_argument']
-        item['evaluation_results'] = {}
+    try:
+        validate_evaluation_prompts(evaluation_prompts)
+        if args.model_mode == "joint":
+            validate_joint_evaluation_prompts(evaluation_prompts)
+    except ValueError as e:
+        logging.error(f"Invalid evaluation prompts in {evaluation_prompt_path}: {e}")
+        sys.exit(1)
+
+    if args.batch:
+        run_batch_stage(args, evaluation_prompts, selected_criteria, is_selected)
+        return
+
+    # 完了した (item, model) ごとにチェックポイントへ追記する
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.jsonl"
+    completed = set()
+    if args.resume:
+        completed = {(record['id'], record['model']) for record in read_jsonl(checkpoint_path)}
+        logging.info(f"Resuming from {checkpoint_path}: {len(completed)} evaluations already completed")
 
-        # 各モデルについて評価を実行
-        for model_name, model_counterarguments in item['counterarguments'].items():
-            counter_arguments_text = ""
-            for idx, (key, counter_arg) in enumerate(model_counterarguments.items(), start=1):
-                counterargument = extract_counterargument(counter_arg)
-                if counterargument:
-                    counter_arguments_text += f"{idx}. {counterargument}\n"
-                else:
-                    logging.warning(f"No counterargument found for {key} in model {model_name} on topic '{topic}'")
-
-            if counter_arguments_text.strip() == "":
-                logging.warning(f"No valid counterarguments to evaluate for model {model_name} on topic '{topic}'")
+    # 入力ハッシュが前回と同じ (item, model) は評価結果をそのまま引き継ぐ
+    previous = {}
+    if args.incremental:
+        previous = load_previous_evaluations(args.previous or args.output)
+    reused = 0
+
+    def iter_tasks():
+        nonlocal reused
+        for item_key, item in iter_selected_items(args.input, is_selected):
+            # 各モデルについて評価を実行
+            for model_name, model_counterarguments in item['counterarguments'].items():
+                if (item_key, model_name) in completed:
+                    continue
+                counter_arguments_text = build_counter_arguments_text(model_counterarguments, model_name, item['topic'])
+                if counter_arguments_text is None:
+                    continue
+                input_hash = evaluation_input_hash(
+                    item['topic'], item['affirmative_argument'], counter_arguments_text,
+                    selected_criteria, eval_model, evaluation_prompts, args.message_layout,
+                    args.criteria_mode, args.temperature, args.max_tokens
+                )
+                previous_result = previous.get((item_key, model_name))
+                if previous_result is not None and previous_result['input_hash'] == input_hash:
+                    sink.write({"id": item_key, "model": model_name, "input_hash": input_hash, "evaluation_results": previous_result['evaluation_results']})
+                    reused += 1
+                    continue
+                yield item_key, item, model_name, counter_arguments_text, input_hash
+
+    # --model-mode joint では項目ごとに全モデルの反論をまとめて1つのタスクにする
+    joint_prompts = joint_evaluation_prompts(evaluation_prompts)
+
+    def iter_joint_tasks():
+        nonlocal reused
+        for item_key, item in iter_selected_items(args.input, is_selected):
+            if all((item_key, model_name) in completed for model_name in item['counterarguments']):
                 continue
+            counter_arguments_text, labels = build_joint_counter_arguments(item)
+            if counter_arguments_text is None:
+                continue
+            # 評価結果はどのモデルの反論も全モデルの反論に左右されるため、全モデルで同じ入力ハッシュを使う
+            input_hash = evaluation_input_hash(
+                item['topic'], item['affirmative_argument'], counter_arguments_text,
+                selected_criteria, eval_model, joint_prompts, args.message_layout,
+                args.criteria_mode, args.temperature, args.max_tokens
+            )
+            model_names = list(dict.fromkeys(model_name for model_name, _ in labels))
+            previous_results = [previous.get((item_key, model_name)) for model_name in model_names]
+            if all(previous_result is not None and previous_result['input_hash'] == input_hash for previous_result in previous_results):
+                for model_name, previous_result in zip(model_names, previous_results):
+                    sink.write({"id": item_key, "model": model_name, "input_hash": input_hash, "evaluation_results": previous_result['evaluation_results']})
+                reused += len(model_names)
+                continue
+            yield item_key, item, counter_arguments_text, labels, input_hash
+
+    def run_task(task):
+        item_key, item, model_name, counter_arguments_text, input_hash = task
+        topic = item['topic']
+        affirmative_argument = item['affirmative_argument']
 
-            try:
+        try:
+            with trace_tags(item=item_key, model_name=model_name):
                 evaluation_results = evaluate_arguments(
                     eval_client, eval_model, topic, affirmative_argument,
                     counter_arguments_text, selected_criteria, evaluation_prompts,
-                    temperature=args.temperature, max_tokens=args.max_tokens
+                    temperature=args.temperature, max_tokens=args.max_tokens,
+                    max_workers=args.criteria_concurrency, timeout=args.request_timeout,
+                    criteria_mode=args.criteria_mode, layout=args.message_layout,
+                    num_counter_arguments=count_counter_arguments(item['counterarguments'][model_name])
+                )
+            sink.write({"id": item_key, "model": model_name, "input_hash": input_hash, "evaluation_results": evaluation_results})
+            print(f"Evaluation completed for model {model_name} on topic '{topic}'")
+        except Exception as e:
+            error_message = f"An error occurred during evaluation for model {model_name} on topic '{topic}': {e}\n"
+            logging.error(error_message)
+
+    def run_joint_task(task):
+        item_key, item, counter_arguments_text, labels, input_hash = task
+        topic = item['topic']
+
+        try:
+            with trace_tags(item=item_key, model_name="joint"):
+                evaluation_results = evaluate_item_jointly(
+                    eval_client, eval_model, item, counter_arguments_text, labels,
+                    selected_criteria, joint_prompts,
+                    temperature=args.temperature, max_tokens=args.max_tokens,
+                    max_workers=args.criteria_concurrency, timeout=args.request_timeout,
+                    criteria_mode=args.criteria_mode, layout=args.message_layout
                 )
-                item['evaluation_results'][model_name] = evaluation_results
-                print(f"Evaluation completed for model {model_name} on topic '{topic}'")
-            except Exception as e:
-                error_message = f"An error occurred during evaluation for model {model_name} on topic '{topic}': {e}\n"
-                logging.error(error_message)
-
-    # 結果を出力
-    with open(args.output, 'w', encoding='utf-8') as f:
-        json.dump(generated_data, f, ensure_ascii=False, indent=2)
+            for model_name, model_results in evaluation_results.items():
+                sink.write({"id": item_key, "model": model_name, "input_hash": input_hash, "evaluation_results": model_results})
+            print(f"Joint evaluation completed for models {', '.join(evaluation_results)} on topic '{topic}'")
+        except Exception as e:
+            error_message = f"An error occurred during joint evaluation on topic '{topic}': {e}\n"
+            logging.error(error_message)
+
+    # (item, model) の単位（joint では項目の単位）で並列に評価する
+    with JsonlSink(checkpoint_path, resume=args.resume) as sink:
+        if args.model_mode == "joint":
+            tasks = ordered_map(run_joint_task, iter_joint_tasks(), args.concurrency)
+        else:
+            tasks = ordered_map(run_task, iter_tasks(), args.concurrency)
+        for _ in tasks:
+            pass
+
+    if args.incremental:
+        logging.info(f"Incremental evaluation reused {reused} unchanged results from {args.previous or args.output}")
+    log_cache_stats()
+    log_truncation_stats()
+    finish_tracing(args)
+
+    # チェックポイントの評価結果を入力データに書き戻して出力する
+    write_items(args.output, compact_checkpoint(checkpoint_path, args.input, is_selected))
     print(f"Evaluation results saved to {args.output}")
 
 if __name__ == "__main__":
@@ -24,6 +24,42 @@ INPUT_FILE="/home/del_taiseiozaki/multi_steps_counter-argument-generation/ss_gen
 # 出力ファイルのパス
 OUTPUT_FILE="2evaluation_results.json"
 
+# 評価指標の評価方法（separate: 指標ごとに1リクエスト, combined: 全指標を1リクエスト）
+CRITERIA_MODE="separate"
+
+# 並列に評価する (item, model) の数
+CONCURRENCY=4
+
+# 分析後に並列に実行する評価指標の数
+CRITERIA_CONCURRENCY=8
+
+# 1リクエストあたりのタイムアウト（秒）
+REQUEST_TIMEOUT=120
+
+# 1分あたりのリクエスト数・トークン数の上限（provider[/model]=rpm,tpm）
+RATE_LIMITS="openai=500,200000 groq=30,6000"
+
+# 応答キャッシュの設定（--cache または --no-cache）
+CACHE_FLAG="--cache"
+
+# モデルごとの評価の仕方（separate: モデルごとに分析・評価する / joint: 全モデルの反論を並べ替えてまとめて1回の分析で評価する）
+MODEL_MODE="separate"
+
+# メッセージの並べ方（inline: 従来どおり / prefix: 固定の指示を先に置きプロバイダのプロンプトキャッシュを効かせる）
+MESSAGE_LAYOUT="inline"
+
+# 各ステップの max_tokens の決め方（fixed: 全ステップで MAX_TOKENS / adaptive: プロンプトのトークン数から決める）
+TOKEN_BUDGET="adaptive"
+
+# max_tokens で切り詰められた応答の続きを要求する回数の上限
+MAX_CONTINUATIONS=1
+
+# 応答をストリーミングで受け取り、最初のトークンまでの時間と出力速度を計測する場合は "--stream"
+STREAM_FLAG=""
+
+# 入力が変わった評価だけをやり直す場合は "--incremental"（前回の OUTPUT_FILE の結果を引き継ぐ）
+INCREMENTAL_FLAG=""
+
 # ===============================
 # スクリプトの実行
 # ===============================
@@ -35,4 +71,16 @@ python3 evaluate/evaluate.py \
   --evaluation-model "$EVALUATION_MODEL" \
   --criteria-ids $CRITERIA_IDS \
   --temperature "$TEMPERATURE" \
-  --max-tokens "$MAX_TOKENS"
\ No newline at end of file
+  --max-tokens "$MAX_TOKENS" \
+  --concurrency "$CONCURRENCY" \
+  --criteria-mode "$CRITERIA_MODE" \
+  --criteria-concurrency "$CRITERIA_CONCURRENCY" \
+  --request-timeout "$REQUEST_TIMEOUT" \
+  --rate-limits $RATE_LIMITS \
+  $CACHE_FLAG \
+  --model-mode "$MODEL_MODE" \
+  --message-layout "$MESSAGE_LAYOUT" \
+  --token-budget "$TOKEN_BUDGET" \
+  --max-continuations "$MAX_CONTINUATIONS" \
+  $STREAM_FLAG \
+  $INCREMENTAL_FLAG
\ No newline at end of file
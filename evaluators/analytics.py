@@ -0,0 +1,304 @@
+import ast
+import json
+import logging
+import os
+import re
+import warnings
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from evaluators.argument_evaluator import extract_counterargument
+from utils.file_handlers import iter_items
+
+SELECTION = "selection"
+RANKING = "ranking"
+
+# キャッシュの形式を変えたときに古い .npz を読み込まないようにするための版数
+CACHE_VERSION = 1
+
+def criterion_kind(name: str) -> Optional[str]:
+    if name.startswith("(Multiple Choice)"):
+        return SELECTION
+    if name.startswith("(Ranking)"):
+        return RANKING
+    return None
+
+def parse_result_numbers(result) -> Optional[list]:
+    """評価結果（リストまたは '[1, 3, 2]' を含む文字列）を反論番号のリストに変換します。解析できなければ None を返します。"""
+    if isinstance(result, list):
+        return result
+    if not isinstance(result, str):
+        return None
+    match = re.search(r"\[.*\]", result, re.DOTALL)
+    if match is None:
+        return None
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            numbers = parse(match.group(0))
+        except (ValueError, SyntaxError):
+            continue
+        if isinstance(numbers, list):
+            return numbers
+    return None
+
+def ranking_positions(numbers: list) -> Dict[int, float]:
+    """ランキング（同順位はリストでまとめる）を反論番号ごとの順位に変換します。同順位は平均順位にします。"""
+    positions = {}
+    next_position = 1
+    for entry in numbers:
+        group = entry if isinstance(entry, list) else [entry]
+        group = [number for number in group if isinstance(number, int) and not isinstance(number, bool) and number not in positions]
+        for number in group:
+            positions[number] = next_position + (len(group) - 1) / 2
+        next_position += len(group)
+    return positions
+
+class ResultsArray:
+    """評価結果を (item × model × condition × criterion) の配列にまとめたものです。
+
+    values は選択型の指標では選ばれたら 1・選ばれなければ 0、ランキング型の指標では順位（1が最良）で、
+    評価されていない組み合わせは NaN です。
+    """
+
+    def __init__(self, values: np.ndarray, item_ids: list, models: list, conditions: list, criterion_ids: list, criterion_names: list, criterion_kinds: list):
+        self.values = values
+        self.item_ids = item_ids
+        self.models = models
+        self.conditions = conditions
+        self.criterion_ids = criterion_ids
+        self.criterion_names = criterion_names
+        self.criterion_kinds = criterion_kinds
+
+    @property
+    def selection_mask(self) -> np.ndarray:
+        return np.array([kind == SELECTION for kind in self.criterion_kinds], dtype=bool)
+
+    @property
+    def ranking_mask(self) -> np.ndarray:
+        return np.array([kind == RANKING for kind in self.criterion_kinds], dtype=bool)
+
+    def save(self, file_path: str, source_signature: list) -> None:
+        np.savez_compressed(
+            file_path,
+            values=self.values,
+            item_ids=np.array([json.dumps(item_id) for item_id in self.item_ids]),
+            models=np.array(self.models, dtype=str),
+            conditions=np.array(self.conditions, dtype=str),
+            criterion_ids=np.array(self.criterion_ids, dtype=np.int64),
+            criterion_names=np.array(self.criterion_names, dtype=str),
+            criterion_kinds=np.array(self.criterion_kinds, dtype=str),
+            source_signature=np.array(source_signature, dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, file_path: str, source_signature: list) -> Optional["ResultsArray"]:
+        """キャッシュが元のファイルと一致すれば読み込みます。一致しなければ None を返します。"""
+        if not os.path.exists(file_path):
+            return None
+        with np.load(file_path) as data:
+            if data["source_signature"].tolist() != list(source_signature):
+                return None
+            return cls(
+                data["values"],
+                [json.loads(item_id) for item_id in data["item_ids"].tolist()],
+                data["models"].tolist(),
+                data["conditions"].tolist(),
+                data["criterion_ids"].tolist(),
+                data["criterion_names"].tolist(),
+                data["criterion_kinds"].tolist(),
+            )
+
+def build_results_array(items) -> ResultsArray:
+    """evaluate.py の出力項目を読み込み、選択・ランキングの結果を配列にまとめます。"""
+    records = []
+    models, conditions, criteria = {}, {}, {}
+    for index, item in enumerate(items):
+        item_key = item.get('id', index)
+        for model_name, evaluation_results in item.get('evaluation_results', {}).items():
+            # 反論の番号は counterarguments の条件の並び順に対応する（build_counter_arguments_text を参照）
+            model_counterarguments = item['counterarguments'].get(model_name, {})
+            labels = list(model_counterarguments)
+            evaluated = {number for number, condition in enumerate(labels, start=1) if extract_counterargument(model_counterarguments[condition])}
+            models.setdefault(model_name, len(models))
+            for condition in labels:
+                conditions.setdefault(condition, None)
+            for result in evaluation_results:
+                kind = criterion_kind(result['name'])
+                if kind is None:
+                    continue
+                criteria.setdefault(result['id'], (result['name'], kind))
+                # まとめて評価した結果をモデルごとに戻せなかった評価指標（evaluators.joint.split_joint_results）は数えない
+                if result.get('invalid'):
+                    continue
+                numbers = parse_result_numbers(result['result'])
+                if numbers is None:
+                    logging.warning(f"Could not parse result of criterion {result['id']} for model {model_name} on item {item_key}: {result['result']!r}")
+                    continue
+                records.append((item_key, model_name, labels, evaluated, result['id'], kind, numbers))
+
+    item_ids = list(dict.fromkeys(record[0] for record in records))
+    item_index = {item_id: index for index, item_id in enumerate(item_ids)}
+    condition_list = sorted(conditions)
+    condition_index = {condition: index for index, condition in enumerate(condition_list)}
+    criterion_ids = sorted(criteria)
+    criterion_index = {criterion_id: index for index, criterion_id in enumerate(criterion_ids)}
+
+    values = np.full((len(item_ids), len(models), len(condition_list), len(criterion_ids)), np.nan)
+    for item_key, model_name, labels, evaluated, criterion_id, kind, numbers in records:
+        i, m, k = item_index[item_key], models[model_name], criterion_index[criterion_id]
+        if kind == SELECTION:
+            selected = {number for number in numbers if isinstance(number, int)}
+            for number in evaluated:
+                values[i, m, condition_index[labels[number - 1]], k] = 1.0 if number in selected else 0.0
+        else:
+            for number, position in ranking_positions(numbers).items():
+                if number in evaluated:
+                    values[i, m, condition_index[labels[number - 1]], k] = position
+
+    return ResultsArray(
+        values, item_ids, list(models), condition_list, criterion_ids,
+        [criteria[criterion_id][0] for criterion_id in criterion_ids],
+        [criteria[criterion_id][1] for criterion_id in criterion_ids],
+    )
+
+def file_signature(file_path: str) -> list:
+    stat = os.stat(file_path)
+    return [CACHE_VERSION, stat.st_size, stat.st_mtime_ns]
+
+def load_results_array(file_path: str, cache_path: Optional[str] = None) -> ResultsArray:
+    """評価結果ファイルを配列に変換します。cache_path を指定すると解析済みの配列を .npz で再利用します。"""
+    signature = file_signature(file_path)
+    if cache_path:
+        cached = ResultsArray.load(cache_path, signature)
+        if cached is not None:
+            logging.info(f"Loaded parsed results from {cache_path}")
+            return cached
+    results = build_results_array(iter_items(file_path))
+    if cache_path:
+        results.save(cache_path, signature)
+        logging.info(f"Parsed results cached to {cache_path}")
+    return results
+
+@contextmanager
+def _ignore_empty_slices():
+    """全て NaN の軸に対する nanmean などの警告を抑制します。"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        yield
+
+def pairwise_win_fraction(ranks: np.ndarray) -> np.ndarray:
+    """順位の配列（最後の軸が条件）から、各条件が同じ評価内の他の条件に勝った割合を求めます。同順位は 0.5 勝とします。"""
+    diff = ranks[..., :, None] - ranks[..., None, :]
+    valid = ~np.isnan(diff)
+    with np.errstate(invalid="ignore"):
+        wins = np.where(valid, (diff < 0) + 0.5 * (diff == 0), 0.0).sum(axis=-1)
+    ranked = ~np.isnan(ranks)
+    # 自分自身との比較（差が 0 で 0.5 勝）を除く
+    wins -= 0.5 * ranked
+    opponents = valid.sum(axis=-1) - ranked
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(ranked & (opponents > 0), wins / np.maximum(opponents, 1), np.nan)
+
+def per_item_scores(results: ResultsArray) -> np.ndarray:
+    """item ごとの勝率の元になる値を返します。選択型は選ばれたかどうか、ランキング型は一対比較の勝率です。"""
+    scores = results.values.copy()
+    ranking = results.ranking_mask
+    if ranking.any():
+        # (item, model, criterion, condition) の順にして条件の軸で比較する
+        ranks = np.moveaxis(results.values[..., ranking], 2, -1)
+        scores[..., ranking] = np.moveaxis(pairwise_win_fraction(ranks), -1, 2)
+    return scores
+
+def win_rates(results: ResultsArray) -> np.ndarray:
+    """(model, condition, criterion) ごとの勝率（選択型は選択率）を返します。"""
+    with np.errstate(invalid="ignore"), _ignore_empty_slices():
+        return np.nanmean(per_item_scores(results), axis=0)
+
+def mean_ranks(results: ResultsArray) -> np.ndarray:
+    """(model, condition, criterion) ごとの平均順位を返します。選択型の指標は NaN です。"""
+    ranks = np.where(results.ranking_mask, results.values, np.nan)
+    with _ignore_empty_slices():
+        return np.nanmean(ranks, axis=0)
+
+def borda_scores(results: ResultsArray) -> np.ndarray:
+    """(model, condition, criterion) ごとのボルダ得点（順位付けされた数 - 順位 の合計）を返します。"""
+    ranks = np.where(results.ranking_mask, results.values, np.nan)
+    ranked_count = (~np.isnan(ranks)).sum(axis=2, keepdims=True)
+    points = ranked_count - ranks
+    totals = np.nansum(points, axis=0)
+    return np.where(results.ranking_mask & (~np.isnan(ranks)).any(axis=0), totals, np.nan)
+
+def kendall_tau_matrix(results: ResultsArray) -> np.ndarray:
+    """ランキング型の指標どうしの一致度（item・model ごとの Kendall の tau-b の平均）を (criterion × criterion) で返します。"""
+    ranking = np.flatnonzero(results.ranking_mask)
+    matrix = np.full((len(results.criterion_ids), len(results.criterion_ids)), np.nan)
+    if len(ranking) == 0:
+        return matrix
+    # (item, model, criterion, condition, condition) の順位差の符号。比較できない組は 0
+    ranks = np.moveaxis(results.values[..., ranking], 2, -1)
+    signs = np.nan_to_num(np.sign(ranks[..., :, None] - ranks[..., None, :]))
+    concordance = np.einsum("imacd,imbcd->imab", signs, signs)
+    norms = np.einsum("imacd,imacd->ima", signs, signs)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tau = concordance / np.sqrt(norms[..., :, None] * norms[..., None, :])
+    tau[~np.isfinite(tau)] = np.nan
+    with _ignore_empty_slices():
+        matrix[np.ix_(ranking, ranking)] = np.nanmean(tau, axis=(0, 1))
+    return matrix
+
+def bootstrap_win_rate_intervals(results: ResultsArray, samples: int = 1000, confidence: float = 0.95, seed: int = 0):
+    """item を復元抽出したブートストラップで勝率の信頼区間を求め、(下限, 上限) を返します。
+
+    各反復の item の出現回数を重みとする行列積で、全反復をまとめて計算します。
+    """
+    scores = per_item_scores(results)
+    num_items = scores.shape[0]
+    flat = scores.reshape(num_items, -1)
+    observed = ~np.isnan(flat)
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(num_items, np.full(num_items, 1 / num_items), size=samples).astype(float)
+    totals = weights @ np.where(observed, flat, 0.0)
+    counts = weights @ observed.astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, totals / np.maximum(counts, 1), np.nan)
+    alpha = (1 - confidence) / 2
+    with _ignore_empty_slices():
+        lower, upper = np.nanquantile(means, [alpha, 1 - alpha], axis=0)
+    shape = scores.shape[1:]
+    return lower.reshape(shape), upper.reshape(shape)
+
+def summarize(results: ResultsArray, samples: int = 1000, confidence: float = 0.95, seed: int = 0) -> List[Dict]:
+    """(model, condition, criterion) ごとの指標を行のリストにまとめます。"""
+    rates = win_rates(results)
+    ranks = mean_ranks(results)
+    borda = borda_scores(results)
+    if samples:
+        lower, upper = bootstrap_win_rate_intervals(results, samples, confidence, seed)
+    else:
+        lower = upper = np.full_like(rates, np.nan)
+    evaluated = (~np.isnan(results.values)).sum(axis=0)
+
+    rows = []
+    for m, model_name in enumerate(results.models):
+        for c, condition in enumerate(results.conditions):
+            for k, criterion_id in enumerate(results.criterion_ids):
+                if evaluated[m, c, k] == 0:
+                    continue
+                rows.append({
+                    "model": model_name,
+                    "condition": condition,
+                    "criterion_id": criterion_id,
+                    "criterion": results.criterion_names[k],
+                    "kind": results.criterion_kinds[k],
+                    "items": int(evaluated[m, c, k]),
+                    "win_rate": _to_float(rates[m, c, k]),
+                    "win_rate_ci": [_to_float(lower[m, c, k]), _to_float(upper[m, c, k])],
+                    "mean_rank": _to_float(ranks[m, c, k]),
+                    "borda": _to_float(borda[m, c, k]),
+                })
+    return rows
+
+def _to_float(value) -> Optional[float]:
+    return None if np.isnan(value) else float(value)
@@ -1,104 +1,371 @@
+import hashlib
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-from models.ai_models import get_ai_client
+from models.ai_models import complete_with_continuation, get_ai_client
 from utils.file_handlers import load_evaluation_prompts
+from utils.prompt_templates import compile_format_template, split_format_template, validate_format_templates
+from utils.token_budget import count_tokens, get_token_budget
+from utils.tracing import propagate, trace_tags
+
+# evaluate_prompt.json の各テンプレートで使える {name}
+EVALUATION_TEMPLATE_FIELDS = {
+    'system_prompt_template': ['topic', 'affirmative_argument', 'counter_arguments'],
+    'selection_user_prompt_template': ['selection_criteria', 'criteria_description'],
+    'ranking_user_prompt_template': ['ranking_criteria', 'criteria_description'],
+    'multi_criteria_user_prompt_template': ['criteria_list'],
+}
+
+# --token-budget adaptive での各ステップの max_tokens の規則（基本値, 基準のトークン数に対する比, 最大値）。
+# 分析は反論のトークン数に、一括評価は評価指標の数に比例させる。最大値が None の規則は --max-tokens を上限にする。
+# 選択・ランキングは反論番号のリストだけを返すため短い
+EVALUATION_TOKEN_BUDGETS = {
+    "analysis": (256, 1.0, None),
+    "selection": (64, 0.0, 128),
+    "ranking": (64, 0.0, 128),
+    "multi_criteria": (64, 48.0, None),
+}
+
+def plan_evaluation_max_tokens(step, reference_tokens, messages, model, max_tokens):
+    """評価のステップの max_tokens を決めます。--token-budget fixed の場合は max_tokens をそのまま返します。"""
+    budget = get_token_budget()
+    if budget.mode == "fixed":
+        return max_tokens
+    return budget.plan(EVALUATION_TOKEN_BUDGETS[step], reference_tokens, messages, model, max_tokens)
+
+def validate_evaluation_prompts(prompts: dict) -> None:
+    """評価プロンプトのテンプレートを検証し、変換しておきます。一括評価用のテンプレートは省略できます。"""
+    if not isinstance(prompts.get('analysis_user_prompt'), str):
+        raise ValueError("Missing prompt 'analysis_user_prompt'")
+    validate_format_templates(prompts, EVALUATION_TEMPLATE_FIELDS, optional=['multi_criteria_user_prompt_template'])
+
+def build_analysis_messages(topic, affirmative_argument, counter_arguments, prompts, layout="inline"):
+    """ディベート分析のメッセージを組み立てます。
+
+    layout が "prefix" の場合、システムプロンプトには固定の指示だけを置き、トピック・主張・反論は分析の依頼の後ろに置きます。
+    """
+    if layout == "prefix":
+        system_prompt, item_template = split_format_template(prompts['system_prompt_template'])
+        item_prompt = compile_format_template(item_template).render(
+            topic=topic,
+            affirmative_argument=affirmative_argument,
+            counter_arguments=counter_arguments
+        )
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{prompts['analysis_user_prompt']}\n\n{item_prompt}"}
+        ]
+    if layout != "inline":
+        raise ValueError(f"Invalid message layout: {layout}")
 
-def analyze_debate(client, model, topic, affirmative_argument, counter_arguments, prompts, temperature=0, max_tokens=1000):
-    """ディベートを分析します。"""
     system_prompt_template = prompts['system_prompt_template']
     analysis_user_prompt = prompts['analysis_user_prompt']
 
-    system_prompt = system_prompt_template.format(
+    system_prompt = compile_format_template(system_prompt_template).render(
         topic=topic,
         affirmative_argument=affirmative_argument,
         counter_arguments=counter_arguments
     )
 
-    messages = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": analysis_user_prompt}
     ]
 
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
-    return response.choices[0].message.content
-
-def evaluate_selection(client, model, topic, affirmative_argument, counter_arguments, selection_criteria, criteria_description, analysis, prompts, temperature=0, max_tokens=1000):
-    """選択式の評価を行います。"""
+def build_selection_messages(selection_criteria, criteria_description, analysis, prompts, history=()):
+    """選択式の評価のメッセージを組み立てます。history は分析の前の会話履歴です（prefix レイアウトの場合）。"""
     selection_user_prompt_template = prompts['selection_user_prompt_template']
 
-    selection_prompt = selection_user_prompt_template.format(
+    selection_prompt = compile_format_template(selection_user_prompt_template).render(
         selection_criteria=selection_criteria,
         criteria_description=criteria_description
     )
 
-    messages = [
+    return [
+        *history,
         {"role": "assistant", "content": analysis},
         {"role": "user", "content": selection_prompt}
     ]
 
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
-    return response.choices[0].message.content
-
-def evaluate_ranking(client, model, topic, affirmative_argument, counter_arguments, ranking_criteria, criteria_description, analysis, prompts, temperature=0, max_tokens=1000):
-    """ランキング式の評価を行います。"""
+def build_ranking_messages(ranking_criteria, criteria_description, analysis, prompts, history=()):
+    """ランキング式の評価のメッセージを組み立てます。history は分析の前の会話履歴です（prefix レイアウトの場合）。"""
     ranking_user_prompt_template = prompts['ranking_user_prompt_template']
 
-    ranking_prompt = ranking_user_prompt_template.format(
+    ranking_prompt = compile_format_template(ranking_user_prompt_template).render(
         ranking_criteria=ranking_criteria,
         criteria_description=criteria_description
     )
 
-    messages = [
+    return [
+        *history,
         {"role": "assistant", "content": analysis},
         {"role": "user", "content": ranking_prompt}
     ]
 
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
-    return response.choices[0].message.content
+def build_criterion_messages(criterion, analysis, prompts, history=()):
+    """評価指標の種類に応じたメッセージを組み立てます。未知の種類の場合は None を返します。"""
+    if criterion['name'].startswith("(Multiple Choice)"):
+        return build_selection_messages(criterion['name'], criterion['description'], analysis, prompts, history)
+    if criterion['name'].startswith("(Ranking)"):
+        return build_ranking_messages(criterion['name'], criterion['description'], analysis, prompts, history)
+    return None
 
-def evaluate_arguments(client, model, topic, affirmative_argument, counter_arguments, evaluation_criteria, prompts, temperature=0, max_tokens=1000):
-    """指定された評価指標のみを使用して評価を行います。"""
-    analysis = analyze_debate(client, model, topic, affirmative_argument, counter_arguments, prompts, temperature, max_tokens)
-    results = []
+def criterion_step(criterion):
+    """評価指標の種類に対応するステップ名（selection または ranking）を返します。未知の種類の場合は None を返します。"""
+    if criterion['name'].startswith("(Multiple Choice)"):
+        return "selection"
+    if criterion['name'].startswith("(Ranking)"):
+        return "ranking"
+    return None
+
+def analyze_debate(client, model, topic, affirmative_argument, counter_arguments, prompts, temperature=0, max_tokens=1000, timeout=None, layout="inline"):
+    """ディベートを分析します。"""
+    messages = build_analysis_messages(topic, affirmative_argument, counter_arguments, prompts, layout)
+    max_tokens = plan_evaluation_max_tokens("analysis", count_tokens(counter_arguments, model), messages, model, max_tokens)
+
+    with trace_tags(step="analysis"):
+        response = complete_with_continuation(client, messages, model, temperature, max_tokens, timeout=timeout)
+    return response["content"]
+
+def evaluate_selection(client, model, topic, affirmative_argument, counter_arguments, selection_criteria, criteria_description, analysis, prompts, temperature=0, max_tokens=1000, timeout=None, history=()):
+    """選択式の評価を行います。"""
+    messages = build_selection_messages(selection_criteria, criteria_description, analysis, prompts, history)
+    max_tokens = plan_evaluation_max_tokens("selection", 0, messages, model, max_tokens)
+
+    with trace_tags(step="selection"):
+        # --stream の場合はリストが閉じた時点で受信を打ち切る
+        response = complete_with_continuation(client, messages, model, temperature, max_tokens, timeout=timeout, stop_rule="number_list")
+    return response["content"]
+
+def evaluate_ranking(client, model, topic, affirmative_argument, counter_arguments, ranking_criteria, criteria_description, analysis, prompts, temperature=0, max_tokens=1000, timeout=None, history=()):
+    """ランキング式の評価を行います。"""
+    messages = build_ranking_messages(ranking_criteria, criteria_description, analysis, prompts, history)
+    max_tokens = plan_evaluation_max_tokens("ranking", 0, messages, model, max_tokens)
 
-    for item in evaluation_criteria:
-        id = item['id']
-        name = item['name']
-        description = item['description']
+    with trace_tags(step="ranking"):
+        # --stream の場合はリストが閉じた時点で受信を打ち切る
+        response = complete_with_continuation(client, messages, model, temperature, max_tokens, timeout=timeout, stop_rule="number_list")
+    return response["content"]
 
-        result = {"id": id, "name": name}
+def evaluate_criterion(client, model, topic, affirmative_argument, counter_arguments, criterion, analysis, prompts, temperature=0, max_tokens=1000, timeout=None, history=()):
+    """1つの評価指標について評価を行います。"""
+    id = criterion['id']
+    name = criterion['name']
+    description = criterion['description']
 
+    result = {"id": id, "name": name}
+
+    with trace_tags(criterion=id):
         if name.startswith("(Multiple Choice)"):
             selection_criteria = name
             criteria_description = description
-            selection_results = evaluate_selection(client, model, topic, affirmative_argument, counter_arguments, selection_criteria, criteria_description, analysis, prompts, temperature, max_tokens)
+            selection_results = evaluate_selection(client, model, topic, affirmative_argument, counter_arguments, selection_criteria, criteria_description, analysis, prompts, temperature, max_tokens, timeout, history)
             logging.info(f"Selection results for item {id}: {selection_results}")
             result["result"] = selection_results
         elif name.startswith("(Ranking)"):
             ranking_criteria = name
             criteria_description = description
-            ranking_results = evaluate_ranking(client, model, topic, affirmative_argument, counter_arguments, ranking_criteria, criteria_description, analysis, prompts, temperature, max_tokens)
+            ranking_results = evaluate_ranking(client, model, topic, affirmative_argument, counter_arguments, ranking_criteria, criteria_description, analysis, prompts, temperature, max_tokens, timeout, history)
             logging.info(f"Ranking results for item {id}: {ranking_results}")
             result["result"] = ranking_results
         else:
             logging.warning(f"Unknown evaluation type for item {id}: {name}")
             result["result"] = []
 
-        results.append(result)
+    return result
+
+MULTI_CRITERIA_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "multi_criteria_evaluation",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "result": {
+                                "type": "array",
+                                "items": {
+                                    "anyOf": [
+                                        {"type": "integer"},
+                                        {"type": "array", "items": {"type": "integer"}}
+                                    ]
+                                }
+                            }
+                        },
+                        "required": ["id", "result"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def count_counter_arguments(model_counterarguments: dict) -> int:
+    """build_counter_arguments_text で評価対象として番号付けされる反論の最大番号を返します。
+
+    反論の本文に番号付きの行が含まれていても数えないよう、テキストではなく生成結果の条件から数えます。
+    """
+    numbers = [idx for idx, counter_arg in enumerate(model_counterarguments.values(), start=1) if extract_counterargument(counter_arg)]
+    return max(numbers) if numbers else 0
+
+def validate_criterion_result(criterion, result, num_counter_arguments):
+    """選択・ランキングの結果が反論番号のリストとして正しいか検証します。ランキングは全ての反論を1回ずつ含む必要があります。"""
+    if not isinstance(result, list):
+        raise ValueError(f"Result for criterion {criterion['id']} is not a list: {result!r}")
+
+    numbers = []
+    for entry in result:
+        if criterion['name'].startswith("(Ranking)") and isinstance(entry, list):
+            numbers.extend(entry)
+        else:
+            numbers.append(entry)
+
+    for number in numbers:
+        if not isinstance(number, int) or isinstance(number, bool) or not 1 <= number <= num_counter_arguments:
+            raise ValueError(f"Invalid counter-argument number for criterion {criterion['id']}: {number!r}")
+    if len(numbers) != len(set(numbers)):
+        raise ValueError(f"Duplicate counter-argument numbers for criterion {criterion['id']}: {result!r}")
+    # 抜けた反論があると平均順位やボルダ得点から黙って除かれるため、不完全なランキングは受け付けない
+    if criterion['name'].startswith("(Ranking)") and set(numbers) != set(range(1, num_counter_arguments + 1)):
+        raise ValueError(f"Ranking for criterion {criterion['id']} does not rank all {num_counter_arguments} counter-arguments: {result!r}")
+
+def parse_multi_criteria_response(response, evaluation_criteria, num_counter_arguments):
+    """複数指標の一括評価の応答を評価指標ごとの結果に変換します。"""
+    data = json.loads(response)
+    entries = {entry['id']: entry['result'] for entry in data['results']}
+
+    results = []
+    for criterion in evaluation_criteria:
+        if criterion['id'] not in entries:
+            raise ValueError(f"Missing result for criterion {criterion['id']}")
+        result = entries[criterion['id']]
+        validate_criterion_result(criterion, result, num_counter_arguments)
+        results.append({"id": criterion['id'], "name": criterion['name'], "result": result})
+    return results
+
+def evaluate_all_criteria(client, model, topic, affirmative_argument, counter_arguments, num_counter_arguments, evaluation_criteria, analysis, prompts, temperature=0, max_tokens=1000, timeout=None, history=()):
+    """すべての評価指標を1回のリクエストで評価し、構造化された結果を返します。反論番号は 1 から num_counter_arguments までを有効とします。"""
+    multi_criteria_user_prompt_template = prompts['multi_criteria_user_prompt_template']
+
+    criteria_list = "\n".join(
+        f"{criterion['id']}. {criterion['name']}\nDescription: {criterion['description']}"
+        for criterion in evaluation_criteria
+    )
+    multi_criteria_prompt = compile_format_template(multi_criteria_user_prompt_template).render(criteria_list=criteria_list)
+
+    messages = [
+        *history,
+        {"role": "assistant", "content": analysis},
+        {"role": "user", "content": multi_criteria_prompt}
+    ]
+
+    max_tokens = plan_evaluation_max_tokens("multi_criteria", len(evaluation_criteria), messages, model, max_tokens)
+
+    with trace_tags(step="multi_criteria"):
+        response = complete_with_continuation(client, messages, model, temperature, max_tokens, timeout=timeout, response_format=MULTI_CRITERIA_RESPONSE_FORMAT)
+    results = parse_multi_criteria_response(response["content"], evaluation_criteria, num_counter_arguments)
+    logging.info(f"Combined results for criteria {[criterion['id'] for criterion in evaluation_criteria]}: {results}")
+    return results
+
+def evaluate_arguments(client, model, topic, affirmative_argument, counter_arguments, evaluation_criteria, prompts, temperature=0, max_tokens=1000, max_workers=1, timeout=None, criteria_mode="separate", layout="inline", num_counter_arguments=None):
+    """指定された評価指標のみを使用して評価を行います。
+
+    criteria_mode が "combined" の場合はすべての評価指標を1回のリクエストで評価し、
+    応答を解析できなかった場合は評価指標ごとの呼び出しに切り替えます。応答の検証に反論の数 num_counter_arguments が必要です。
+    max_workers が2以上の場合、分析結果を共有する各評価指標の呼び出しを並列に実行します。
+    結果は評価指標の順序で返します。
+    layout が "prefix" の場合、各評価指標の呼び出しは分析と同じ会話履歴から始め、アイテムごとに共通の接頭辞にします。
+    """
+    if criteria_mode == "combined" and num_counter_arguments is None:
+        raise ValueError("num_counter_arguments is required for the combined criteria mode")
+    analysis = analyze_debate(client, model, topic, affirmative_argument, counter_arguments, prompts, temperature, max_tokens, timeout, layout)
+    history = build_analysis_messages(topic, affirmative_argument, counter_arguments, prompts, layout) if layout == "prefix" else []
+
+    if criteria_mode == "combined":
+        known_criteria = [criterion for criterion in evaluation_criteria if criterion['name'].startswith(("(Multiple Choice)", "(Ranking)"))]
+        try:
+            combined_results = {result['id']: result for result in evaluate_all_criteria(client, model, topic, affirmative_argument, counter_arguments, num_counter_arguments, known_criteria, analysis, prompts, temperature, max_tokens, timeout, history)}
+            return [combined_results.get(criterion['id'], {"id": criterion['id'], "name": criterion['name'], "result": []}) for criterion in evaluation_criteria]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Falling back to per-criterion evaluation: could not parse combined response ({e})")
+    elif criteria_mode != "separate":
+        raise ValueError(f"Invalid criteria mode: {criteria_mode}")
+
+    def run(criterion):
+        return evaluate_criterion(client, model, topic, affirmative_argument, counter_arguments, criterion, analysis, prompts, temperature, max_tokens, timeout, history)
+
+    if max_workers <= 1 or len(evaluation_criteria) <= 1:
+        return [run(criterion) for criterion in evaluation_criteria]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(evaluation_criteria))) as executor:
+        return list(executor.map(propagate(run), evaluation_criteria))
+
+def extract_counterargument(counter_arg):
+    for step in counter_arg['steps']:
+        if step['step'] == 'counterargument_generation':
+            return step['output']
+    return None
+
+def build_counter_arguments_text(model_counterarguments: dict, model_name: str, topic: str):
+    """各条件の反論を番号付きのテキストにまとめます。評価できる反論がない場合は None を返します。"""
+    counter_arguments_text = ""
+    for idx, (key, counter_arg) in enumerate(model_counterarguments.items(), start=1):
+        counterargument = extract_counterargument(counter_arg)
+        if counterargument:
+            counter_arguments_text += f"{idx}. {counterargument}\n"
+        else:
+            logging.warning(f"No counterargument found for {key} in model {model_name} on topic '{topic}'")
+
+    if counter_arguments_text.strip() == "":
+        logging.warning(f"No valid counterarguments to evaluate for model {model_name} on topic '{topic}'")
+        return None
+    return counter_arguments_text
+
+def used_evaluation_templates(prompts: dict, criteria: List[Dict], criteria_mode: str = "separate") -> dict:
+    """評価で実際に使うテンプレートだけを返します。使わないテンプレートを編集しても入力ハッシュは変わりません。"""
+    keys = ['system_prompt_template', 'analysis_user_prompt']
+    steps = {criterion_step(criterion) for criterion in criteria}
+    if "selection" in steps:
+        keys.append('selection_user_prompt_template')
+    if "ranking" in steps:
+        keys.append('ranking_user_prompt_template')
+    if criteria_mode == "combined":
+        keys.append('multi_criteria_user_prompt_template')
+    return {key: prompts.get(key) for key in keys}
+
+def evaluation_input_hash(topic: str, affirmative_argument: str, counter_arguments: str, criteria: List[Dict], evaluation_model: str, prompts: dict, layout: str = "inline", criteria_mode: str = "separate", temperature: float = 0, max_tokens: int = 1000) -> str:
+    """評価結果を左右する入力のハッシュを返します。
 
-    return results
\ No newline at end of file
+    トピック、主張、反論、評価指標（名前と説明）、評価モデル、実際に使う評価プロンプトとその並べ方、
+    評価の方法（criteria_mode）、temperature、max_tokens と --token-budget の設定（adaptive では EVALUATION_TOKEN_BUDGETS）を含めます。
+    """
+    budget = get_token_budget()
+    payload = {
+        "topic": topic,
+        "affirmative_argument": affirmative_argument,
+        "counter_arguments": counter_arguments,
+        "criteria": [{"id": criterion['id'], "name": criterion['name'], "description": criterion['description']} for criterion in criteria],
+        "evaluation_model": evaluation_model,
+        "templates": used_evaluation_templates(prompts, criteria, criteria_mode),
+        "layout": layout,
+        "criteria_mode": criteria_mode,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "token_budget": {
+            "mode": budget.mode,
+            "max_continuations": budget.max_continuations,
+            "rules": EVALUATION_TOKEN_BUDGETS if budget.mode == "adaptive" else None,
+        },
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
@@ -0,0 +1,99 @@
+import logging
+from typing import Dict, List, Tuple
+
+from evaluators.argument_evaluator import build_analysis_messages, build_criterion_messages, criterion_step, plan_evaluation_max_tokens
+from evaluators.joint import joint_evaluation_prompts, split_joint_results
+from utils.token_budget import count_tokens
+from utils.batch_api import batch_group_key, log_missing_results, make_batch_request, make_custom_id
+
+def init_evaluation_state(groups: List[Dict], evaluation_model: str, evaluation_criteria: List[Dict], temperature: float, max_tokens: int, layout: str = "inline", model_mode: str = "separate") -> Dict:
+    """バッチ評価の状態を作成します。groups は (id, model, topic, affirmative_argument, counter_arguments) の辞書のリストです。
+
+    model_mode が "joint" の場合、各グループは項目の全モデルの反論をまとめたもので、反論番号のラベル（labels）を持ちます。
+    """
+    return {
+        "kind": "evaluation",
+        "evaluation_model": evaluation_model,
+        "criteria": evaluation_criteria,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "layout": layout,
+        "model_mode": model_mode,
+        "groups": [dict(group, analysis=None, results={}, pending={}) for group in groups],
+    }
+
+def is_complete(state: Dict, group: Dict) -> bool:
+    return group["analysis"] is not None and all(str(criterion['id']) in group["results"] for criterion in state["criteria"])
+
+def export_evaluation_stage(state: Dict, prompts: Dict) -> Dict[Tuple[str, str], List[Dict]]:
+    """分析が済んでいなければ分析を、済んでいれば未評価の各評価指標のリクエストを返します。評価は1つのモデルで行うため、バッチ入力ファイルは1つです。"""
+    layout = state.get("layout", "inline")
+    if state.get("model_mode") == "joint":
+        prompts = joint_evaluation_prompts(prompts)
+    requests = []
+    for group in state["groups"]:
+        group["pending"] = {}
+        if group["analysis"] is None:
+            custom_id = make_custom_id(group["id"], group["model"], "analysis")
+            messages = build_analysis_messages(group["topic"], group["affirmative_argument"], group["counter_arguments"], prompts, layout)
+            group["pending"][custom_id] = "analysis"
+            max_tokens = plan_evaluation_max_tokens("analysis", count_tokens(group["counter_arguments"], state["evaluation_model"]), messages, state["evaluation_model"], state["max_tokens"])
+            requests.append(make_batch_request(custom_id, state["evaluation_model"], messages, state["temperature"], max_tokens))
+            continue
+
+        history = build_analysis_messages(group["topic"], group["affirmative_argument"], group["counter_arguments"], prompts, layout) if layout == "prefix" else []
+        for criterion in state["criteria"]:
+            key = str(criterion['id'])
+            if key in group["results"]:
+                continue
+            messages = build_criterion_messages(criterion, group["analysis"], prompts, history)
+            if messages is None:
+                logging.warning(f"Unknown evaluation type for item {criterion['id']}: {criterion['name']}")
+                group["results"][key] = []
+                continue
+            custom_id = make_custom_id(group["id"], group["model"], f"criterion-{criterion['id']}")
+            group["pending"][custom_id] = key
+            max_tokens = plan_evaluation_max_tokens(criterion_step(criterion), 0, messages, state["evaluation_model"], state["max_tokens"])
+            requests.append(make_batch_request(custom_id, state["evaluation_model"], messages, state["temperature"], max_tokens))
+    return {("openai", state["evaluation_model"]): requests}
+
+def import_evaluation_results(state: Dict, results: Dict[str, str]) -> int:
+    imported = 0
+    missing = 0
+    for group in state["groups"]:
+        for custom_id, target in group["pending"].items():
+            if custom_id not in results:
+                missing += 1
+                continue
+            if target == "analysis":
+                group["analysis"] = results[custom_id]
+            else:
+                group["results"][target] = results[custom_id]
+            imported += 1
+        group["pending"] = {}
+    if missing:
+        log_missing_results(state, {batch_group_key("openai", state["evaluation_model"]): missing})
+    return imported
+
+def remaining_groups(state: Dict) -> int:
+    return sum(1 for group in state["groups"] if not is_complete(state, group))
+
+def collect_evaluation_results(state: Dict) -> Dict:
+    """完了したグループの評価結果を (id, model) ごとに evaluate_arguments と同じ形式で返します。
+
+    全モデルをまとめて評価したグループの結果は、モデルごとの結果に戻して返します（戻せなかった評価指標は invalid になります）。
+    """
+    evaluated = {}
+    for group in state["groups"]:
+        if not is_complete(state, group):
+            continue
+        results = [
+            {"id": criterion['id'], "name": criterion['name'], "result": group["results"][str(criterion['id'])]}
+            for criterion in state["criteria"]
+        ]
+        if "labels" not in group:
+            evaluated[(group["id"], group["model"])] = results
+            continue
+        for model_name, model_results in split_joint_results(results, group["labels"], state["criteria"]).items():
+            evaluated[(group["id"], model_name)] = model_results
+    return evaluated
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import random
+from typing import Dict, List, Optional, Tuple
+
+from evaluators.analytics import criterion_kind, parse_result_numbers, RANKING
+from evaluators.argument_evaluator import EVALUATION_TEMPLATE_FIELDS, evaluate_arguments, extract_counterargument, validate_criterion_result
+from utils.prompt_templates import validate_format_templates
+
+MODEL_MODES = ["separate", "joint"]
+
+# --model-mode joint で使うテンプレートのキーの接頭辞。全モデルの反論をまとめて評価するため、反論の数を決め打ちしない
+JOINT_PROMPT_PREFIX = "joint_"
+JOINT_PROMPT_KEYS = ['analysis_user_prompt', *EVALUATION_TEMPLATE_FIELDS]
+
+def joint_evaluation_prompts(prompts: dict) -> dict:
+    """evaluate_prompt.json の joint_ で始まるテンプレートを通常のキーに置き換えたプロンプトを返します。
+
+    joint_ のテンプレートがないキーは使えないよう取り除きます（一括評価のテンプレートがなければ評価指標ごとの評価になります）。
+    """
+    joint_prompts = {key: value for key, value in prompts.items() if key not in JOINT_PROMPT_KEYS and not key.startswith(JOINT_PROMPT_PREFIX)}
+    for key in JOINT_PROMPT_KEYS:
+        if JOINT_PROMPT_PREFIX + key in prompts:
+            joint_prompts[key] = prompts[JOINT_PROMPT_PREFIX + key]
+    return joint_prompts
+
+def validate_joint_evaluation_prompts(prompts: dict) -> None:
+    """joint_ で始まる評価プロンプトのテンプレートを検証し、変換しておきます。一括評価用のテンプレートは省略できます。"""
+    if not isinstance(prompts.get(JOINT_PROMPT_PREFIX + 'analysis_user_prompt'), str):
+        raise ValueError(f"Missing prompt '{JOINT_PROMPT_PREFIX}analysis_user_prompt'")
+    fields = {JOINT_PROMPT_PREFIX + key: allowed for key, allowed in EVALUATION_TEMPLATE_FIELDS.items()}
+    validate_format_templates(prompts, fields, optional=[JOINT_PROMPT_PREFIX + 'multi_criteria_user_prompt_template'])
+
+def build_joint_counter_arguments(item: dict) -> Tuple[Optional[str], List[Tuple[str, int]]]:
+    """全モデルの反論を1つの番号付きテキストにまとめ、(テキスト, ラベル) を返します。
+
+    位置による偏りを避けるため、反論は項目の内容から決まる順序でシャッフルします（同じ入力なら同じ順序になります）。
+    ラベルは番号 - 1 の位置に (モデル名, そのモデルだけを評価した場合の反論番号) を持ちます。評価できる反論がない場合のテキストは None です。
+    """
+    entries = []
+    for model_name, model_counterarguments in item['counterarguments'].items():
+        for number, (key, counter_arg) in enumerate(model_counterarguments.items(), start=1):
+            counterargument = extract_counterargument(counter_arg)
+            if counterargument:
+                entries.append((model_name, number, counterargument))
+            else:
+                logging.warning(f"No counterargument found for {key} in model {model_name} on topic '{item['topic']}'")
+    if not entries:
+        logging.warning(f"No valid counterarguments to evaluate on topic '{item['topic']}'")
+        return None, []
+
+    seed = hashlib.sha256(json.dumps([item['topic'], item['affirmative_argument'], entries], ensure_ascii=False).encode("utf-8")).digest()
+    random.Random(seed).shuffle(entries)
+    counter_arguments_text = "".join(f"{index}. {counterargument}\n" for index, (_, _, counterargument) in enumerate(entries, start=1))
+    return counter_arguments_text, [(model_name, number) for model_name, number, _ in entries]
+
+def split_joint_results(results: List[Dict], labels: List[Tuple[str, int]], criteria: List[Dict]) -> Dict[str, List[Dict]]:
+    """まとめて評価した結果を、モデルごとの反論番号での結果に戻します。
+
+    選択は各モデルの選ばれた反論番号の昇順のリスト、ランキングは全体の順位をそのモデルの反論だけに絞ったリスト（同順位はリストのまま）にします。
+    解析・検証できなかった評価指標は、他の評価指標を捨てないよう、その指標だけを invalid とし、応答をそのまま raw_result に残します。
+    """
+    models = list(dict.fromkeys(model_name for model_name, _ in labels))
+    split = {model_name: [] for model_name in models}
+    criteria_by_id = {criterion['id']: criterion for criterion in criteria}
+    for result in results:
+        criterion = criteria_by_id[result['id']]
+        kind = criterion_kind(criterion['name'])
+        if kind is None:
+            for model_name in models:
+                split[model_name].append(dict(result))
+            continue
+        numbers = parse_result_numbers(result['result'])
+        try:
+            if numbers is None:
+                raise ValueError(f"Could not parse joint result for criterion {criterion['id']}: {result['result']!r}")
+            validate_criterion_result(criterion, numbers, len(labels))
+        except ValueError as e:
+            logging.warning(f"Marking criterion {criterion['id']} invalid for models {', '.join(models)}: {e}")
+            for model_name in models:
+                split[model_name].append({"id": result['id'], "name": result['name'], "result": None, "invalid": True, "raw_result": result['result']})
+            continue
+
+        for model_name in models:
+            if kind == RANKING:
+                mapped = []
+                for entry in numbers:
+                    group = [labels[number - 1][1] for number in (entry if isinstance(entry, list) else [entry]) if labels[number - 1][0] == model_name]
+                    if len(group) > 1:
+                        mapped.append(group)
+                    elif group:
+                        mapped.append(group[0])
+            else:
+                mapped = sorted(labels[number - 1][1] for number in numbers if labels[number - 1][0] == model_name)
+            split[model_name].append({"id": result['id'], "name": result['name'], "result": mapped})
+    return split
+
+def evaluate_item_jointly(client, model, item, counter_arguments_text, labels, evaluation_criteria, prompts, temperature=0, max_tokens=1000, max_workers=1, timeout=None, criteria_mode="separate", layout="inline") -> Dict[str, List[Dict]]:
+    """build_joint_counter_arguments でまとめた全モデルの反論を1回の分析で評価し、モデルごとの評価結果を返します。
+
+    prompts は joint_evaluation_prompts で置き換えたプロンプトです。
+    """
+    results = evaluate_arguments(
+        client, model, item['topic'], item['affirmative_argument'],
+        counter_arguments_text, evaluation_criteria, prompts,
+        temperature=temperature, max_tokens=max_tokens, max_workers=max_workers, timeout=timeout,
+        criteria_mode=criteria_mode, layout=layout, num_counter_arguments=len(labels)
+    )
+    return split_joint_results(results, labels, evaluation_criteria)
+
+def add_model_mode_arguments(parser) -> None:
+    parser.add_argument("--model-mode", choices=MODEL_MODES, default="separate", help="Evaluate each model's counterarguments separately, or all models' counterarguments for an item together in one shuffled list with a single analysis ('joint', uses the joint_ prompts)")
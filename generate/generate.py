@@ -1,5 +1,4 @@
 import argparse
-import json
 import logging
 import sys
 import os
@@ -15,25 +14,137 @@ from config import (
     models
 )
 from utils.logging_config import setup_logging
-from utils.file_handlers import load_prompts
+from utils.response_cache import add_cache_arguments, configure_cache_from_args, log_cache_stats
+from utils.token_budget import add_token_budget_arguments, configure_token_budget_from_args, log_truncation_stats
+from utils.tracing import add_tracing_arguments, configure_tracing_from_args, finish_tracing, trace_tags
+from utils.premise_index import add_premise_index_arguments, configure_premise_index_from_args
+from utils.dedup import add_dedup_arguments, resolve_duplicates, select_aliases
+from utils.prompt_templates import add_layout_arguments
+from utils.file_handlers import JsonlIndex, JsonlSink, iter_items, load_prompts, read_jsonl, write_items
 
-from models.ai_models import get_ai_client
-from generators.counterargument_generator import generate_counterargument
+from models.ai_models import add_client_arguments, configure_clients_from_args, get_ai_client
+from models.request_layer import add_request_arguments, configure_requests_from_args
+from generators.counterargument_generator import compact_steps, generate_counterargument, validate_prompts
+from generators.step_scheduler import StepScheduler, count_shareable_steps
+from generators.batch import compact_generation_state, export_generation_stage, import_generation_results, init_generation_state, remaining_chains
+from utils.batch_api import load_batch_state, read_batch_results, save_batch_state, write_batch_requests
+from utils.concurrency import ProviderLimiter, ordered_map, parse_provider_limits
+from utils.sharding import add_shard_arguments, make_item_filter, parse_id_range, parse_shard
 
-def load_input_data(file_path: str) -> list:
+VALID_CONDITIONS = ["x1", "x2", "x3", "x4", "x5", "x6", "x7"]
+
+def iter_input_data(file_path: str):
+    """入力ファイル（JSON配列または JSONL）を1件ずつ検証しながら読み込みます。"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        if not isinstance(data, list):
-            raise ValueError("Input JSON must be a list of dictionaries with 'topic', 'context', and 'id' keys")
-        for item in data:
-            if 'topic' not in item or 'context' not in item or 'id' not in item:
+        for item in iter_items(file_path):
+            if not isinstance(item, dict) or 'topic' not in item or 'context' not in item or 'id' not in item:
                 raise ValueError("Each item in the input JSON must contain 'topic', 'context', and 'id' keys")
-        return data
+            yield item
     except Exception as e:
         logging.error(f"Error loading input data from {file_path}: {e}")
         sys.exit(1)
 
+def compact_checkpoint(checkpoint_path: str, input_path: str, is_selected, model_names: list, conditions: list, aliases: dict = None, dedup: str = "off"):
+    """チェックポイントの生成結果を入力と同じ順序の出力項目として1件ずつ返します。
+
+    aliases（{重複した項目のID: 代表の項目のID}）の項目は、dedup が "skip" なら出力せず、"alias" なら代表の生成結果を alias_of 付きで出力します。
+    """
+    aliases = aliases or {}
+    with JsonlIndex(checkpoint_path, key=lambda record: (record['id'], record['model'], record['condition'])) as generated:
+        for input_item in iter_input_data(input_path):
+            item_id = input_item['id']
+            if not is_selected(item_id):
+                continue
+            if item_id in aliases and dedup == "skip":
+                continue
+
+            result_item = {
+                "id": item_id,
+                'topic': input_item['topic'],
+                'affirmative_argument': input_item['context'],
+                'counterarguments': {}
+            }
+            if item_id in aliases:
+                result_item["alias_of"] = aliases[item_id]
+            source_id = aliases.get(item_id, item_id)
+            for model_name in model_names:
+                result_item['counterarguments'][model_name] = {}
+                for condition in conditions:
+                    record = generated.get((source_id, model_name, condition))
+                    if record is not None:
+                        result_item['counterarguments'][model_name][condition] = {
+                            "counterargument": record["counterargument"],
+                            "steps": record["steps"]
+                        }
+                        if "samples" in record:
+                            result_item['counterarguments'][model_name][condition]["samples"] = record["samples"]
+            yield result_item
+
+def add_alias_items(items: list, input_path: str, is_selected, aliases: dict):
+    """代表の項目の生成結果を重複した項目にも alias_of 付きで複製し、入力と同じ順序で返します。"""
+    generated = {item['id']: item for item in items}
+    for input_item in iter_input_data(input_path):
+        item_id = input_item['id']
+        if item_id in generated:
+            yield generated[item_id]
+        elif item_id in aliases and is_selected(item_id) and aliases[item_id] in generated:
+            yield {
+                "id": item_id,
+                'topic': input_item['topic'],
+                'affirmative_argument': input_item['context'],
+                'counterarguments': generated[aliases[item_id]]['counterarguments'],
+                "alias_of": aliases[item_id]
+            }
+
+def find_aliases(args, duplicates: dict, is_selected) -> dict:
+    """--dedup が有効な場合、生成を省く重複した項目の {ID: 代表のID} を返します。
+
+    重複は入力全体で探してあり（resolve_duplicates）、重複した項目は代表と同じシャードに割り当てられます。
+    代表がこの実行で処理されない（ID範囲の外の）項目は、重複していても生成します。
+    """
+    if args.dedup == "off":
+        return {}
+    selected_duplicates = [item_id for item_id in duplicates if is_selected(item_id)]
+    aliases = select_aliases(duplicates, is_selected)
+    if len(aliases) < len(selected_duplicates):
+        logging.info(f"{len(selected_duplicates) - len(aliases)} duplicates will be generated because their canonical items are not selected in this run")
+    logging.info(f"Skipping generation for {len(aliases)} duplicate items (--dedup {args.dedup})")
+    return aliases
+
+def run_batch_stage(args, prompts: dict, is_selected, conditions: list, aliases: dict) -> None:
+    """バッチAPI用にステップを1段階ずつ書き出し、結果を取り込みます。"""
+    state_path = args.batch_state or f"{args.output}.batch_state.json"
+    state = load_batch_state(state_path)
+
+    if args.batch == "import":
+        if state is None:
+            logging.error(f"No batch state found at {state_path}; run --batch export first")
+            sys.exit(1)
+        imported = import_generation_results(state, read_batch_results(args.batch_results))
+        save_batch_state(state_path, state)
+        remaining = remaining_chains(state)
+        print(f"Imported {imported} batch results; {remaining} chains remaining")
+        if remaining == 0:
+            items = compact_generation_state(state)
+            if args.dedup == "alias":
+                items = add_alias_items(items, args.input, is_selected, aliases)
+            write_items(args.output, items)
+            print(f"Generated counterarguments saved to {args.output}")
+        return
+
+    if state is None:
+        selected_items = [input_item for input_item in iter_input_data(args.input) if is_selected(input_item['id']) and input_item['id'] not in aliases]
+        state = init_generation_state(selected_items, args.models, conditions, models, args.temperature, args.max_tokens, args.message_layout)
+    requests_path = args.batch_requests or f"{args.output}.batch_requests.jsonl"
+    written = write_batch_requests(requests_path, export_generation_stage(state, prompts))
+    # 書き出したファイルを記録し、取り込み時に結果の足りないファイルを示す
+    state["batch_files"] = written
+    save_batch_state(state_path, state)
+    if written:
+        print(f"Batch requests written to {', '.join(written.values())}; run with --batch import --batch-results <files> when the batches finish")
+    else:
+        print(f"All chains are complete; run with --batch import to write {args.output}")
+
 def main():
     setup_logging()
     prompts = load_prompts(prompt_path)
@@ -43,10 +154,35 @@ def main():
     parser.add_argument("--temperature", type=float, required=True, help="Temperature for generation")
     parser.add_argument("--max-tokens", type=int, required=True, help="Max tokens for generation")
     parser.add_argument("--conditions", nargs='+', required=True, help="Conditions to use (x1, x2, x3, x4, x5, x6, x7)")
-    parser.add_argument("--input", type=str, required=True, help="Path to input JSON file")
-    parser.add_argument("--output", type=str, default='generated_counterarguments.json', help="Path to output JSON file")
+    parser.add_argument("--input", type=str, required=True, help="Path to input JSON or JSONL file")
+    parser.add_argument("--output", type=str, default='generated_counterarguments.json', help="Path to output JSON file (written as JSONL if it ends with .jsonl)")
     parser.add_argument("--id-range", type=str, help="ID range to process (e.g., '1-3' or '2,4,6')")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of (item, model, condition) chains to run in parallel")
+    parser.add_argument("--provider-concurrency", nargs='*', default=[], help="Per-provider limits on in-flight chains (e.g., 'openai=8 groq=4')")
+    parser.add_argument("--share-steps", action="store_true", help="Run steps with identical conversation prefixes once and share the result across conditions; only has an effect when the selected conditions start with the same step prompts (the bundled prompt.json has none, so the flag is ignored with a warning)")
+    parser.add_argument("--samples", type=int, default=1, help="Number of counterarguments to sample from the final step of each chain (earlier steps are shared)")
+    parser.add_argument("--compact-steps", action="store_true", help="Store each step's prompt as a prompt.json key instead of the filled input text")
+    parser.add_argument("--checkpoint", type=str, help="Path to the append-only JSONL checkpoint (default: <output>.checkpoint.jsonl)")
+    parser.add_argument("--resume", action="store_true", help="Skip counterarguments already recorded in the checkpoint")
+    parser.add_argument("--batch", choices=["export", "import"], help="Export the next step of every chain as provider batch JSONL files, or import batch results")
+    parser.add_argument("--batch-state", type=str, help="Path to the batch progress state (default: <output>.batch_state.json)")
+    parser.add_argument("--batch-requests", type=str, help="Batch request file prefix; one file per provider and model is written (default: <output>.batch_requests.jsonl)")
+    parser.add_argument("--batch-results", nargs='+', default=[], help="Batch result JSONL files to import")
+    add_shard_arguments(parser)
+    add_premise_index_arguments(parser)
+    add_dedup_arguments(parser)
+    add_layout_arguments(parser)
+    add_cache_arguments(parser)
+    add_request_arguments(parser)
+    add_client_arguments(parser)
+    add_token_budget_arguments(parser)
+    add_tracing_arguments(parser)
     args = parser.parse_args()
+    configure_cache_from_args(args)
+    configure_requests_from_args(args)
+    configure_clients_from_args(args)
+    configure_tracing_from_args(args)
+    configure_token_budget_from_args(args)
 
     # APIキーの設定
     os.environ['OPENAI_API_KEY'] = openai_api_key
@@ -56,74 +192,122 @@ def main():
         if model_name not in models:
             raise ValueError(f"Unsupported model: {model_name}")
 
-    input_data = load_input_data(args.input)
+    conditions = []
+    for condition in args.conditions:
+        if condition not in VALID_CONDITIONS:
+            logging.warning(f"Skipping invalid condition: {condition}")
+            continue
+        conditions.append(condition)
+
+    try:
+        validate_prompts(prompts, conditions)
+    except ValueError as e:
+        logging.error(f"Invalid prompts in {prompt_path}: {e}")
+        sys.exit(1)
+
+    # 入力の主張を文に分割した前提の索引を用意する（保存済みの索引があれば再利用する）
+    # シャードごとに並列に実行しても同じ索引になるよう、ID範囲に関係なく入力全体から作る
+    configure_premise_index_from_args(args, (input_item['context'] for input_item in iter_input_data(args.input)))
+
+    # 重複した入力は生成せず、代表の結果を使う。重複はシャードに関係なく入力全体で探す
+    duplicates = resolve_duplicates(args, lambda: iter_input_data(args.input))
+
+    # ID範囲とシャードの処理（重複した項目は代表と同じシャードで処理する）
+    is_selected = make_item_filter(parse_id_range(args.id_range), parse_shard(args.shard), duplicates)
+    aliases = find_aliases(args, duplicates, is_selected)
+
+    if args.batch:
+        if args.samples > 1:
+            parser.error("--samples is not supported with --batch")
+        run_batch_stage(args, prompts, is_selected, conditions, aliases)
+        return
 
-    # ID範囲の処理
-    if args.id_range:
-        if '-' in args.id_range:
-            start, end = map(int, args.id_range.split('-'))
-            id_list = list(range(start, end + 1))
+    # クライアントはモデルごとに1つ作成し、全アイテムで共有する
+    clients = {
+        model_name: get_ai_client(models[model_name]['client_type'], {
+            'openai_api_key': openai_api_key,
+            'groq_api_key': groq_api_key
+        })
+        for model_name in args.models
+    }
+
+    # 条件間で同一の会話履歴を持つステップを共有する。共有できるステップがないプロンプトでは使わない
+    scheduler = None
+    if args.share_steps:
+        shareable = count_shareable_steps(prompts, conditions)
+        if shareable == 0:
+            logging.warning(f"--share-steps has no effect: the selected conditions ({', '.join(conditions)}) use different prompts from the first step in {prompt_path}, so no step can be shared; running without it")
         else:
-            id_list = list(map(int, args.id_range.split(',')))
-    else:
-        id_list = None
+            logging.info(f"Sharing {shareable} identical steps per (item, model) across the selected conditions")
+            scheduler = StepScheduler()
 
-    all_results = []
+    limiter = ProviderLimiter(parse_provider_limits(args.provider_concurrency))
 
-    for input_item in input_data:
-        item_id = input_item['id']
-        
-        if id_list and item_id not in id_list:
-            continue
+    def iter_tasks():
+        for input_item in iter_input_data(args.input):
+            item_id = input_item['id']
 
+            if not is_selected(item_id) or item_id in aliases:
+                continue
+
+            print(f"Processing item with ID: {item_id}")
+
+            for model_name in args.models:
+                client = clients[model_name]
+                for condition in conditions:
+                    if (item_id, model_name, condition) in completed:
+                        continue
+                    yield input_item, model_name, client, condition
+
+    def run_task(task):
+        input_item, model_name, client, condition = task
+        model_info = models[model_name]
         topic = input_item['topic']
         affirmative_argument = input_item['context']
 
-        print(f"Processing item with ID: {item_id}")
-
-        result_item = {
-            "id": item_id,
-            'topic': topic,
-            'affirmative_argument': affirmative_argument,
-            'counterarguments': {}
-        }
-
-        for model_name in args.models:
-            model_info = models[model_name]
-            client = get_ai_client(model_info['client_type'], {
-                'openai_api_key': openai_api_key,
-                'groq_api_key': groq_api_key
-            })
-
-            counterarguments = {}
-            for condition in args.conditions:
-                if condition not in ["x1", "x2", "x3", "x4", "x5", "x6", "x7"]:
-                    logging.warning(f"Skipping invalid condition: {condition}")
-                    continue
-
-                print(f"Generating counterargument using {model_name} with condition {condition} for topic '{topic}' (ID: {item_id})...")
-
-                try:
-                    result = generate_counterargument(
-                        client, topic, affirmative_argument, prompts,
-                        model_info['model'], args.temperature, args.max_tokens, condition
-                    )
-                    counterarguments[condition] = {
-                        "counterargument": result["counterargument"],
-                        "steps": result["steps"]
-                    }
-                    print(f"Successfully generated counterargument for condition {condition} using model {model_name}")
-                except Exception as e:
-                    error_message = f"An error occurred for condition {condition} using model {model_name}: {e}\n"
-                    logging.error(error_message)
-
-            result_item['counterarguments'][model_name] = counterarguments
-
-        all_results.append(result_item)
-
-    # 結果を出力
-    with open(args.output, 'w', encoding='utf-8') as f:
-        json.dump(all_results, f, ensure_ascii=False, indent=2)
+        print(f"Generating counterargument using {model_name} with condition {condition} for topic '{topic}' (ID: {input_item['id']})...")
+
+        try:
+            with limiter.slot(model_info['client_type']), trace_tags(item=input_item['id'], model_name=model_name, condition=condition):
+                result = generate_counterargument(
+                    client, topic, affirmative_argument, prompts,
+                    model_info['model'], args.temperature, args.max_tokens, condition,
+                    scheduler=scheduler, samples=args.samples, layout=args.message_layout
+                )
+            record = {
+                "id": input_item['id'],
+                "model": model_name,
+                "condition": condition,
+                "counterargument": result["counterargument"],
+                "steps": compact_steps(condition, result["steps"], args.message_layout) if args.compact_steps else result["steps"]
+            }
+            if "samples" in result:
+                record["samples"] = result["samples"]
+            sink.write(record)
+            print(f"Successfully generated counterargument for condition {condition} using model {model_name}")
+        except Exception as e:
+            error_message = f"An error occurred for condition {condition} using model {model_name}: {e}\n"
+            logging.error(error_message)
+
+    # 完了した (item, model, condition) ごとにチェックポイントへ追記する
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.jsonl"
+    completed = set()
+    if args.resume:
+        completed = {(record['id'], record['model'], record['condition']) for record in read_jsonl(checkpoint_path)}
+        logging.info(f"Resuming from {checkpoint_path}: {len(completed)} counterarguments already generated")
+
+    with JsonlSink(checkpoint_path, resume=args.resume) as sink:
+        for _ in ordered_map(run_task, iter_tasks(), args.concurrency):
+            pass
+
+    if scheduler is not None:
+        scheduler.log_stats()
+    log_cache_stats()
+    log_truncation_stats()
+    finish_tracing(args)
+
+    # チェックポイントを入力と同じ順序の出力ファイルにまとめる
+    write_items(args.output, compact_checkpoint(checkpoint_path, args.input, is_selected, args.models, conditions, aliases, args.dedup))
     print(f"Generated counterarguments saved to {args.output}")
 
 if __name__ == "__main__":
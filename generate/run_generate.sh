@@ -24,6 +24,39 @@ INPUT_FILE="input.json"
 # 出力ファイルのパス
 OUTPUT_FILE="generated_counterarguments.json"
 
+# 1分あたりのリクエスト数・トークン数の上限（provider[/model]=rpm,tpm）
+RATE_LIMITS="openai=500,200000 groq=30,6000"
+
+# 応答キャッシュの設定（--cache または --no-cache）
+CACHE_FLAG="--cache"
+
+# メッセージの並べ方（inline: 従来どおり / prefix: 固定の指示を先に置きプロバイダのプロンプトキャッシュを効かせる）
+MESSAGE_LAYOUT="inline"
+
+# 各ステップの max_tokens の決め方（fixed: 全ステップで MAX_TOKENS / adaptive: プロンプトのトークン数から決める）
+TOKEN_BUDGET="adaptive"
+
+# max_tokens で切り詰められた応答の続きを要求する回数の上限
+MAX_CONTINUATIONS=1
+
+# 重複した入力の扱い（off: 全て生成 / skip: 生成も出力もしない / alias: 代表の項目の結果を alias_of 付きで出力する）
+DEDUP="off"
+
+# 応答をストリーミングで受け取り、最初のトークンまでの時間と出力速度を計測する場合は "--stream"
+STREAM_FLAG=""
+
+# 各ステップの入力プロンプトを prompt.json のキーで保存して出力を小さくする場合は "--compact-steps"
+COMPACT_FLAG=""
+
+# 条件ごとに最後のステップで生成する反論の数（それまでのステップは共有される）
+SAMPLES=1
+
+# 並列に実行する (item, model, condition) の数
+CONCURRENCY=8
+
+# プロバイダごとの同時実行数の上限
+PROVIDER_CONCURRENCY="openai=8 groq=4"
+
 # ID範囲の初期化
 ID_RANGE=""
 
@@ -60,7 +93,18 @@ if [ -z "$ID_RANGE" ]; then
     --max-tokens "$MAX_TOKENS" \
     --conditions $CONDITIONS \
     --input "$INPUT_FILE" \
-    --output "$OUTPUT_FILE"
+    --output "$OUTPUT_FILE" \
+    --concurrency "$CONCURRENCY" \
+    --samples "$SAMPLES" \
+    $CACHE_FLAG \
+    --message-layout "$MESSAGE_LAYOUT" \
+    --token-budget "$TOKEN_BUDGET" \
+    --max-continuations "$MAX_CONTINUATIONS" \
+    $STREAM_FLAG \
+    --dedup "$DEDUP" \
+    $COMPACT_FLAG \
+    --rate-limits $RATE_LIMITS \
+    --provider-concurrency $PROVIDER_CONCURRENCY
 else
   # 指定されたID範囲のデータのみを処理
   python3 generate/generate.py \
@@ -70,5 +114,16 @@ else
     --conditions $CONDITIONS \
     --input "$INPUT_FILE" \
     --output "$OUTPUT_FILE" \
+    --concurrency "$CONCURRENCY" \
+    --samples "$SAMPLES" \
+    $CACHE_FLAG \
+    --message-layout "$MESSAGE_LAYOUT" \
+    --token-budget "$TOKEN_BUDGET" \
+    --max-continuations "$MAX_CONTINUATIONS" \
+    $STREAM_FLAG \
+    --dedup "$DEDUP" \
+    $COMPACT_FLAG \
+    --rate-limits $RATE_LIMITS \
+    --provider-concurrency $PROVIDER_CONCURRENCY \
     --id-range "$ID_RANGE"
 fi
\ No newline at end of file
@@ -0,0 +1,99 @@
+from typing import Dict, List, Tuple
+
+from generators.counterargument_generator import CONDITION_STEPS, build_step_messages, plan_chain_max_tokens
+from utils.batch_api import batch_group_key, log_missing_results, make_batch_request, make_custom_id
+
+def init_generation_state(input_items: List[Dict], model_names: List[str], conditions: List[str], models: Dict, temperature: float, max_tokens: int, layout: str = "inline") -> Dict:
+    """バッチ生成の状態（各 (item, model, condition) チェーンの進捗）を作成します。"""
+    state = {
+        "kind": "generation",
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "layout": layout,
+        "models": {model_name: models[model_name] for model_name in model_names},
+        "conditions": conditions,
+        "items": [],
+        "chains": [],
+    }
+    for input_item in input_items:
+        state["items"].append({
+            "id": input_item['id'],
+            "topic": input_item['topic'],
+            "affirmative_argument": input_item['context'],
+        })
+        for model_name in model_names:
+            for condition in conditions:
+                state["chains"].append({
+                    "id": input_item['id'],
+                    "model": model_name,
+                    "condition": condition,
+                    "steps": [],
+                    "pending": None,
+                })
+    return state
+
+def is_complete(chain: Dict) -> bool:
+    return len(chain["steps"]) >= len(CONDITION_STEPS[chain["condition"]])
+
+def export_generation_stage(state: Dict, prompts: Dict) -> Dict[Tuple[str, str], List[Dict]]:
+    """未完了の各チェーンについて次のステップのリクエストを (プロバイダ, モデル) ごとに返します。"""
+    items = {item["id"]: item for item in state["items"]}
+    requests_by_group = {}
+    for chain in state["chains"]:
+        if is_complete(chain):
+            continue
+        item = items[chain["id"]]
+        step_name, step_prompt, messages = build_step_messages(prompts, chain["condition"], item["topic"], item["affirmative_argument"], chain["steps"], state.get("layout", "inline"))
+        model_info = state["models"][chain["model"]]
+        custom_id = make_custom_id(chain["id"], chain["model"], chain["condition"], step_name)
+        chain["pending"] = {"custom_id": custom_id, "step": step_name, "input": step_prompt}
+        requests_by_group.setdefault((model_info['client_type'], model_info['model']), []).append(
+            make_batch_request(custom_id, model_info['model'], messages, state["temperature"], plan_chain_max_tokens(chain["condition"], chain["steps"], item["affirmative_argument"], messages, model_info['model'], state["max_tokens"]))
+        )
+    return requests_by_group
+
+def import_generation_results(state: Dict, results: Dict[str, str]) -> int:
+    """バッチ結果を各チェーンの次のステップとして記録し、記録したステップ数を返します。"""
+    imported = 0
+    missing = {}
+    for chain in state["chains"]:
+        pending = chain["pending"]
+        if pending is None:
+            continue
+        if pending["custom_id"] not in results:
+            model_info = state["models"][chain["model"]]
+            group_key = batch_group_key(model_info['client_type'], model_info['model'])
+            missing[group_key] = missing.get(group_key, 0) + 1
+            continue
+        chain["steps"].append({"step": pending["step"], "input": pending["input"], "output": results[pending["custom_id"]]})
+        chain["pending"] = None
+        imported += 1
+    log_missing_results(state, missing)
+    return imported
+
+def remaining_chains(state: Dict) -> int:
+    return sum(1 for chain in state["chains"] if not is_complete(chain))
+
+def compact_generation_state(state: Dict) -> List[Dict]:
+    """完了したチェーンを generated_counterarguments.json と同じ形式にまとめます。"""
+    chains = {(chain["id"], chain["model"], chain["condition"]): chain for chain in state["chains"]}
+    all_results = []
+    for item in state["items"]:
+        result_item = {
+            "id": item["id"],
+            'topic': item["topic"],
+            'affirmative_argument': item["affirmative_argument"],
+            'counterarguments': {}
+        }
+        for model_name in state["models"]:
+            counterarguments = {}
+            for condition in state["conditions"]:
+                chain = chains[(item["id"], model_name, condition)]
+                if is_complete(chain):
+                    counterarguments[condition] = {
+                        "counterargument": chain["steps"][-1]["output"],
+                        "steps": chain["steps"]
+                    }
+            result_item['counterarguments'][model_name] = counterarguments
+        all_results.append(result_item)
+    return all_results
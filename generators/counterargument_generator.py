@@ -1,84 +1,202 @@
 import logging
 from typing import List, Dict
+from models.ai_models import complete_samples_with_continuation, complete_with_continuation
+from utils.premise_index import format_premise_list, get_premise_index
+from utils.prompt_templates import compile_generation_template
+from utils.token_budget import count_tokens, get_token_budget
+from utils.tracing import trace_tags
 
 def generate_response(client, messages: List[Dict], model: str, temperature: float, max_tokens: int) -> Dict:
     try:
         if hasattr(client, 'chat'):
-            chat_completion = client.chat.completions.create(
-                messages=messages,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens,
-            )
+            completion = complete_with_continuation(client, messages, model, temperature, max_tokens)
+            result = {"input": messages[-1]['content'], "output": completion["content"]}
+            # 続きを要求しても max_tokens で切れたままの応答は、後から見つけられるように印を付ける
+            if completion.get("finish_reason") == "length":
+                result["truncated"] = True
+            return result
         else:
-            chat_completion = client.completions.create(
+            completion = client.completions.create(
                 model=model,
                 prompt=messages[-1]['content'],
                 temperature=temperature,
                 max_tokens=max_tokens
             )
-        response = chat_completion.choices[0].message.content if hasattr(chat_completion.choices[0], 'message') else chat_completion.choices[0].text
+            response = completion.choices[0].text
         return {"input": messages[-1]['content'], "output": response}
     except Exception as e:
         logging.error(f"Error generating response: {e}")
         raise
 
+def generate_samples(client, messages: List[Dict], model: str, temperature: float, max_tokens: int, samples: int) -> List[Dict]:
+    """同じ会話履歴から samples 個の応答を generate_response と同じ形式（output と truncated）で生成します。"""
+    try:
+        if hasattr(client, 'chat'):
+            sample_results = []
+            for completion in complete_samples_with_continuation(client, messages, model, temperature, max_tokens, samples):
+                sample_result = {"input": messages[-1]['content'], "output": completion["content"]}
+                if completion.get("finish_reason") == "length":
+                    sample_result["truncated"] = True
+                sample_results.append(sample_result)
+            return sample_results
+        return [generate_response(client, messages, model, temperature, max_tokens) for _ in range(samples)]
+    except Exception as e:
+        logging.error(f"Error generating samples: {e}")
+        raise
+
 def extract_premise(affirmative_argument: str) -> str:
-    premise_list = affirmative_argument.split(".")
-    combined_premises_text = "\n".join(f"\"{premise.strip()}\"" for i, premise in enumerate(premise_list) if premise.strip())
-    return combined_premises_text
+    """主張を文に分割した前提リストのテキストを返します。事前に作った索引に分割済みの結果があればそれを使います。"""
+    return format_premise_list(get_premise_index().sentences(affirmative_argument))
 
-def generate_counterargument(client, topic: str, affirmative_argument: str, prompts: Dict, model: str, temperature: float, max_tokens: int, condition: str) -> Dict:
-    conversation_history = [
-        {"role": "system", "content": prompts["system_prompt"]}
-    ]
-    steps = []
+# 条件ごとのステップ定義（ステップ名, prompt.json のキー）。前のステップの出力は会話履歴として次のステップに渡される
+CONDITION_STEPS = {
+    "x1": [
+        ("premise_generation", "premise_generation_prompt"),
+        ("premise_decision", "premise_decision_prompt"),
+        ("counterargument_generation", "counter-argument_generation_prompt"),
+    ],
+    "x2": [
+        ("premise_decision", "premise_decision_prompt"),
+        ("counterargument_generation", "counter-argument_generation_prompt"),
+    ],
+    "x3": [
+        ("premise_decision", "premise_decision_prompt"),
+        ("counterargument_generation", "counter-argument_generation_prompt"),
+    ],
+    "x4": [("counterargument_generation", "counter-argument_generation_prompt")],
+    "x5": [("counterargument_generation", "counter-argument_generation_prompt")],
+    "x6": [("counterargument_generation", "counter-argument_generation_prompt")],
+    "x7": [("counterargument_generation", "counter-argument_generation_prompt")],
+}
 
-    try:
-        premise_list = extract_premise(affirmative_argument)
-        
-        if condition == "x1":
-            premise_prompt = prompts["x1"]["premise_generation_prompt"].replace("#topic#", topic).replace("#argument#", affirmative_argument)
-            conversation_history.append({"role": "user", "content": premise_prompt})
-            step_result = generate_response(client, conversation_history, model, temperature, max_tokens)
-            steps.append({"step": "premise_generation", "input": premise_prompt, "output": step_result["output"]})
-            conversation_history.append({"role": "assistant", "content": step_result["output"]})
+# --token-budget adaptive での各ステップの max_tokens の規則（基本値, 主張のトークン数に対する比, 最大値）。
+# 前提の列挙は主張の長さに比例して長くなり、前提の選択は短い。None のステップ（反論の生成）は --max-tokens を使う
+STEP_TOKEN_BUDGETS = {
+    "premise_generation": (128, 1.0, 1024),
+    "premise_decision": (96, 0.25, 384),
+    "counterargument_generation": None,
+}
 
-            decision_prompt = prompts["x1"]["premise_decision_prompt"]
-            conversation_history.append({"role": "user", "content": decision_prompt})
-            step_result = generate_response(client, conversation_history, model, temperature, max_tokens)
-            steps.append({"step": "premise_decision", "input": decision_prompt, "output": step_result["output"]})
-            conversation_history.append({"role": "assistant", "content": step_result["output"]})
+def plan_step_max_tokens(step_name: str, affirmative_argument: str, messages: List[Dict], model: str, max_tokens: int) -> int:
+    """ステップの max_tokens を決めます。--token-budget fixed の場合は max_tokens をそのまま返します。"""
+    budget = get_token_budget()
+    if budget.mode == "fixed":
+        return max_tokens
+    return budget.plan(STEP_TOKEN_BUDGETS.get(step_name), count_tokens(affirmative_argument, model), messages, model, max_tokens)
 
-            counterargument_prompt = prompts["x1"]["counter-argument_generation_prompt"]
-            conversation_history.append({"role": "user", "content": counterargument_prompt})
+def fill_prompt(template: str, topic: str, affirmative_argument: str, premise_list: str, layout: str = "inline") -> str:
+    return compile_generation_template(template, layout).render(topic=topic, affirmative_argument=affirmative_argument, premise_list=premise_list)
 
-        elif condition in ["x2", "x3"]:
-            decision_prompt = prompts[condition]["premise_decision_prompt"].replace("#topic#", topic).replace("#argument#", affirmative_argument).replace("###premise_list###", premise_list)
-            conversation_history.append({"role": "user", "content": decision_prompt})
-            step_result = generate_response(client, conversation_history, model, temperature, max_tokens)
-            steps.append({"step": "premise_decision", "input": decision_prompt, "output": step_result["output"]})
-            conversation_history.append({"role": "assistant", "content": step_result["output"]})
+def validate_prompts(prompts: Dict, conditions: List[str]) -> None:
+    """指定した条件のステップで使うプロンプトが prompt.json にそろっているか検証し、テンプレートを変換しておきます。"""
+    if not isinstance(prompts.get("system_prompt"), str):
+        raise ValueError("Missing prompt 'system_prompt'")
+    for condition in conditions:
+        for _, prompt_key in CONDITION_STEPS[condition]:
+            template = prompts.get(condition, {}).get(prompt_key)
+            if not isinstance(template, str):
+                raise ValueError(f"Missing prompt '{condition}.{prompt_key}'")
+            try:
+                compile_generation_template(template)
+            except ValueError as e:
+                raise ValueError(f"Invalid prompt '{condition}.{prompt_key}': {e}") from e
 
-            counterargument_prompt = prompts[condition]["counter-argument_generation_prompt"]
-            conversation_history.append({"role": "user", "content": counterargument_prompt})
+def build_step_messages(prompts: Dict, condition: str, topic: str, affirmative_argument: str, completed_steps: List[Dict], layout: str = "inline"):
+    """完了済みのステップから次のステップの (ステップ名, プロンプト, メッセージ) を組み立てます。
 
-        elif condition in ["x4", "x7"]:
-            counterargument_prompt = prompts[condition]["counter-argument_generation_prompt"].replace("#topic#", topic).replace("#argument#", affirmative_argument)
-            conversation_history.append({"role": "user", "content": counterargument_prompt})
+    全ステップが完了している場合は None を返します。
+    """
+    step_definitions = CONDITION_STEPS[condition]
+    if len(completed_steps) >= len(step_definitions):
+        return None
 
-        elif condition == ["x5","x6"]:
-            counterargument_prompt = prompts[condition]["counter-argument_generation_prompt"].replace("#topic#", topic).replace("#argument#", affirmative_argument).replace("###premise_list###", premise_list)
-            conversation_history.append({"role": "user", "content": counterargument_prompt})
+    messages = [{"role": "system", "content": prompts["system_prompt"]}]
+    for step in completed_steps:
+        messages.append({"role": "user", "content": step["input"]})
+        messages.append({"role": "assistant", "content": step["output"]})
 
-        else:
+    step_name, prompt_key = step_definitions[len(completed_steps)]
+    step_prompt = fill_prompt(prompts[condition][prompt_key], topic, affirmative_argument, extract_premise(affirmative_argument), layout)
+    messages.append({"role": "user", "content": step_prompt})
+    return step_name, step_prompt, messages
+
+def plan_chain_max_tokens(condition: str, completed_steps: List[Dict], affirmative_argument: str, messages: List[Dict], model: str, max_tokens: int) -> int:
+    """build_step_messages で組み立てた次のステップの max_tokens を決めます。"""
+    step_name, _ = CONDITION_STEPS[condition][len(completed_steps)]
+    return plan_step_max_tokens(step_name, affirmative_argument, messages, model, max_tokens)
+
+def compact_steps(condition: str, steps: List[Dict], layout: str = "inline") -> List[Dict]:
+    """各ステップの input（埋め込み済みのプロンプト）を prompt.json のキーへの参照に置き換えます。"""
+    compacted = []
+    for step, (_, prompt_key) in zip(steps, CONDITION_STEPS[condition]):
+        compacted.append({"step": step["step"], "prompt": prompt_key, "output": step["output"]})
+        if layout != "inline":
+            compacted[-1]["layout"] = layout
+        if step.get("truncated"):
+            compacted[-1]["truncated"] = True
+    return compacted
+
+def expand_steps(prompts: Dict, condition: str, topic: str, affirmative_argument: str, steps: List[Dict]) -> List[Dict]:
+    """compact_steps で参照にしたステップの input を prompt.json から復元します。"""
+    premise_list = extract_premise(affirmative_argument)
+    expanded = []
+    for step in steps:
+        if "prompt" in step:
+            step_prompt = fill_prompt(prompts[condition][step["prompt"]], topic, affirmative_argument, premise_list, step.get("layout", "inline"))
+            expanded_step = {"step": step["step"], "input": step_prompt, "output": step["output"]}
+            if step.get("truncated"):
+                expanded_step["truncated"] = True
+            step = expanded_step
+        expanded.append(step)
+    return expanded
+
+def generate_counterargument(client, topic: str, affirmative_argument: str, prompts: Dict, model: str, temperature: float, max_tokens: int, condition: str, scheduler=None, samples: int = 1, layout: str = "inline") -> Dict:
+    """条件に対応するステップを順に実行して反論を生成します。
+
+    scheduler（StepScheduler）を渡した場合、同じ会話履歴に対するステップは実行中の全条件・全モデルで1回だけ実行されます。
+    samples が 2 以上の場合、最後のステップだけを samples 個生成し、結果の samples に番号付きで入れます。
+    それまでのステップは全サンプルで共有します（最後のステップは scheduler でも共有しません）。
+    layout が "prefix" の場合、各ステップのプロンプトは固定の指示を先に、トピックや主張を後ろに置きます。
+    """
+    conversation_history = [
+        {"role": "system", "content": prompts["system_prompt"]}
+    ]
+    steps = []
+
+    try:
+        if condition not in CONDITION_STEPS:
             raise ValueError(f"Invalid condition: {condition}")
 
-        step_result = generate_response(client, conversation_history, model, temperature, max_tokens)
-        steps.append({"step": "counterargument_generation", "input": counterargument_prompt, "output": step_result["output"]})
+        premise_list = extract_premise(affirmative_argument)
+        step_definitions = CONDITION_STEPS[condition]
+        sample_outputs = None
+
+        for index, (step_name, prompt_key) in enumerate(step_definitions):
+            step_prompt = fill_prompt(prompts[condition][prompt_key], topic, affirmative_argument, premise_list, layout)
+            conversation_history.append({"role": "user", "content": step_prompt})
+            step_max_tokens = plan_step_max_tokens(step_name, affirmative_argument, conversation_history, model, max_tokens)
+            with trace_tags(step=step_name):
+                if samples > 1 and index == len(step_definitions) - 1:
+                    sample_outputs = generate_samples(client, conversation_history, model, temperature, step_max_tokens, samples)
+                    step_result = sample_outputs[0]
+                elif scheduler is not None:
+                    step_result = scheduler.run(client, list(conversation_history), model, temperature, step_max_tokens)
+                else:
+                    step_result = generate_response(client, conversation_history, model, temperature, step_max_tokens)
+            steps.append({"step": step_name, "input": step_prompt, "output": step_result["output"]})
+            if step_result.get("truncated"):
+                steps[-1]["truncated"] = True
+            conversation_history.append({"role": "assistant", "content": step_result["output"]})
 
-        return {"counterargument": step_result["output"], "steps": steps}
+        result = {"counterargument": steps[-1]["output"], "steps": steps}
+        if sample_outputs is not None:
+            result["samples"] = []
+            for sample, sample_output in enumerate(sample_outputs):
+                result["samples"].append({"sample": sample, "counterargument": sample_output["output"]})
+                if sample_output.get("truncated"):
+                    result["samples"][-1]["truncated"] = True
+        return result
 
     except Exception as e:
         logging.error(f"Error generating counterargument: {e}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List
+from models.ai_models import client_provider
+from generators.counterargument_generator import CONDITION_STEPS, generate_response
+
+def count_shareable_steps(prompts: Dict, conditions: List[str]) -> int:
+    """選択した条件のうち、先頭から同じステップ（ステップ名とプロンプトのテンプレート）が続き、共有できるステップの数を返します。
+
+    同じ入力・モデルでも、条件どうしでプロンプトが異なれば会話履歴が一致しないため、スケジューラは何も共有しません。
+    同梱の prompt.json では各条件のプロンプトが全て異なるため 0 になります。
+    """
+    prefixes = {}
+    for condition in conditions:
+        prefix = ()
+        for step_name, prompt_key in CONDITION_STEPS[condition]:
+            prefix += ((step_name, prompts[condition][prompt_key]),)
+            prefixes.setdefault(prefix, set()).add(condition)
+    return sum(len(sharing) - 1 for sharing in prefixes.values())
+
+class StepScheduler:
+    """条件間で共通する (会話履歴 → 応答) のステップを1回だけ実行するスケジューラです。
+
+    各条件のチェーンは別スレッドで並列に進み、同じノードに到達したチェーンは
+    最初に実行したチェーンの結果を待って共有します。
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.executed = 0
+        self.shared = 0
+        self._nodes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def node_key(client, messages: List[Dict], model: str, temperature: float, max_tokens: int) -> str:
+        payload = [client_provider(client), model, messages, temperature, max_tokens]
+        encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def run(self, client, messages: List[Dict], model: str, temperature: float, max_tokens: int) -> Dict:
+        key = self.node_key(client, messages, model, temperature, max_tokens)
+        with self._lock:
+            future = self._nodes.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._nodes[key] = future
+                self.executed += 1
+                self._evict()
+            else:
+                self._nodes.move_to_end(key)
+                self.shared += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = generate_response(client, messages, model, temperature, max_tokens)
+        except Exception as e:
+            # 失敗したノードは後続のチェーンが再実行できるように取り除く
+            with self._lock:
+                self._nodes.pop(key, None)
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def log_stats(self) -> None:
+        logging.info(f"Step scheduler: {self.executed} steps executed, {self.shared} shared across conditions")
+
+    def _evict(self) -> None:
+        while len(self._nodes) > self.max_entries:
+            oldest_key, oldest = next(iter(self._nodes.items()))
+            if not oldest.done():
+                break
+            del self._nodes[oldest_key]
@@ -1,10 +1,356 @@
-from openai import OpenAI
-from groq import Groq
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from groq import AsyncGroq, Groq
+from models.request_layer import get_request_layer
+from utils.response_cache import get_response_cache
+from utils.token_budget import count_message_tokens, count_tokens, get_token_budget
+from utils.tracing import current_tags, get_tracer, propagate, trace_tags
+
+CLIENT_CLASSES = {
+    "openai": (OpenAI, AsyncOpenAI, 'openai_api_key'),
+    "groq": (Groq, AsyncGroq, 'groq_api_key'),
+}
+
+# max_tokens で切り詰められた応答の続きを求めるプロンプト
+CONTINUATION_PROMPT = "Your previous response was cut off. Continue exactly where it stopped, without repeating anything or adding any preamble."
+
+# 1回のリクエストで n 個の応答を返せるプロバイダ（Groq は n=1 のみ対応）
+PROVIDERS_WITH_N = {"openai"}
+
+# ストリーミングの最後のチャンクで usage を返すよう stream_options を指定できるプロバイダ（Groq は x_groq.usage で返す）
+PROVIDERS_WITH_STREAM_USAGE = {"openai"}
+
+def number_list_end(text: str) -> Optional[int]:
+    """最初の [ から対応する ] までが数字・カンマ・空白・入れ子の括弧だけでできていれば、その直後の位置を返します。"""
+    start = text.find("[")
+    if start < 0:
+        return None
+    depth = 0
+    for position in range(start, len(text)):
+        char = text[position]
+        if char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+            if depth == 0:
+                return position + 1
+        elif not (char.isdigit() or char in ", \t\r\n"):
+            return None
+    return None
+
+# ストリーミング中に応答を打ち切る規則。受け取った文字列から応答の終わりの位置を返し、まだなら None を返す
+STOP_RULES = {
+    "number_list": number_list_end,
+}
+
+class ClientRegistry:
+    """(provider, APIキー) ごとにクライアントを1つだけ作成し、HTTP接続プールを共有します。"""
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0, timeout: float = 600.0, stream: bool = False):
+        # チャット補完をストリーミングで受け取るかどうか
+        self.stream = stream
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=10.0)
+        self._http_client = None
+        self._async_http_client = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def http_client(self) -> httpx.Client:
+        if self._http_client is None:
+            self._http_client = httpx.Client(limits=self.limits, timeout=self.timeout, follow_redirects=True)
+        return self._http_client
+
+    @property
+    def async_http_client(self) -> httpx.AsyncClient:
+        if self._async_http_client is None:
+            self._async_http_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, follow_redirects=True)
+        return self._async_http_client
+
+    def get(self, client_type: str, config: dict, asynchronous: bool = False):
+        if client_type not in CLIENT_CLASSES:
+            raise ValueError(f"Unsupported client type: {client_type}")
+        sync_class, async_class, key_name = CLIENT_CLASSES[client_type]
+        api_key = config[key_name]
+
+        with self._lock:
+            key = (client_type, api_key, asynchronous)
+            if key not in self._clients:
+                # 再試行は models.request_layer で行うため、SDK側の再試行は無効にする
+                if asynchronous:
+                    self._clients[key] = async_class(api_key=api_key, max_retries=0, http_client=self.async_http_client)
+                else:
+                    self._clients[key] = sync_class(api_key=api_key, max_retries=0, http_client=self.http_client)
+            return self._clients[key]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._http_client is not None:
+                self._http_client.close()
+            if self._async_http_client is not None:
+                close_async_http_client(self._async_http_client)
+            self._clients.clear()
+            self._http_client = None
+            self._async_http_client = None
+
+def close_async_http_client(client: httpx.AsyncClient) -> None:
+    """非同期のHTTPクライアントを閉じます。イベントループの中から呼ばれた場合は、そのループで閉じる処理を予約します。"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    try:
+        if loop is None:
+            asyncio.run(client.aclose())
+        else:
+            loop.create_task(client.aclose())
+    except Exception as e:
+        # 接続を作ったイベントループが asyncio.run の終了で既に閉じている場合など。その接続はループと一緒に破棄されている
+        logging.debug(f"Could not close the async HTTP client: {e}")
+
+_registry = ClientRegistry()
+
+def configure_clients(max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0, timeout: float = 600.0, stream: bool = False) -> ClientRegistry:
+    global _registry
+    _registry.close()
+    _registry = ClientRegistry(max_connections, max_keepalive_connections, keepalive_expiry, timeout, stream)
+    return _registry
+
+def add_client_arguments(parser) -> None:
+    parser.add_argument("--max-connections", type=int, default=100, help="Maximum number of pooled HTTP connections shared by all clients")
+    parser.add_argument("--max-keepalive-connections", type=int, default=20, help="Maximum number of idle keep-alive connections")
+    parser.add_argument("--keepalive-expiry", type=float, default=30.0, help="Seconds an idle keep-alive connection is kept open")
+    parser.add_argument("--http-timeout", type=float, default=600.0, help="Default HTTP timeout in seconds for API requests")
+    parser.add_argument("--stream", action="store_true", help="Stream chat completions to measure time to first token and tokens/sec, and stop list answers as soon as they are complete")
+
+def configure_clients_from_args(args) -> ClientRegistry:
+    return configure_clients(args.max_connections, args.max_keepalive_connections, args.keepalive_expiry, args.http_timeout, args.stream)
 
 def get_ai_client(client_type: str, config: dict):
-    if client_type == "openai":
-        return OpenAI(api_key=config['openai_api_key'])
-    elif client_type == "groq":
-        return Groq(api_key=config['groq_api_key'])
+    return _registry.get(client_type, config)
+
+def get_async_ai_client(client_type: str, config: dict):
+    return _registry.get(client_type, config, asynchronous=True)
+
+def client_provider(client) -> str:
+    return type(client).__module__.split('.')[0]
+
+def estimate_tokens(messages: List[Dict], max_tokens: int) -> int:
+    return count_message_tokens(messages) + max_tokens
+
+def read_stream(stream, messages: List[Dict], model: str, sent_at: float, stop_rule: Optional[str] = None):
+    """ストリーミング応答のチャンクを順につなげ、(結果, 計測値) を返します。
+
+    stop_rule（STOP_RULES のキー）が応答の終わりを見つけた時点でストリームを閉じ、その位置までを応答とします。
+    計測値はリクエストの送信（sent_at）から最初のトークンまでの時間（ttft）と、最初のトークン以降の1秒あたりの出力トークン数（tokens_per_second）です。
+    """
+    first_token_at = None
+    parts = []
+    finish_reason = None
+    usage = None
+    stop_position = None
+    try:
+        for chunk in stream:
+            chunk_usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if chunk_usage is not None:
+                usage = chunk_usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta is not None and choice.delta.content:
+                if first_token_at is None:
+                    first_token_at = time.time()
+                parts.append(choice.delta.content)
+                if stop_rule is not None:
+                    stop_position = STOP_RULES[stop_rule]("".join(parts))
+                    if stop_position is not None:
+                        break
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    finally:
+        stream.close()
+    finished_at = time.time()
+
+    content = "".join(parts)
+    if stop_position is not None:
+        content = content[:stop_position]
+        finish_reason = "stop"
+    if usage is not None and stop_position is None:
+        usage = usage_to_dict(usage)
+    else:
+        # 途中で打ち切った場合は usage が返らないため、手元で数える（プロンプトキャッシュの一致数は分からない）
+        usage = {"prompt_tokens": count_message_tokens(messages, model), "completion_tokens": count_tokens(content, model), "cached_tokens": 0}
+
+    timing = {"stopped_early": stop_position is not None}
+    if first_token_at is not None:
+        timing["ttft"] = first_token_at - sent_at
+        if finished_at > first_token_at:
+            timing["tokens_per_second"] = usage["completion_tokens"] / (finished_at - first_token_at)
+    return {"content": content, "finish_reason": finish_reason, "usage": usage}, timing
+
+def create_chat_completion(client, messages: List[Dict], model: str, temperature: float, max_tokens: int, timeout: Optional[float] = None, sample_index: Optional[int] = None, stop_rule: Optional[str] = None, **params) -> Dict:
+    """チャット補完を実行します。応答キャッシュが有効な場合は保存済みの応答を再利用します。
+
+    params（response_format など）はそのままSDKに渡し、キャッシュのキーにも含めます。
+    n を指定した場合は全ての応答を choices に入れて返します。
+    sample_index は同じリクエストを複数回送って別々の応答を得るときにキャッシュのキーを分けるために使います。
+    --stream を指定した場合（n が1のとき）はストリーミングで受け取り、stop_rule があればその規則で応答を打ち切ります。
+    ストリーミングでない場合、stop_rule は使いません。
+    """
+    provider = client_provider(client)
+    tracer = get_tracer()
+    started_at = time.time()
+    num_choices = params.get("n") or 1
+    streaming = _registry.stream and num_choices == 1
+    if not streaming:
+        stop_rule = None
+
+    cache = get_response_cache()
+    if cache is not None:
+        cache_params = dict(params, sample=sample_index) if sample_index is not None else params
+        # 打ち切った応答は全体の応答と異なるため、キャッシュのキーを分ける
+        if stop_rule is not None:
+            cache_params = dict(cache_params, stop_rule=stop_rule)
+        key = cache.make_key(provider, model, messages, temperature, max_tokens, **cache_params)
+        cached = cache.get(key)
+        if cached is not None:
+            if tracer is not None:
+                tracer.record(provider, model, started_at, time.time() - started_at, usage=cached.get("usage"), cached=True)
+            return cached
+
+    request_options = {}
+    if timeout is not None:
+        request_options["timeout"] = timeout
+
+    if streaming:
+        request_options["stream"] = True
+        if provider in PROVIDERS_WITH_STREAM_USAGE:
+            request_options["stream_options"] = {"include_usage": True}
+
+    def send():
+        sent_at = time.time()
+        response = client.chat.completions.create(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **params,
+            **request_options
+        )
+        # ストリームは再試行やヘッジの対象に含めるため、送信と同じ処理の中で最後まで読む
+        return read_stream(response, messages, model, sent_at, stop_rule) if streaming else response
+
+    stats = {}
+    try:
+        chat_completion = get_request_layer().call(provider, model, send, estimate_tokens(messages, max_tokens * num_choices), stats)
+    except Exception as e:
+        if tracer is not None:
+            tracer.record(provider, model, started_at, time.time() - started_at, stats.get("queue_wait", 0.0), stats.get("retries", 0), error=str(e))
+        raise
+    timing = {}
+    if streaming:
+        result, timing = chat_completion
     else:
-        raise ValueError(f"Unsupported client type: {client_type}")
\ No newline at end of file
+        choice = chat_completion.choices[0]
+        result = {"content": choice.message.content, "finish_reason": choice.finish_reason, "usage": usage_to_dict(chat_completion.usage)}
+        if num_choices > 1:
+            # usage はリクエスト全体の値しか返らないため、各応答の出力トークン数は手元で数える。入力は1回分だけ課金されるので最初の応答に付ける
+            result["choices"] = [
+                {
+                    "content": choice.message.content,
+                    "finish_reason": choice.finish_reason,
+                    "usage": {
+                        "prompt_tokens": result["usage"].get("prompt_tokens", 0) if index == 0 else 0,
+                        "completion_tokens": count_tokens(choice.message.content or "", model),
+                        "cached_tokens": result["usage"].get("cached_tokens", 0) if index == 0 else 0,
+                    },
+                }
+                for index, choice in enumerate(chat_completion.choices)
+            ]
+
+    if tracer is not None:
+        tracer.record(provider, model, started_at, time.time() - started_at, stats["queue_wait"], stats["retries"], result["usage"], **timing)
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+def complete_with_continuation(client, messages: List[Dict], model: str, temperature: float, max_tokens: int, timeout: Optional[float] = None, **params) -> Dict:
+    """チャット補完を実行し、max_tokens で切り詰められた場合は設定された回数まで続きを要求してつなげます。
+
+    切り詰めの有無と続きの要求の回数は、トレースのタグのステップごとに記録します。
+    構造化出力（response_format）の応答は途中からつなげられないため、続きは要求しません。
+    """
+    result = create_chat_completion(client, messages, model, temperature, max_tokens, timeout, **params)
+    return continue_truncated(client, messages, model, temperature, max_tokens, result, timeout, **params)
+
+def continue_truncated(client, messages: List[Dict], model: str, temperature: float, max_tokens: int, result: Dict, timeout: Optional[float] = None, **params) -> Dict:
+    """messages に対する応答 result が max_tokens で切り詰められていれば続きを要求してつなげ、切り詰めの有無を記録します。"""
+    budget = get_token_budget()
+    truncated = result.get("finish_reason") == "length"
+    continuations = 0
+    if truncated and budget.max_continuations > 0 and "response_format" not in params:
+        content = result["content"] or ""
+        usage = dict(result.get("usage") or {})
+        while result.get("finish_reason") == "length" and continuations < budget.max_continuations:
+            continuations += 1
+            continuation_messages = messages + [
+                {"role": "assistant", "content": content},
+                {"role": "user", "content": CONTINUATION_PROMPT}
+            ]
+            with trace_tags(continuation=continuations):
+                result = create_chat_completion(client, continuation_messages, model, temperature, max_tokens, timeout, **params)
+            content += result["content"] or ""
+            for key, value in (result.get("usage") or {}).items():
+                usage[key] = usage.get(key, 0) + value
+        result = {"content": content, "finish_reason": result.get("finish_reason"), "usage": usage, "continuations": continuations}
+    budget.record(current_tags().get("step", "-"), truncated, continuations, result.get("finish_reason") == "length")
+    return result
+
+def create_chat_completion_samples(client, messages: List[Dict], model: str, temperature: float, max_tokens: int, samples: int, timeout: Optional[float] = None, **params) -> List[Dict]:
+    """同じメッセージに対する samples 個の応答を、それぞれの content・finish_reason・usage の辞書のリストで返します。
+
+    n パラメータに対応するプロバイダでは1回のリクエストで、それ以外は samples 回のリクエストを並列に送ります。
+    """
+    if samples <= 1:
+        return [create_chat_completion(client, messages, model, temperature, max_tokens, timeout, **params)]
+    if client_provider(client) in PROVIDERS_WITH_N:
+        result = create_chat_completion(client, messages, model, temperature, max_tokens, timeout, n=samples, **params)
+        return result["choices"]
+
+    def run(sample_index):
+        with trace_tags(sample=sample_index):
+            return create_chat_completion(client, messages, model, temperature, max_tokens, timeout, sample_index=sample_index, **params)
+
+    with ThreadPoolExecutor(max_workers=samples) as executor:
+        return list(executor.map(propagate(run), range(samples)))
+
+def complete_samples_with_continuation(client, messages: List[Dict], model: str, temperature: float, max_tokens: int, samples: int, timeout: Optional[float] = None, **params) -> List[Dict]:
+    """samples 個の応答を生成し、complete_with_continuation と同じく、切り詰められた応答ごとに続きを要求して記録します。"""
+    choices = create_chat_completion_samples(client, messages, model, temperature, max_tokens, samples, timeout, **params)
+    completed = []
+    for sample_index, choice in enumerate(choices):
+        with trace_tags(sample=sample_index):
+            completed.append(continue_truncated(client, messages, model, temperature, max_tokens, choice, timeout, **params))
+    return completed
+
+def usage_to_dict(usage) -> Dict:
+    if usage is None:
+        return {}
+    # プロバイダのプロンプトキャッシュに一致した入力トークン数（OpenAI の usage.prompt_tokens_details.cached_tokens）
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+    }
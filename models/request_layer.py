@@ -0,0 +1,203 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError"}
+# 同時に送るヘッジリクエストの上限。これを超える分はヘッジせず、元のリクエストの応答を待つ
+MAX_HEDGES_IN_FLIGHT = 32
+
+class TokenBucket:
+    """1分あたりの上限で補充されるトークンバケットです。容量が足りるまで待機します。"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class RequestLayer:
+    """プロバイダ・モデルごとのレート制限、再試行、ヘッジリクエストをまとめて扱います。"""
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, float]]] = None, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, hedge_after: Optional[float] = None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.retries = 0
+        self._buckets = {}
+        for key, limit in (limits or {}).items():
+            self._buckets[key] = {
+                name: TokenBucket(limit[name]) for name in ("rpm", "tpm") if limit.get(name)
+            }
+        self._lock = threading.Lock()
+        self._hedge_executor = ThreadPoolExecutor(max_workers=MAX_HEDGES_IN_FLIGHT, thread_name_prefix="hedge") if hedge_after else None
+        self._hedge_slots = threading.BoundedSemaphore(MAX_HEDGES_IN_FLIGHT)
+
+    def wait_for_capacity(self, provider: str, model: str, estimated_tokens: int) -> float:
+        """モデル固有の設定があればそれを、なければプロバイダの設定を使って容量を確保します。"""
+        buckets = self._buckets.get(f"{provider}/{model}", self._buckets.get(provider, {}))
+        waited = 0.0
+        if "rpm" in buckets:
+            waited += buckets["rpm"].acquire(1)
+        if "tpm" in buckets:
+            waited += buckets["tpm"].acquire(estimated_tokens)
+        return waited
+
+    def call(self, provider: str, model: str, send: Callable, estimated_tokens: int = 0, stats: Optional[Dict] = None):
+        """send を実行し、一時的なエラーの場合はジッター付き指数バックオフで再試行します。
+
+        stats を渡すと、レート制限による待ち時間（queue_wait）と再試行回数（retries）を記録します。
+        """
+        stats = stats if stats is not None else {}
+        stats.setdefault("queue_wait", 0.0)
+        stats.setdefault("retries", 0)
+        for attempt in range(self.max_retries + 1):
+            stats["queue_wait"] += self.wait_for_capacity(provider, model, estimated_tokens)
+            try:
+                return self._send(provider, model, send, estimated_tokens, stats)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                with self._lock:
+                    self.retries += 1
+                stats["retries"] += 1
+                logging.warning(f"Retrying {provider}/{model} in {delay:.1f}s after error (attempt {attempt + 1}/{self.max_retries}): {e}")
+                time.sleep(delay)
+
+    def close(self) -> None:
+        """ヘッジリクエスト用のスレッドプールを終了します。負けた方のリクエストの完了は待ちません。"""
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False, cancel_futures=True)
+            self._hedge_executor = None
+
+    def _send(self, provider: str, model: str, send: Callable, estimated_tokens: int, stats: Dict):
+        executor = self._hedge_executor
+        if executor is None:
+            return send()
+
+        # 元のリクエストは待ち行列に入れずにすぐ送り、送り始めてから hedge_after 秒以内に応答が返らなければ同じリクエストをもう1つ送る
+        primary = _start_thread(send)
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+
+        # ヘッジが上限まで出ている（全体の応答が遅れている）ときは、これ以上リクエストを増やさない
+        if not self._hedge_slots.acquire(blocking=False):
+            logging.debug(f"Not hedging {provider}/{model}: {MAX_HEDGES_IN_FLIGHT} hedged requests already in flight")
+            return primary.result()
+        try:
+            stats["queue_wait"] += self.wait_for_capacity(provider, model, estimated_tokens)
+            if primary.done():
+                self._hedge_slots.release()
+                return primary.result()
+            logging.info(f"Sending hedged request to {provider}/{model} after {self.hedge_after:.1f}s")
+            hedge = executor.submit(send)
+        except BaseException:
+            self._hedge_slots.release()
+            raise
+        hedge.add_done_callback(lambda _: self._hedge_slots.release())
+
+        # 先に成功した方を使う
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+def _start_thread(send: Callable) -> Future:
+    """send を専用のスレッドですぐに実行し、その結果の Future を返します。"""
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(send())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="request", daemon=True).start()
+    return future
+
+def is_retryable(error: Exception) -> bool:
+    if type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+def parse_rate_limits(values: Optional[List[str]]) -> Dict[str, Dict[str, float]]:
+    """'openai=500,200000' や 'groq/llama3-70b-8192=30,6000' 形式の指定を解析します。
+
+    値は「1分あたりのリクエスト数,1分あたりのトークン数」で、トークン数は省略できます。
+    """
+    limits = {}
+    for value in values or []:
+        if '=' not in value:
+            raise ValueError(f"Invalid rate limit (expected provider[/model]=rpm[,tpm]): {value}")
+        key, spec = value.split('=', 1)
+        parts = spec.split(',')
+        limit = {"rpm": float(parts[0]) if parts[0] else None}
+        if len(parts) > 1 and parts[1]:
+            limit["tpm"] = float(parts[1])
+        limits[key.strip()] = limit
+    return limits
+
+_request_layer = RequestLayer()
+
+def get_request_layer() -> RequestLayer:
+    return _request_layer
+
+def configure_request_layer(limits: Optional[Dict[str, Dict[str, float]]] = None, max_retries: int = 5, hedge_after: Optional[float] = None) -> RequestLayer:
+    global _request_layer
+    _request_layer.close()
+    _request_layer = RequestLayer(limits, max_retries=max_retries, hedge_after=hedge_after)
+    return _request_layer
+
+def add_request_arguments(parser) -> None:
+    parser.add_argument("--rate-limits", nargs='*', default=[], help="Requests/tokens per minute per provider or provider/model (e.g., 'openai=500,200000 groq/llama3-70b-8192=30,6000')")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries for rate-limited or failed requests")
+    parser.add_argument("--hedge-after", type=float, default=None, help=f"Send a duplicate request if no response arrives within this many seconds of sending (at most {MAX_HEDGES_IN_FLIGHT} duplicates in flight at once)")
+
+def configure_requests_from_args(args) -> RequestLayer:
+    return configure_request_layer(parse_rate_limits(args.rate_limits), args.max_retries, args.hedge_after)
@@ -0,0 +1,129 @@
+import argparse
+import logging
+import subprocess
+import sys
+import os
+
+# プロジェクトのルートディレクトリをシステムパスに追加
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from utils.logging_config import setup_logging
+from utils.dedup import DEFAULT_DEDUP_THRESHOLD, resolve_duplicates, select_aliases
+from utils.sharding import iter_reference_items, make_item_filter, merge_shard_outputs, parse_id_range, shard_output_path
+
+# シャードごとに別のファイルにする必要があるパスのオプション
+PER_SHARD_PATH_OPTIONS = ["--output", "--checkpoint", "--trace", "--batch-state", "--batch-requests"]
+
+def find_option(argv: list, name: str):
+    """argv 中のオプションの (位置, 値のリスト) を返します。見つからなければ (None, []) を返します。"""
+    for position, token in enumerate(argv):
+        if token == name:
+            values = []
+            for value in argv[position + 1:]:
+                if value.startswith("--"):
+                    break
+                values.append(value)
+            return position, values
+        if token.startswith(name + "="):
+            return position, [token.split("=", 1)[1]]
+    return None, []
+
+def replace_option(argv: list, name: str, values: list) -> list:
+    position, old_values = find_option(argv, name)
+    if position is None:
+        return argv + [name] + values
+    length = 1 if "=" in argv[position] else 1 + len(old_values)
+    return argv[:position] + [name] + values + argv[position + length:]
+
+def split_rate_limits(values: list, count: int) -> list:
+    """'openai=500,200000' のような上限を各シャードに均等に割り振ります。"""
+    split = []
+    for value in values:
+        key, spec = value.split("=", 1)
+        parts = [f"{float(part) / count:g}" if part else "" for part in spec.split(",")]
+        split.append(f"{key}={','.join(parts)}")
+    return split
+
+def build_shard_command(script: str, script_args: list, index: int, count: int) -> list:
+    argv = list(script_args)
+    for name in PER_SHARD_PATH_OPTIONS:
+        position, values = find_option(argv, name)
+        if position is not None and values:
+            argv = replace_option(argv, name, [shard_output_path(values[0], index, count)])
+    position, values = find_option(argv, "--rate-limits")
+    if position is not None and values:
+        argv = replace_option(argv, "--rate-limits", split_rate_limits(values, count))
+    return [sys.executable, script] + replace_option(argv, "--shard", [f"{index}/{count}"])
+
+def prepare_duplicates(script_args: list, input_path: str, output_path: str):
+    """--dedup が有効な場合、入力全体の重複の対応を1回だけ作って保存し、(設定, 重複の対応, 全シャードに渡す引数) を返します。
+
+    全てのシャードが同じ対応を読み込み、重複した項目を代表と同じシャードで処理します。
+    """
+    _, dedup_values = find_option(script_args, "--dedup")
+    _, threshold_values = find_option(script_args, "--dedup-threshold")
+    _, map_values = find_option(script_args, "--dedup-map")
+    dedup_args = argparse.Namespace(
+        dedup=dedup_values[0] if dedup_values else "off",
+        dedup_threshold=float(threshold_values[0]) if threshold_values else DEFAULT_DEDUP_THRESHOLD,
+        dedup_map=map_values[0] if map_values else f"{output_path}.dedup.json",
+    )
+    if dedup_args.dedup == "off":
+        return dedup_args, {}, script_args
+    duplicates = resolve_duplicates(dedup_args, lambda: iter_reference_items(input_path))
+    return dedup_args, duplicates, replace_option(script_args, "--dedup-map", [dedup_args.dedup_map])
+
+def main():
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Run generate.py or evaluate.py as N local shard processes and merge their outputs")
+    parser.add_argument("--shards", type=int, required=True, help="Number of shard processes to run")
+    parser.add_argument("--no-merge", action="store_true", help="Leave the shard outputs without merging them")
+    parser.add_argument("script", type=str, help="Script to run (e.g., generate/generate.py)")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments passed to every shard; --output, --checkpoint and --trace get a per-shard suffix, --rate-limits is split across shards and --dedup uses one duplicate map computed before the shards start")
+    args = parser.parse_args()
+
+    _, input_values = find_option(args.script_args, "--input")
+    _, output_values = find_option(args.script_args, "--output")
+    if not input_values or not output_values:
+        parser.error("the script arguments must include --input and --output")
+    output_path = output_values[0]
+    dedup_args, duplicates, script_args = prepare_duplicates(args.script_args, input_values[0], output_path)
+
+    processes = []
+    for index in range(args.shards):
+        command = build_shard_command(args.script, script_args, index, args.shards)
+        log_path = f"{shard_output_path(output_path, index, args.shards)}.log"
+        log_file = open(log_path, 'w', encoding='utf-8')
+        processes.append((index, subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT), log_file, log_path))
+        logging.info(f"Started shard {index}/{args.shards} (log: {log_path})")
+
+    failed = []
+    for index, process, log_file, log_path in processes:
+        returncode = process.wait()
+        log_file.close()
+        if returncode != 0:
+            failed.append(index)
+            logging.error(f"Shard {index}/{args.shards} failed with exit code {returncode}; see {log_path}")
+        else:
+            logging.info(f"Shard {index}/{args.shards} finished")
+    if failed:
+        sys.exit(1)
+
+    shard_paths = [shard_output_path(output_path, index, args.shards) for index in range(args.shards)]
+    if args.no_merge:
+        print(f"Shard outputs written to {', '.join(shard_paths)}")
+        return
+
+    _, id_range_values = find_option(args.script_args, "--id-range")
+    is_selected = make_item_filter(parse_id_range(id_range_values[0] if id_range_values else None))
+    # --dedup skip で出力されない重複は、見つからなかった項目に数えない
+    skipped = select_aliases(duplicates, is_selected) if dedup_args.dedup == "skip" else {}
+    missing, unexpected = merge_shard_outputs(shard_paths, iter_reference_items(input_values[0]), output_path, is_selected, skipped)
+    print(f"Merged {args.shards} shard outputs into {output_path}")
+    if missing or unexpected:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import argparse
+import sys
+import os
+
+# プロジェクトのルートディレクトリをシステムパスに追加
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from utils.logging_config import setup_logging
+from utils.dedup import add_dedup_arguments, resolve_duplicates, select_aliases
+from utils.sharding import iter_reference_items, make_item_filter, merge_shard_outputs, parse_id_range
+
+def main():
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Merge shard outputs of generate.py or evaluate.py into one ordered file")
+    parser.add_argument("--inputs", nargs='+', required=True, help="Shard output files to merge")
+    parser.add_argument("--reference", type=str, required=True, help="File whose item order the merged output follows (the --input given to the shards)")
+    parser.add_argument("--output", type=str, required=True, help="Path to the merged JSON or JSONL file")
+    parser.add_argument("--id-range", type=str, help="ID range the shards were run with, if any (e.g., '1-3' or '2,4,6')")
+    add_dedup_arguments(parser)
+    args = parser.parse_args()
+
+    is_selected = make_item_filter(parse_id_range(args.id_range))
+    # シャードを --dedup skip で実行した場合は、同じ重複の対応（--dedup-map）で出力されない重複を除いて確かめる
+    duplicates = resolve_duplicates(args, lambda: iter_reference_items(args.reference))
+    skipped = select_aliases(duplicates, is_selected) if args.dedup == "skip" else {}
+    missing, unexpected = merge_shard_outputs(args.inputs, iter_reference_items(args.reference), args.output, is_selected, skipped)
+    print(f"Merged {len(args.inputs)} shard outputs into {args.output}")
+    if missing or unexpected:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#!/bin/bash
+
+set -e
+
+# ===============================
+# 変数の設定
+# ===============================
+
+# 起動するシャード（プロセス）の数
+SHARDS=4
+
+# 使用するAIモデル
+MODELS="mini gpt llama"
+
+# 使用する条件
+CONDITIONS="x1 x2 x3 x4"
+
+# 入力ファイルと出力ファイル（シャードの出力は out.shard-k-of-N.json に書き出され、最後に出力ファイルへまとめられる）
+INPUT_FILE="input.json"
+OUTPUT_FILE="generated_counterarguments.json"
+
+# 1分あたりのリクエスト数・トークン数の上限（全シャードの合計。各シャードには均等に割り振られる）
+RATE_LIMITS="openai=500,200000 groq=30,6000"
+
+# ===============================
+# スクリプトの実行
+# ===============================
+
+# 生成をシャードに分けて並列に実行し、結果をまとめる
+python3 shard/launch.py --shards "$SHARDS" generate/generate.py \
+  --models $MODELS \
+  --temperature 0.7 \
+  --max-tokens 1500 \
+  --conditions $CONDITIONS \
+  --input "$INPUT_FILE" \
+  --output "$OUTPUT_FILE" \
+  --concurrency 4 \
+  --rate-limits $RATE_LIMITS
+
+# 別々のマシンで --shard k/N を指定して実行した場合は、出力を集めてから次のようにまとめる
+# python3 shard/merge.py --inputs generated_counterarguments.shard-*-of-4.json --reference "$INPUT_FILE" --output "$OUTPUT_FILE"
+# （--dedup skip で実行した場合は、全シャードで同じ --dedup-map を使い、まとめる際にも --dedup skip --dedup-map <同じファイル> を指定する）
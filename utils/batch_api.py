@@ -0,0 +1,120 @@
+import argparse
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Tuple
+
+from utils.file_handlers import read_jsonl
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+def make_custom_id(*parts) -> str:
+    """(id, model, condition, step) などから安定した custom_id を作ります。"""
+    return "|".join(str(part) for part in parts)
+
+def make_batch_request(custom_id: str, model: str, messages: List[Dict], temperature: float, max_tokens: int) -> Dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": CHAT_COMPLETIONS_URL,
+        "body": {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        },
+    }
+
+def batch_group_key(provider: str, model: str) -> str:
+    """バッチ入力ファイルの単位（プロバイダとモデルの組）を表すキーです。"""
+    return f"{provider}/{model}"
+
+def batch_group_path(file_path: str, provider: str, model: str) -> str:
+    root, ext = os.path.splitext(file_path)
+    # モデル名に含まれる "/" などはファイル名に使えないため置き換える
+    model_part = re.sub(r"[^\w.-]", "_", model)
+    return f"{root}.{provider}.{model_part}{ext or '.jsonl'}"
+
+def write_batch_requests(file_path: str, requests_by_group: Dict[Tuple[str, str], List[Dict]]) -> Dict[str, str]:
+    """(プロバイダ, モデル) ごとのバッチ入力ファイル（<file_path>.<provider>.<model>.jsonl）を書き出します。
+
+    OpenAI のバッチAPIは1つの入力ファイルに1つのモデルしか受け付けないため、モデルごとにファイルを分けます。
+    書き出したファイルを {batch_group_key: パス} で返します。
+    """
+    written = {}
+    for (provider, model), requests in requests_by_group.items():
+        if not requests:
+            continue
+        path = batch_group_path(file_path, provider, model)
+        with open(path, 'w', encoding='utf-8') as f:
+            for request in requests:
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+        logging.info(f"Wrote {len(requests)} batch requests for {provider}/{model} to {path}")
+        written[batch_group_key(provider, model)] = path
+    return written
+
+def log_missing_results(state: Dict, missing: Dict[str, int]) -> None:
+    """結果のなかったリクエストの件数を、書き出したバッチ入力ファイル（state の batch_files）ごとに警告します。"""
+    files = state.get("batch_files", {})
+    for group_key, count in missing.items():
+        logging.warning(f"No batch results for {count} requests to {group_key} (exported to {files.get(group_key, 'an unknown file')}); they will be exported again")
+
+def read_batch_results(file_paths: List[str]) -> Dict[str, str]:
+    """バッチ結果ファイルを読み込み、custom_id から応答本文への辞書を返します。失敗したリクエストは含めません。"""
+    results = {}
+    for file_path in file_paths:
+        for record in read_jsonl(file_path):
+            custom_id = record.get('custom_id')
+            response = record.get('response') or {}
+            if record.get('error') or response.get('status_code', 200) != 200:
+                logging.warning(f"Batch request {custom_id} failed: {record.get('error') or response.get('body')}")
+                continue
+            try:
+                results[custom_id] = response['body']['choices'][0]['message']['content']
+            except (KeyError, IndexError, TypeError):
+                logging.warning(f"Batch result for {custom_id} has no message content")
+    return results
+
+def write_stub_results(requests_path: str, results_path: str) -> None:
+    """バッチ入力ファイルに対する決定的なダミーの結果ファイルを作成します（ローカルでの動作確認用）。"""
+    with open(results_path, 'w', encoding='utf-8') as out:
+        for index, request in enumerate(read_jsonl(requests_path)):
+            last_message = request['body']['messages'][-1]['content']
+            if "Python list" in last_message:
+                content = "[1, 2, 3, 4, 5, 6, 7]"
+            else:
+                content = f"[stub] {request['custom_id']}"
+            out.write(json.dumps({
+                "id": f"batch_req_{index}",
+                "custom_id": request['custom_id'],
+                "response": {
+                    "status_code": 200,
+                    "request_id": f"stub_{index}",
+                    "body": {
+                        "object": "chat.completion",
+                        "model": request['body']['model'],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    },
+                },
+                "error": None,
+            }, ensure_ascii=False) + "\n")
+
+def load_batch_state(file_path: str):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_batch_state(file_path: str, state: Dict) -> None:
+    temporary_path = f"{file_path}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temporary_path, file_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a stub batch results file for local testing")
+    parser.add_argument("requests", type=str, help="Path to a batch requests JSONL file")
+    parser.add_argument("results", type=str, help="Path to write the stub results JSONL file")
+    args = parser.parse_args()
+    write_stub_results(args.requests, args.results)
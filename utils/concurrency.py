@@ -0,0 +1,53 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+def parse_provider_limits(values: Optional[List[str]]) -> Dict[str, int]:
+    """'openai=8 groq=4' 形式の指定をプロバイダごとの上限に変換します。"""
+    limits = {}
+    for value in values or []:
+        if '=' not in value:
+            raise ValueError(f"Invalid provider limit (expected provider=N): {value}")
+        provider, limit = value.split('=', 1)
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError(f"Provider limit must be positive: {value}")
+        limits[provider.strip()] = limit
+    return limits
+
+class ProviderLimiter:
+    """プロバイダごとの同時リクエスト数を制限します。"""
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None):
+        self._semaphores = {provider: threading.BoundedSemaphore(limit) for provider, limit in (limits or {}).items()}
+
+    @contextmanager
+    def slot(self, provider: str):
+        semaphore = self._semaphores.get(provider)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+def ordered_map(fn: Callable, items: Iterable, max_workers: int = 1, max_pending: Optional[int] = None) -> Iterator:
+    """fn を並列に適用し、結果を入力と同じ順序で返します。
+
+    実行中のタスク数は max_pending（既定は max_workers の2倍）までに抑えます。
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    max_pending = max_pending or max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
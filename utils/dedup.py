@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+import zlib
+from itertools import chain
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+DEDUP_MODES = ["off", "skip", "alias"]
+DEFAULT_DEDUP_THRESHOLD = 0.8
+
+# 主張を単語の3-gram（shingle）の集合として MinHash で比べる
+SHINGLE_SIZE = 3
+NUM_PERMUTATIONS = 64
+# LSH のバンド数と1バンドの行数（16 × 4 = 64）。Jaccard 係数が約 0.5 以上の組が候補になりやすい
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+
+# shingle がない（主張が空の）場合の署名の値
+_EMPTY = np.uint32(0xFFFFFFFF)
+
+def _random_odd_uint64(random_state, shape) -> np.ndarray:
+    return random_state.randint(0, 1 << 62, size=shape, dtype=np.int64).astype(np.uint64) * np.uint64(4) + np.uint64(1)
+
+_random = np.random.RandomState(0)
+# 置換 (a * x + b) の上位32ビット（multiply-shift）の係数と、単語のハッシュから shingle のハッシュを作る係数。
+# プロセスやマシンが変わっても同じ値になるよう固定の乱数から作る。64ビットの掛け算の桁あふれはそのまま捨てる
+_PERMUTATION_A = _random_odd_uint64(_random, (NUM_PERMUTATIONS, 1))
+_PERMUTATION_B = _random_odd_uint64(_random, (NUM_PERMUTATIONS, 1))
+_SHINGLE_WEIGHTS = _random_odd_uint64(_random, SHINGLE_SIZE)
+_BAND_WEIGHTS = _random_odd_uint64(_random, LSH_ROWS)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+def normalize_words(text: str) -> List[str]:
+    """Unicode 正規化・小文字化し、句読点と空白の違いを無視した単語の列にします。"""
+    return WORD_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold())
+
+# MinHash 署名はこの件数ずつまとめて計算する
+SIGNATURE_CHUNK_SIZE = 512
+
+def minhash_signatures(word_lists: List[List[str]], word_hashes: Dict[str, int]) -> np.ndarray:
+    """単語の列ごとの shingle 集合の MinHash 署名を (件数, NUM_PERMUTATIONS) の配列で返します。
+
+    全ての列の shingle をつなげて一度に置換し、列ごとの最小値を取ります。
+    SHINGLE_SIZE より短い列は全単語を1つの shingle とし、空の列の署名は全て _EMPTY になります。
+    word_hashes は単語のハッシュのキャッシュで、呼び出しの間で使い回します。
+    """
+    lengths = np.fromiter((len(words) for words in word_lists), dtype=np.int64, count=len(word_lists))
+    signatures = np.full((len(word_lists), NUM_PERMUTATIONS), _EMPTY, dtype=np.uint32)
+    total = int(lengths.sum())
+    if total == 0:
+        return signatures
+    all_words = list(chain.from_iterable(word_lists))
+    for word in set(all_words).difference(word_hashes):
+        word_hashes[word] = zlib.crc32(word.encode("utf-8"))
+    hashes = np.concatenate([np.fromiter(map(word_hashes.__getitem__, all_words), dtype=np.uint64, count=total), np.zeros(SHINGLE_SIZE - 1, dtype=np.uint64)])
+
+    # 各位置から列の終わりまでの単語数。列の終わりをまたぐ単語は shingle に含めない
+    ends = np.cumsum(lengths)
+    item_indices = np.repeat(np.arange(len(word_lists)), lengths)
+    remaining = ends[item_indices] - np.arange(total)
+    shingles = np.zeros(total, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        shingles += hashes[offset:offset + total] * _SHINGLE_WEIGHTS[offset] * (remaining > offset)
+    starts = ends - lengths
+    valid = remaining >= SHINGLE_SIZE
+    valid[starts[(lengths > 0) & (lengths < SHINGLE_SIZE)]] = True
+
+    permuted = _PERMUTATION_A * shingles[valid]
+    permuted += _PERMUTATION_B
+    permuted >>= np.uint64(32)
+    valid_items = item_indices[valid]
+    present = np.unique(valid_items)
+    signatures[present] = np.minimum.reduceat(permuted, np.searchsorted(valid_items, present), axis=1).T
+    return signatures
+
+def band_keys(signatures: np.ndarray, topic_keys: np.ndarray) -> np.ndarray:
+    """署名をバンドに分けたハッシュを (件数, LSH_BANDS) の配列で返します。トピックが異なる入力は同じバケットに入りません。"""
+    bands = signatures.astype(np.uint64).reshape(len(signatures), LSH_BANDS, LSH_ROWS)
+    return (bands * _BAND_WEIGHTS).sum(axis=2) + topic_keys[:, None]
+
+def estimate_similarity(first: np.ndarray, second: np.ndarray) -> float:
+    """2つの署名から shingle 集合の Jaccard 係数を推定します。"""
+    return float(np.mean(first == second))
+
+def find_duplicates(items: Iterable[Dict], threshold: float = DEFAULT_DEDUP_THRESHOLD) -> Dict:
+    """入力の重複を探し、{重複した項目のID: 代表の項目のID} を返します。
+
+    正規化したトピックと主張が一致する項目と、トピックが一致し主張の推定 Jaccard 係数が threshold 以上の項目を重複とします。
+    代表は入力の順で最初に現れた項目です。LSH で同じバケットに入った代表とだけ比べるため、全ての組は比べません。
+    重複どうしは比べないので、A と B、B と C が似ていても A と C が似ていなければ C は別の代表になります。
+    """
+    started_at = time.time()
+    state = {"exact": {}, "buckets": [{} for _ in range(LSH_BANDS)], "canonical_ids": [], "signatures": [], "word_hashes": {}}
+    duplicates = {}
+    count = 0
+    chunk = []
+    for item in items:
+        count += 1
+        topic_words = normalize_words(item['topic'])
+        context_words = normalize_words(item['context'])
+        # 正規化したトピックと主張が一致する（表記の揺れだけが異なる）入力はハッシュで見つける
+        key = hashlib.sha256((" ".join(topic_words) + "\n" + " ".join(context_words)).encode("utf-8")).hexdigest()
+        if key in state["exact"]:
+            duplicates[item['id']] = state["exact"][key]
+            continue
+        state["exact"][key] = item['id']
+        chunk.append((item['id'], topic_words, context_words))
+        if len(chunk) >= SIGNATURE_CHUNK_SIZE:
+            _cluster_chunk(chunk, state, duplicates, threshold)
+            chunk = []
+    if chunk:
+        _cluster_chunk(chunk, state, duplicates, threshold)
+
+    exact_count = count - len(state["exact"])
+    logging.info(f"Found {exact_count} exact and {len(duplicates) - exact_count} near duplicates among {count} input items in {time.time() - started_at:.1f}s")
+    return duplicates
+
+def _cluster_chunk(chunk: List, state: Dict, duplicates: Dict, threshold: float) -> None:
+    """署名を計算した項目を入力の順に、似た代表があればその重複に、なければ新しい代表にします。"""
+    signatures = minhash_signatures([context_words for _, _, context_words in chunk], state["word_hashes"])
+    topic_keys = np.fromiter((zlib.crc32(" ".join(topic_words).encode("utf-8")) for _, topic_words, _ in chunk), dtype=np.uint64, count=len(chunk))
+    for (item_id, _, _), signature, keys in zip(chunk, signatures, band_keys(signatures, topic_keys).tolist()):
+        canonical_index = _find_similar(signature, keys, state, threshold)
+        if canonical_index is not None:
+            duplicates[item_id] = state["canonical_ids"][canonical_index]
+            continue
+        canonical_index = len(state["canonical_ids"])
+        state["canonical_ids"].append(item_id)
+        state["signatures"].append(signature)
+        for bucket, band_key in zip(state["buckets"], keys):
+            bucket.setdefault(band_key, []).append(canonical_index)
+
+def _find_similar(signature: np.ndarray, keys: List[int], state: Dict, threshold: float) -> Optional[int]:
+    """同じバケットに入った代表のうち、推定 Jaccard 係数が threshold 以上で最も似ているものの番号を返します。"""
+    best_index, best_similarity = None, 0.0
+    checked = set()
+    for bucket, band_key in zip(state["buckets"], keys):
+        for candidate_index in bucket.get(band_key, ()):
+            if candidate_index in checked:
+                continue
+            checked.add(candidate_index)
+            similarity = estimate_similarity(signature, state["signatures"][candidate_index])
+            if similarity >= threshold and similarity > best_similarity:
+                best_index, best_similarity = candidate_index, similarity
+    return best_index
+
+def save_duplicates(file_path: str, duplicates: Dict, threshold: float) -> None:
+    """重複の対応を保存します。JSON のキーは文字列になるため、IDの型が変わらないよう組のリストで保存します。"""
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"threshold": threshold, "duplicates": list(duplicates.items())}, f, ensure_ascii=False)
+        os.replace(temp_path, file_path)
+    except OSError as e:
+        logging.warning(f"Could not save the duplicate map to {file_path}: {e}")
+
+def load_duplicates(file_path: str, threshold: float) -> Optional[Dict]:
+    """保存した重複の対応を読み込みます。ファイルがないか、しきい値が異なる場合は None を返します。"""
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning(f"Ignoring unreadable duplicate map {file_path}: {e}")
+        return None
+    if data.get("threshold") != threshold:
+        logging.info(f"Duplicate map {file_path} was built with threshold {data.get('threshold')}; rebuilding")
+        return None
+    logging.info(f"Duplicate map {file_path}: reusing {len(data['duplicates'])} duplicates")
+    return {item_id: canonical_id for item_id, canonical_id in data["duplicates"]}
+
+def resolve_duplicates(args, iter_input: Callable[[], Iterable[Dict]]) -> Dict:
+    """--dedup が有効な場合、入力全体の {重複した項目のID: 代表の項目のID} を返します。
+
+    --dedup-map のファイルがあれば読み込み、なければ入力全体から探して保存します。
+    シャードに分けて実行する場合は shard/launch.py が先に1回だけ作り、全てのシャードとまとめる処理で同じ対応を使います。
+    """
+    if args.dedup == "off":
+        return {}
+    if args.dedup_map:
+        duplicates = load_duplicates(args.dedup_map, args.dedup_threshold)
+        if duplicates is not None:
+            return duplicates
+    duplicates = find_duplicates(iter_input(), args.dedup_threshold)
+    if args.dedup_map:
+        save_duplicates(args.dedup_map, duplicates, args.dedup_threshold)
+    return duplicates
+
+def select_aliases(duplicates: Dict, is_selected: Callable) -> Dict:
+    """重複した項目と代表の項目がどちらも処理される場合だけ、生成を省いて代表の結果を使う {ID: 代表のID} を返します。
+
+    代表が処理されない（ID範囲の外の）項目は、重複していても生成します。
+    """
+    return {item_id: canonical_id for item_id, canonical_id in duplicates.items() if is_selected(item_id) and is_selected(canonical_id)}
+
+def add_dedup_arguments(parser) -> None:
+    parser.add_argument("--dedup", choices=DEDUP_MODES, default="off", help="Detect exact and near-duplicate inputs (same topic, similar argument) and 'skip' them or 'alias' the canonical item's results to them in the output")
+    parser.add_argument("--dedup-threshold", type=float, default=DEFAULT_DEDUP_THRESHOLD, help="Estimated Jaccard similarity of argument word 3-grams at or above which two inputs with the same topic are near duplicates")
+    parser.add_argument("--dedup-map", type=str, help="Path to the duplicate map of the whole input; read if it exists, otherwise computed and written (shard/launch.py passes one shared map to every shard)")
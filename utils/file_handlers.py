@@ -1,5 +1,7 @@
 import json
 import logging
+import os
+import threading
 
 def load_prompts(file_path: str) -> dict:
     try:
@@ -24,3 +26,199 @@ def load_evaluation_prompts(file_path: str) -> dict:
     except Exception as e:
         logging.error(f"Error loading evaluation prompts from {file_path}: {e}")
         raise
+
+class JsonlSink:
+    """結果を1行1レコードで追記するスレッドセーフなJSONLファイルです。"""
+
+    def __init__(self, file_path: str, resume: bool = False):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._file = open(file_path, 'a' if resume else 'w', encoding='utf-8')
+        if resume and self._file.tell() > 0:
+            # 中断時に途中まで書かれた行と次のレコードが連結されないようにする
+            with open(file_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_jsonl(file_path: str):
+    """JSONLファイルを1レコードずつ読み込みます。途中で書き込みが中断された最終行は無視します。"""
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Ignoring incomplete record at {file_path}:{line_number}")
+
+def is_jsonl_path(file_path: str) -> bool:
+    return file_path.endswith(".jsonl")
+
+def iter_json_array(file_path: str, chunk_size: int = 1 << 16):
+    """トップレベルが配列のJSONファイルを、全体を読み込まずに1要素ずつ読み込みます。"""
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size)
+        eof = not buffer
+        position = _skip_whitespace(buffer, 0)
+        if position >= len(buffer) or buffer[position] != "[":
+            raise ValueError(f"{file_path} does not contain a JSON array")
+        position += 1
+        expect_value = True
+        while True:
+            position = _skip_whitespace(buffer, position)
+            if position >= len(buffer):
+                if eof:
+                    raise ValueError(f"Unexpected end of JSON array in {file_path}")
+                buffer, position, eof = _read_more(f, buffer, position, chunk_size)
+                continue
+            if buffer[position] == "]":
+                return
+            if buffer[position] == ",":
+                if expect_value:
+                    raise ValueError(f"Unexpected ',' in JSON array in {file_path}")
+                expect_value = True
+                position += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                buffer, position, eof = _read_more(f, buffer, position, chunk_size)
+                continue
+            following = _skip_whitespace(buffer, end)
+            if following >= len(buffer) or buffer[following] not in ",]":
+                # 数値などはバッファの末尾で途切れている可能性があるので、続きを読んでから確定する
+                if not eof:
+                    buffer, position, eof = _read_more(f, buffer, position, chunk_size)
+                    continue
+                if following < len(buffer):
+                    raise ValueError(f"Unexpected {buffer[following]!r} in JSON array in {file_path}")
+            yield item
+            position = end
+            expect_value = False
+
+def _skip_whitespace(buffer: str, position: int) -> int:
+    while position < len(buffer) and buffer[position] in " \t\r\n":
+        position += 1
+    return position
+
+def _read_more(f, buffer: str, position: int, chunk_size: int):
+    # 読み終えた部分を捨て、大きな要素でも読み直しが線形に収まるよう倍々に読み足す
+    buffer = buffer[position:]
+    chunk = f.read(max(chunk_size, len(buffer)))
+    return buffer + chunk, 0, not chunk
+
+def iter_items(file_path: str):
+    """JSON配列または JSONL のファイルを1件ずつ読み込みます（拡張子 .jsonl で判定）。"""
+    if not is_jsonl_path(file_path):
+        yield from iter_json_array(file_path)
+        return
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON at {file_path}:{line_number}: {e}") from e
+
+class ItemWriter:
+    """1件ずつ書き出すライターです。.jsonl なら1行1件、それ以外は json.dump(indent=2) と同じ形式の配列で書きます。
+
+    一時ファイルに書き込み、close 時に置き換えるため、入力と同じパスにも書き出せます。
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.count = 0
+        self._jsonl = is_jsonl_path(file_path)
+        self._temp_path = f"{file_path}.tmp"
+        self._file = open(self._temp_path, 'w', encoding='utf-8')
+
+    def write(self, item) -> None:
+        if self._jsonl:
+            self._file.write(json.dumps(item, ensure_ascii=False) + "\n")
+        else:
+            text = json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+            self._file.write(("[\n  " if self.count == 0 else ",\n  ") + text)
+        self.count += 1
+
+    def close(self) -> None:
+        if not self._jsonl:
+            self._file.write("\n]" if self.count else "[]")
+        self._file.close()
+        os.replace(self._temp_path, self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._temp_path)
+
+def write_items(file_path: str, items) -> int:
+    with ItemWriter(file_path) as writer:
+        for item in items:
+            writer.write(item)
+    return writer.count
+
+class JsonlIndex:
+    """JSONLファイルのキーごとの最新レコードの位置だけを保持し、必要なときにそのレコードを読み込みます。"""
+
+    def __init__(self, file_path: str, key):
+        self.offsets = {}
+        self._file = open(file_path, 'rb') if os.path.exists(file_path) else None
+        if self._file is None:
+            return
+        offset = 0
+        for line_number, line in enumerate(self._file, start=1):
+            if line.strip():
+                try:
+                    self.offsets[key(json.loads(line))] = offset
+                except json.JSONDecodeError:
+                    logging.warning(f"Ignoring incomplete record at {file_path}:{line_number}")
+            offset += len(line)
+
+    def __contains__(self, key) -> bool:
+        return key in self.offsets
+
+    def get(self, key):
+        if key not in self.offsets:
+            return None
+        self._file.seek(self.offsets[key])
+        return json.loads(self._file.readline())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
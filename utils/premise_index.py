@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Dict, Iterable, List, Optional
+
+# 文分割の規則を変えたら上げる。版が異なる索引は読み込まずに作り直す
+SEGMENTER_VERSION = 1
+
+# 文末の句点として扱わない略語（小文字、末尾のピリオドなし）
+ABBREVIATIONS = {
+    "e.g", "i.e", "etc", "vs", "cf", "al", "approx", "ca", "fig", "no", "vol", "pp",
+    "mr", "mrs", "ms", "dr", "prof", "st", "jr", "sr", "inc", "ltd", "co", "corp",
+    "u.s", "u.k", "u.n", "e.u", "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+}
+# 句読点（と閉じ括弧・引用符）の後に空白が続く位置、または全角の句点の後を文の区切りの候補とする
+SENTENCE_END_PATTERN = re.compile(r"[.!?]+[\"'”’)\]]*(?=\s)|[。！？]+[」』）]*")
+WORD_BEFORE_PATTERN = re.compile(r"([A-Za-z][A-Za-z.]*)\.$")
+
+def split_sentences(text: str) -> List[str]:
+    """主張を文に分割します。小数点・略語・イニシャルのピリオドや、小文字で続く位置では区切りません。"""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        end = match.end()
+        if match.group().startswith(".") and _is_abbreviation(text[start:match.start() + 1]):
+            continue
+        following = text[end:].lstrip()
+        if following[:1].islower():
+            continue
+        sentences.append(text[start:end])
+        start = end
+    sentences.append(text[start:])
+    return [sentence for sentence in (_clean_sentence(sentence) for sentence in sentences) if sentence]
+
+def _is_abbreviation(text: str) -> bool:
+    match = WORD_BEFORE_PATTERN.search(text)
+    if match is None:
+        return False
+    word = match.group(1)
+    # "J. K. Rowling" のような1文字のイニシャル
+    if len(word) == 1 and word.isupper():
+        return True
+    return word.lower().rstrip(".") in ABBREVIATIONS
+
+def _clean_sentence(sentence: str) -> str:
+    # 従来の split(".") と同じく文末のピリオドは含めない（疑問符・感嘆符は残す）
+    return sentence.strip().rstrip(".").strip()
+
+def format_premise_list(sentences: List[str]) -> str:
+    return "\n".join(f"\"{sentence}\"" for sentence in sentences)
+
+def argument_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class PremiseIndex:
+    """主張のテキストのハッシュから文分割済みの前提を引く索引です。索引にない主張はその場で分割して追加します。"""
+
+    def __init__(self, premises: Optional[Dict[str, List[str]]] = None):
+        self.premises = premises or {}
+        self.added = 0
+
+    def sentences(self, text: str) -> List[str]:
+        key = argument_key(text)
+        sentences = self.premises.get(key)
+        if sentences is None:
+            sentences = split_sentences(text)
+            self.premises[key] = sentences
+            self.added += 1
+        return sentences
+
+    def save(self, file_path: str) -> bool:
+        """索引を保存します。書き込めない場合（入力のディレクトリが読み取り専用など）は警告だけを出して False を返します。"""
+        # シャードを並列に実行した場合に一時ファイルが衝突しないよう、プロセスごとに分ける
+        temp_path = f"{file_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": SEGMENTER_VERSION, "premises": self.premises}, f, ensure_ascii=False)
+            os.replace(temp_path, file_path)
+        except OSError as e:
+            logging.warning(f"Could not save the premise index to {file_path} ({e}); continuing with the in-memory index (use --premise-index to choose a writable path)")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        self.added = 0
+        return True
+
+    @classmethod
+    def load(cls, file_path: str) -> Optional["PremiseIndex"]:
+        """索引を読み込みます。ファイルがないか、文分割の版が異なる場合は None を返します。"""
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Ignoring unreadable premise index {file_path}: {e}")
+            return None
+        if data.get("version") != SEGMENTER_VERSION:
+            logging.info(f"Premise index {file_path} was built by segmenter version {data.get('version')}; rebuilding")
+            return None
+        return cls(data["premises"])
+
+_index = PremiseIndex()
+
+def get_premise_index() -> PremiseIndex:
+    return _index
+
+def configure_premise_index(index: PremiseIndex) -> PremiseIndex:
+    global _index
+    _index = index
+    return _index
+
+def build_premise_index(file_path: str, arguments: Iterable[str]) -> PremiseIndex:
+    """保存済みの索引を読み込み、足りない主張を分割して追加します。追加があれば保存し直します。"""
+    index = PremiseIndex.load(file_path) or PremiseIndex()
+    for argument in arguments:
+        index.sentences(argument)
+    if index.added or not os.path.exists(file_path):
+        logging.info(f"Premise index {file_path}: segmented {index.added} arguments ({len(index.premises)} total)")
+        index.save(file_path)
+    else:
+        logging.info(f"Premise index {file_path}: reusing {len(index.premises)} segmented arguments")
+    return index
+
+def add_premise_index_arguments(parser) -> None:
+    parser.add_argument("--premise-index", type=str, help="Path to the precomputed sentence-segmented premise index (default: <input>.premises.json)")
+    parser.add_argument("--no-premise-index", action="store_true", help="Segment premises in memory without reading or writing the on-disk index")
+
+def configure_premise_index_from_args(args, arguments: Iterable[str]) -> PremiseIndex:
+    if args.no_premise_index:
+        return configure_premise_index(PremiseIndex())
+    return configure_premise_index(build_premise_index(args.premise_index or f"{args.input}.premises.json", arguments))
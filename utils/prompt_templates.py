@@ -0,0 +1,102 @@
+import re
+import string
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# prompt.json のプレースホルダーと埋め込む値の名前
+GENERATION_PLACEHOLDERS = {
+    "###premise_list###": "premise_list",
+    "#topic#": "topic",
+    "#argument#": "affirmative_argument",
+}
+GENERATION_PLACEHOLDER_PATTERN = re.compile("|".join(re.escape(placeholder) for placeholder in GENERATION_PLACEHOLDERS))
+# 既知のプレースホルダーを除いた後に残る #name# は書き間違いとみなす
+UNKNOWN_GENERATION_PLACEHOLDER_PATTERN = re.compile(r"#+[A-Za-z_]+#+")
+
+# inline: アイテムごとの内容をテンプレートの位置のまま埋め込む（従来どおり）
+# prefix: 指示などの固定の段落を先に、アイテムごとの内容を含む段落を後ろに置き、プロバイダのプロンプトキャッシュが効くようにする
+MESSAGE_LAYOUTS = ["inline", "prefix"]
+
+class PromptTemplate:
+    """プレースホルダーの位置であらかじめ分割したテンプレートです。埋め込みは断片の連結だけで行います。"""
+
+    def __init__(self, parts: List[Tuple[str, Optional[str]]]):
+        # (直前の固定文字列, 埋め込む値の名前) の並び。最後の要素の名前は None
+        self.parts = parts
+        self.fields = frozenset(field for _, field in parts if field is not None)
+
+    def render(self, **values) -> str:
+        pieces = []
+        for literal, field in self.parts:
+            pieces.append(literal)
+            if field is not None:
+                pieces.append(values[field])
+        return "".join(pieces)
+
+def split_paragraphs(template: str, has_placeholder) -> Tuple[str, str]:
+    """テンプレートを空行で段落に分け、(プレースホルダーを含まない段落, 含む段落) をそれぞれ元の順序で連結して返します。"""
+    paragraphs = template.split("\n\n")
+    static = [paragraph for paragraph in paragraphs if not has_placeholder(paragraph)]
+    dynamic = [paragraph for paragraph in paragraphs if has_placeholder(paragraph)]
+    return "\n\n".join(static), "\n\n".join(dynamic)
+
+@lru_cache(maxsize=None)
+def compile_generation_template(template: str, layout: str = "inline") -> PromptTemplate:
+    """prompt.json 形式（#topic#, #argument#, ###premise_list###）のテンプレートを変換します。
+
+    layout が "prefix" の場合は、プレースホルダーを含む段落をテンプレートの末尾に移します。
+    """
+    if layout == "prefix":
+        template = "\n\n".join(part for part in split_paragraphs(template, GENERATION_PLACEHOLDER_PATTERN.search) if part)
+    elif layout != "inline":
+        raise ValueError(f"Invalid message layout: {layout}")
+    parts = []
+    position = 0
+    for match in GENERATION_PLACEHOLDER_PATTERN.finditer(template):
+        parts.append((template[position:match.start()], GENERATION_PLACEHOLDERS[match.group()]))
+        position = match.end()
+    parts.append((template[position:], None))
+
+    unknown = {match for literal, _ in parts for match in UNKNOWN_GENERATION_PLACEHOLDER_PATTERN.findall(literal)}
+    if unknown:
+        raise ValueError(f"Unknown placeholders {sorted(unknown)}; expected {sorted(GENERATION_PLACEHOLDERS)}")
+    return PromptTemplate(parts)
+
+@lru_cache(maxsize=None)
+def compile_format_template(template: str) -> PromptTemplate:
+    """evaluate_prompt.json 形式（str.format の {name}）のテンプレートを変換します。{{ と }} は括弧そのものになります。"""
+    parts = []
+    pending = ""
+    for literal, field, format_spec, conversion in string.Formatter().parse(template):
+        pending += literal
+        if field is None:
+            continue
+        if not field.isidentifier() or format_spec or conversion:
+            raise ValueError(f"Unsupported placeholder {{{field}}}; only plain {{name}} fields are allowed")
+        parts.append((pending, field))
+        pending = ""
+    parts.append((pending, None))
+    return PromptTemplate(parts)
+
+@lru_cache(maxsize=None)
+def split_format_template(template: str) -> Tuple[str, str]:
+    """str.format 形式のテンプレートを (固定の段落を埋め込んだ文字列, {name} を含む段落のテンプレート) に分けます。"""
+    static, dynamic = split_paragraphs(template, lambda paragraph: bool(compile_format_template(paragraph).fields))
+    return compile_format_template(static).render(), dynamic
+
+def add_layout_arguments(parser) -> None:
+    parser.add_argument("--message-layout", choices=MESSAGE_LAYOUTS, default="inline", help="'prefix' puts static instructions first and per-item content last so provider prompt caching can reuse the shared prefix")
+
+def validate_format_templates(prompts: Dict, fields: Dict[str, Iterable[str]], optional: Iterable[str] = ()) -> None:
+    """各キーのテンプレートが存在し、許可された {name} だけを使っているか検証して変換しておきます。"""
+    for key, allowed in fields.items():
+        if key not in prompts and key in optional:
+            continue
+        if not isinstance(prompts.get(key), str):
+            raise ValueError(f"Missing prompt template '{key}'")
+        try:
+            unknown = compile_format_template(prompts[key]).fields - set(allowed)
+        except ValueError as e:
+            raise ValueError(f"Invalid prompt template '{key}': {e}") from e
+        if unknown:
+            raise ValueError(f"Prompt template '{key}' uses unknown placeholders {sorted(unknown)}; expected {sorted(allowed)}")
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "llm_responses.sqlite")
+
+class ResponseCache:
+    """LLMの応答を (provider, model, messages, temperature, max_tokens) のハッシュで保存するSQLiteキャッシュです。"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_age_days: Optional[float] = None, max_entries: Optional[int] = None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages: List[Dict], temperature: float, max_tokens: int, **params) -> str:
+        payload = {
+            "provider": provider,
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        payload.update(params)
+        encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or self._expired(row[1]):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """期限切れのエントリと、上限を超えた古いエントリを削除します。"""
+        removed = 0
+        with self._lock:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed += self._conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+            if self.max_entries is not None:
+                removed += self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                ).rowcount
+            self._conn.commit()
+        if removed:
+            logging.info(f"Evicted {removed} entries from response cache {self.path}")
+        return removed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+    def close(self) -> None:
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+    def _expired(self, created_at: float) -> bool:
+        return self.max_age_days is not None and created_at < time.time() - self.max_age_days * 86400
+
+_cache: Optional[ResponseCache] = None
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return _cache
+
+def configure_response_cache(enabled: bool, path: str = DEFAULT_CACHE_PATH, max_age_days: Optional[float] = None, max_entries: Optional[int] = None) -> Optional[ResponseCache]:
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = ResponseCache(path, max_age_days, max_entries) if enabled else None
+    return _cache
+
+def add_cache_arguments(parser) -> None:
+    parser.add_argument("--cache", action="store_true", default=False, help="Reuse LLM responses from the on-disk cache")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", help="Disable the on-disk response cache (default)")
+    parser.add_argument("--cache-path", type=str, default=DEFAULT_CACHE_PATH, help="Path to the SQLite response cache")
+    parser.add_argument("--cache-max-age-days", type=float, default=None, help="Evict cached responses older than this many days")
+    parser.add_argument("--cache-max-entries", type=int, default=None, help="Keep at most this many cached responses (least recently used are evicted)")
+
+def configure_cache_from_args(args) -> Optional[ResponseCache]:
+    return configure_response_cache(args.cache, args.cache_path, args.cache_max_age_days, args.cache_max_entries)
+
+def log_cache_stats() -> None:
+    if _cache is None:
+        return
+    stats = _cache.stats()
+    logging.info(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries")
@@ -0,0 +1,109 @@
+import hashlib
+import logging
+from typing import Callable, Container, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from utils.file_handlers import ItemWriter, iter_items
+
+def parse_id_range(value: Optional[str]) -> Optional[Set[int]]:
+    """'1-3' や '2,4,6' 形式の指定をIDの集合に変換します。指定がなければ None を返します。"""
+    if not value:
+        return None
+    if '-' in value:
+        start, end = map(int, value.split('-'))
+        return set(range(start, end + 1))
+    return set(map(int, value.split(',')))
+
+def parse_shard(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """'k/N' 形式の指定を (k, N) に変換します。k は 0 から N-1 です。"""
+    if not value:
+        return None
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard (expected k/N): {value}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must satisfy 0 <= k < N: {value}")
+    return index, count
+
+def shard_of(item_id, count: int) -> int:
+    """アイテムIDの安定したハッシュからシャード番号を決めます。プロセスやマシンが変わっても同じ値になります。"""
+    digest = hashlib.sha256(str(item_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+def make_item_filter(id_set: Optional[Set] = None, shard: Optional[Tuple[int, int]] = None, canonical_ids: Optional[Dict] = None) -> Callable:
+    """ID範囲とシャードの指定から、アイテムIDを処理するかどうかを返す関数を作ります。
+
+    canonical_ids（{重複した項目のID: 代表の項目のID}）を渡すと、重複した項目は代表と同じシャードに割り当てます。
+    """
+    canonical_ids = canonical_ids or {}
+
+    def is_selected(item_id) -> bool:
+        if id_set is not None and item_id not in id_set:
+            return False
+        if shard is not None and shard_of(canonical_ids.get(item_id, item_id), shard[1]) != shard[0]:
+            return False
+        return True
+    return is_selected
+
+def add_shard_arguments(parser) -> None:
+    parser.add_argument("--shard", type=str, help="Process only the items in shard k of N by a stable hash of the item ID (e.g., '0/4')")
+
+def shard_output_path(file_path: str, index: int, count: int) -> str:
+    """out.json -> out.shard-0-of-4.json のように、シャードごとの出力パスを作ります。"""
+    for extension in (".jsonl", ".json"):
+        if file_path.endswith(extension):
+            return f"{file_path[:-len(extension)]}.shard-{index}-of-{count}{extension}"
+    return f"{file_path}.shard-{index}-of-{count}"
+
+def merge_shard_outputs(shard_paths: List[str], reference_items: Iterable, output_path: str, is_selected: Callable = lambda item_id: True, skipped: Container = frozenset()) -> Tuple[List, List]:
+    """シャードの出力を reference_items の順序で1つのファイルにまとめます。
+
+    各シャードの出力は入力と同じ順序で並んでいるため、先頭の項目だけを見ながら1件ずつ書き出します。
+    skipped のID（--dedup skip で出力しない重複）は、出力になくても見つからなかったIDに数えません。
+    (見つからなかったID, 重複または想定外のID) を返します。
+    """
+    shards = [iter_items(path) for path in shard_paths]
+    heads = [next(shard, None) for shard in shards]
+    missing = []
+    unexpected = []
+
+    with ItemWriter(output_path) as writer:
+        for reference_item in reference_items:
+            item_id = reference_item['id']
+            if not is_selected(item_id):
+                continue
+            matches = [index for index, head in enumerate(heads) if head is not None and head.get('id') == item_id]
+            if not matches:
+                if item_id not in skipped:
+                    missing.append(item_id)
+                continue
+            writer.write(heads[matches[0]])
+            if len(matches) > 1:
+                unexpected.append(item_id)
+            for index in matches:
+                heads[index] = next(shards[index], None)
+                # 同じシャード内で同じIDが続く場合も重複として読み飛ばす
+                while heads[index] is not None and heads[index].get('id') == item_id:
+                    unexpected.append(item_id)
+                    heads[index] = next(shards[index], None)
+
+        for index, head in enumerate(heads):
+            while head is not None:
+                unexpected.append(head.get('id'))
+                head = next(shards[index], None)
+
+    if missing:
+        logging.error(f"{len(missing)} items are missing from the shard outputs: {summarize_ids(missing)}")
+    if unexpected:
+        logging.error(f"{len(unexpected)} items are duplicated or out of order in the shard outputs: {summarize_ids(unexpected)}")
+    return missing, unexpected
+
+def summarize_ids(ids: List, limit: int = 20) -> str:
+    shown = ", ".join(map(str, ids[:limit]))
+    return shown if len(ids) <= limit else f"{shown}, ... ({len(ids) - limit} more)"
+
+def iter_reference_items(file_path: str) -> Iterator:
+    for index, item in enumerate(iter_items(file_path)):
+        if 'id' not in item:
+            raise ValueError(f"Item {index} in {file_path} has no 'id'; shard outputs can only be merged by item ID")
+        yield item
@@ -0,0 +1,119 @@
+import logging
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    # tiktoken がなければ文字数の1/4でトークン数を見積もる
+    tiktoken = None
+
+# モデルのコンテキスト長。max_tokens がプロンプトと合わせてこれを超えないようにする
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "llama-3.1-70b-versatile": 131072,
+    "llama-3.1-8b-instant": 131072,
+    "llama3-70b-8192": 8192,
+    "llama3-8b-8192": 8192,
+}
+# メッセージごとに加わる役割などのトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+
+TOKEN_BUDGET_MODES = ["fixed", "adaptive"]
+
+@lru_cache(maxsize=None)
+def _encoding(model: Optional[str]):
+    if model is not None:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding("o200k_base")
+
+@lru_cache(maxsize=None)
+def _warn_token_estimate() -> None:
+    # 見積もりを使うたびではなく、プロセスで1回だけ警告する
+    logging.warning("tiktoken is not installed; token counts (adaptive budgets, rate limits, local usage) are estimated as 4 characters per token")
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    if tiktoken is None:
+        _warn_token_estimate()
+        return (len(text) + 3) // 4
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+def count_message_tokens(messages: List[Dict], model: Optional[str] = None) -> int:
+    return sum(count_tokens(message.get('content') or "", model) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+def context_window(model: str) -> Optional[int]:
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+    # 日付付きのモデル名などは最も長く一致するモデル名の値を使う
+    matches = [name for name in MODEL_CONTEXT_WINDOWS if model.startswith(name)]
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)] if matches else None
+
+class TokenBudget:
+    """ステップごとの max_tokens の決め方と、切り詰められた応答の続きを何回まで要求するかを保持します。
+
+    fixed では全ステップに指定された max_tokens を使い、adaptive ではステップの規則
+    (基本値, 基準のトークン数に対する比, 最大値) から 基本値 + 比 × 基準のトークン数 として決めます。最大値が None の規則は指定された max_tokens を上限にします。
+    """
+
+    def __init__(self, mode: str = "fixed", max_continuations: int = 0):
+        if mode not in TOKEN_BUDGET_MODES:
+            raise ValueError(f"Invalid token budget mode: {mode}")
+        self.mode = mode
+        self.max_continuations = max_continuations
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def plan(self, rule: Optional[Tuple[int, float, Optional[int]]], reference_tokens: int, messages: List[Dict], model: str, max_tokens: int) -> int:
+        if self.mode == "fixed" or rule is None:
+            planned = max_tokens
+        else:
+            base, ratio, maximum = rule
+            planned = min(maximum if maximum is not None else max_tokens, int(base + ratio * reference_tokens))
+        if self.mode == "adaptive":
+            window = context_window(model)
+            if window is not None:
+                planned = max(1, min(planned, window - count_message_tokens(messages, model)))
+        return planned
+
+    def record(self, step: str, truncated: bool, continuations: int, still_truncated: bool) -> None:
+        """応答が切り詰められたか（finish_reason が "length"）と、続きの要求の回数をステップごとに数えます。"""
+        with self._lock:
+            stats = self._stats.setdefault(step, {"calls": 0, "truncated": 0, "continuations": 0, "still_truncated": 0})
+            stats["calls"] += 1
+            stats["truncated"] += int(truncated)
+            stats["continuations"] += continuations
+            stats["still_truncated"] += int(still_truncated)
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {step: dict(stats) for step, stats in self._stats.items()}
+
+_budget = TokenBudget()
+
+def get_token_budget() -> TokenBudget:
+    return _budget
+
+def configure_token_budget(mode: str = "fixed", max_continuations: int = 0) -> TokenBudget:
+    global _budget
+    _budget = TokenBudget(mode, max_continuations)
+    return _budget
+
+def add_token_budget_arguments(parser) -> None:
+    parser.add_argument("--token-budget", choices=TOKEN_BUDGET_MODES, default="fixed", help="'adaptive' sizes max_tokens per step from a local token count of the prompt; --max-tokens still sets the final counterargument budget and caps open-ended evaluation steps")
+    parser.add_argument("--max-continuations", type=int, default=0, help="Ask the model to continue a response cut off by max_tokens (finish_reason 'length') up to this many times")
+
+def configure_token_budget_from_args(args) -> TokenBudget:
+    return configure_token_budget(args.token_budget, args.max_continuations)
+
+def log_truncation_stats() -> None:
+    stats_by_step = _budget.stats()
+    if stats_by_step and not any(stats["truncated"] for stats in stats_by_step.values()):
+        logging.info(f"No responses were truncated by max_tokens ({sum(stats['calls'] for stats in stats_by_step.values())} calls)")
+    for step, stats in sorted(stats_by_step.items()):
+        if stats["truncated"]:
+            logging.info(f"Truncated responses for {step}: {stats['truncated']} of {stats['calls']} hit max_tokens, {stats['continuations']} continuation requests, {stats['still_truncated']} still truncated")
@@ -0,0 +1,235 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# モデルごとの料金（100万トークンあたりのUSD: 入力, 出力）
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-2024-08-06": (2.50, 10.00),
+    "llama-3.1-70b-versatile": (0.59, 0.79),
+    "llama-3.1-8b-instant": (0.05, 0.08),
+    "llama3-70b-8192": (0.59, 0.79),
+    "llama3-8b-8192": (0.05, 0.08),
+}
+
+# プロンプトキャッシュに一致した入力トークンの料金（通常の入力トークンに対する比）
+CACHED_INPUT_PRICE_RATIO = 0.5
+
+_trace_tags = contextvars.ContextVar("trace_tags", default={})
+
+@contextmanager
+def trace_tags(**tags):
+    """このブロック内のリクエストに item / model / condition / step などのタグを付けます。"""
+    token = _trace_tags.set({**_trace_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _trace_tags.reset(token)
+
+def current_tags() -> Dict:
+    return dict(_trace_tags.get())
+
+def propagate(fn: Callable) -> Callable:
+    """現在のタグを引き継いで別スレッドで fn を実行するためのラッパーを返します。"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> Optional[float]:
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # 日付付きのモデル名などは最も長く一致するモデル名の料金を使う
+        matches = [name for name in MODEL_PRICES if model.startswith(name)]
+        if not matches:
+            return None
+        prices = MODEL_PRICES[max(matches, key=len)]
+    # プロンプトキャッシュに一致した入力トークンは割引料金で計算する
+    uncached_tokens = prompt_tokens - cached_tokens
+    return (uncached_tokens * prices[0] + cached_tokens * prices[0] * CACHED_INPUT_PRICE_RATIO + completion_tokens * prices[1]) / 1_000_000
+
+class Tracer:
+    """リクエストごとのレイテンシ・待ち時間・再試行・トークン使用量・推定コストを記録します。"""
+
+    def __init__(self):
+        self.records: List[Dict] = []
+        self._lock = threading.Lock()
+        self._origin = time.time()
+
+    def record(self, provider: str, model: str, started_at: float, latency: float, queue_wait: float = 0.0, retries: int = 0, usage: Optional[Dict] = None, cached: bool = False, error: Optional[str] = None, ttft: Optional[float] = None, tokens_per_second: Optional[float] = None, stopped_early: bool = False) -> None:
+        """ttft と tokens_per_second はストリーミングで受け取ったリクエストだけに記録します。"""
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        cached_tokens = usage.get("cached_tokens", 0)
+        record = {
+            **current_tags(),
+            "provider": provider,
+            "model": model,
+            "started_at": started_at,
+            "latency": latency,
+            "queue_wait": queue_wait,
+            "retries": retries,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "cached": cached,
+            "cost": 0.0 if cached else estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens),
+            "thread": threading.get_ident(),
+        }
+        if error is not None:
+            record["error"] = error
+        if ttft is not None:
+            record["ttft"] = ttft
+        if tokens_per_second is not None:
+            record["tokens_per_second"] = tokens_per_second
+        if stopped_early:
+            record["stopped_early"] = True
+        with self._lock:
+            self.records.append(record)
+
+    def chrome_trace(self) -> Dict:
+        """Chrome の trace event 形式（chrome://tracing や Perfetto で表示可能）に変換します。"""
+        events = []
+        process_ids = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            if record["provider"] not in process_ids:
+                process_ids[record["provider"]] = len(process_ids) + 1
+                events.append({"name": "process_name", "ph": "M", "pid": process_ids[record["provider"]], "args": {"name": record["provider"]}})
+            pid = process_ids[record["provider"]]
+            start = (record["started_at"] - self._origin) * 1_000_000
+            args = {key: value for key, value in record.items() if key not in ("started_at", "thread")}
+            if record["queue_wait"] > 0:
+                events.append({
+                    "name": "queue_wait", "cat": record["model"], "ph": "X",
+                    "ts": start, "dur": record["queue_wait"] * 1_000_000,
+                    "pid": pid, "tid": record["thread"], "args": args,
+                })
+            events.append({
+                "name": record.get("step", "request"), "cat": record["model"], "ph": "X",
+                "ts": start + record["queue_wait"] * 1_000_000, "dur": (record["latency"] - record["queue_wait"]) * 1_000_000,
+                "pid": pid, "tid": record["thread"], "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, file_path: str) -> None:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f, ensure_ascii=False)
+        logging.info(f"Trace with {len(self.records)} requests saved to {file_path}")
+
+    def summary(self, group_by=("model", "step")) -> List[Dict]:
+        groups = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            key = tuple(record.get(field, "-") for field in group_by)
+            groups.setdefault(key, []).append(record)
+
+        rows = []
+        for key, group in sorted(groups.items(), key=lambda entry: tuple(str(part) for part in entry[0])):
+            latencies = sorted(record["latency"] for record in group)
+            costs = [record["cost"] for record in group if record["cost"] is not None]
+            # プロンプトキャッシュの一致率は応答キャッシュを使わず実際に送ったリクエストだけで数える
+            sent = [record for record in group if not record["cached"] and "error" not in record]
+            rows.append({
+                **dict(zip(group_by, key)),
+                "calls": len(group),
+                "cached": sum(1 for record in group if record["cached"]),
+                "errors": sum(1 for record in group if "error" in record),
+                "retries": sum(record["retries"] for record in group),
+                "mean_latency": sum(latencies) / len(latencies),
+                "p95_latency": latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))],
+                "queue_wait": sum(record["queue_wait"] for record in group),
+                "prompt_tokens": sum(record["prompt_tokens"] for record in group),
+                "completion_tokens": sum(record["completion_tokens"] for record in group),
+                "cached_tokens": sum(record["cached_tokens"] for record in group),
+                "prompt_cache_hit_rate": prompt_cache_hit_rate(sent),
+                "cost": sum(costs) if costs else None,
+            })
+        return rows
+
+    def print_summary(self) -> None:
+        for group_by in (("model", "step"), ("model_name", "condition")):
+            rows = self.summary(group_by)
+            if not rows:
+                continue
+            header = f"{group_by[0]:<28} {group_by[1]:<26} {'calls':>6} {'cached':>6} {'retries':>7} {'mean(s)':>8} {'p95(s)':>8} {'wait(s)':>8} {'in_tok':>9} {'in_hit%':>7} {'out_tok':>9} {'cost($)':>9}"
+            print(header)
+            print("-" * len(header))
+            for row in rows:
+                cost = f"{row['cost']:.4f}" if row['cost'] is not None else "n/a"
+                hit_rate = f"{row['prompt_cache_hit_rate']:.1%}" if row['prompt_cache_hit_rate'] is not None else "n/a"
+                print(f"{str(row[group_by[0]]):<28} {str(row[group_by[1]]):<26} {row['calls']:>6} {row['cached']:>6} {row['retries']:>7} {row['mean_latency']:>8.2f} {row['p95_latency']:>8.2f} {row['queue_wait']:>8.2f} {row['prompt_tokens']:>9} {hit_rate:>7} {row['completion_tokens']:>9} {cost:>9}")
+            print()
+
+        with self._lock:
+            sent = [record for record in self.records if not record["cached"] and "error" not in record]
+        hit_rate = prompt_cache_hit_rate(sent)
+        if hit_rate is not None:
+            print(f"Provider prompt cache: {sum(record['cached_tokens'] for record in sent)} of {sum(record['prompt_tokens'] for record in sent)} prompt tokens cached ({hit_rate:.1%})")
+
+        rows = self.streaming_summary()
+        if rows:
+            print()
+            header = f"{'model':<28} {'streamed':>8} {'mean_ttft(s)':>12} {'p95_ttft(s)':>11} {'tok/s':>8} {'early_stop':>10}"
+            print(header)
+            print("-" * len(header))
+            for row in rows:
+                tokens_per_second = f"{row['tokens_per_second']:.1f}" if row['tokens_per_second'] is not None else "n/a"
+                print(f"{row['model']:<28} {row['streamed']:>8} {row['mean_ttft']:>12.3f} {row['p95_ttft']:>11.3f} {tokens_per_second:>8} {row['stopped_early']:>10}")
+
+    def streaming_summary(self) -> List[Dict]:
+        """ストリーミングで受け取ったリクエストの最初のトークンまでの時間と出力速度をモデルごとに集計します。"""
+        groups = {}
+        with self._lock:
+            records = [record for record in self.records if "ttft" in record]
+        for record in records:
+            groups.setdefault(record["model"], []).append(record)
+
+        rows = []
+        for model, group in sorted(groups.items()):
+            ttfts = sorted(record["ttft"] for record in group)
+            speeds = [record["tokens_per_second"] for record in group if "tokens_per_second" in record]
+            rows.append({
+                "model": model,
+                "streamed": len(group),
+                "mean_ttft": sum(ttfts) / len(ttfts),
+                "p95_ttft": ttfts[min(len(ttfts) - 1, int(round(0.95 * (len(ttfts) - 1))))],
+                "tokens_per_second": sum(speeds) / len(speeds) if speeds else None,
+                "stopped_early": sum(1 for record in group if record.get("stopped_early")),
+            })
+        return rows
+
+def prompt_cache_hit_rate(records: List[Dict]) -> Optional[float]:
+    """入力トークンのうちプロバイダのプロンプトキャッシュに一致した割合を返します。"""
+    prompt_tokens = sum(record["prompt_tokens"] for record in records)
+    if prompt_tokens == 0:
+        return None
+    return sum(record["cached_tokens"] for record in records) / prompt_tokens
+
+_tracer: Optional[Tracer] = None
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+def configure_tracing(enabled: bool) -> Optional[Tracer]:
+    global _tracer
+    _tracer = Tracer() if enabled else None
+    return _tracer
+
+def add_tracing_arguments(parser) -> None:
+    parser.add_argument("--trace", type=str, default=None, help="Record per-request latency, tokens and cost, write a Chrome trace JSON to this path and print a summary")
+
+def configure_tracing_from_args(args) -> Optional[Tracer]:
+    return configure_tracing(bool(args.trace))
+
+def finish_tracing(args) -> None:
+    if _tracer is None:
+        return
+    _tracer.write(args.trace)
+    _tracer.print_summary()
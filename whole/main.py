@@ -1,51 +1,107 @@
 import argparse
-import json
 import logging
+import queue
 import sys
 import os
+import threading
+
+# プロジェクトのルートディレクトリをシステムパスに追加
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
 from config import (
     openai_api_key,
     groq_api_key,
     prompt_path,
     evaluation_index_path,
+    evaluation_prompt_path,
     models
 )
 from utils.logging_config import setup_logging
-from utils.file_handlers import load_prompts, load_evaluation_index
+from utils.response_cache import add_cache_arguments, configure_cache_from_args, log_cache_stats
+from utils.token_budget import add_token_budget_arguments, configure_token_budget_from_args, log_truncation_stats
+from utils.tracing import add_tracing_arguments, configure_tracing_from_args, finish_tracing, trace_tags
+from utils.premise_index import add_premise_index_arguments, configure_premise_index_from_args
+from utils.prompt_templates import add_layout_arguments
+from utils.file_handlers import JsonlIndex, JsonlSink, iter_items, load_prompts, load_evaluation_index, load_evaluation_prompts, read_jsonl, write_items
 
-from models.ai_models import get_ai_client
-from generators.counterargument import generate_counterargument
-from evaluators.argument_evaluator import evaluate_arguments
+from models.ai_models import add_client_arguments, configure_clients_from_args, get_ai_client
+from models.request_layer import add_request_arguments, configure_requests_from_args
+from generators.counterargument_generator import CONDITION_STEPS, generate_counterargument, validate_prompts
+from evaluators.argument_evaluator import build_counter_arguments_text, count_counter_arguments, evaluate_arguments, validate_evaluation_prompts
 
-def load_input_data(file_path: str) -> list:
+# ワーカーに終了を伝えるための目印
+_DONE = object()
+
+def iter_input_data(file_path: str):
+    """入力ファイル（JSON配列または JSONL）を1件ずつ検証しながら読み込みます。"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        if not isinstance(data, list):
-            raise ValueError("Input JSON must be a list of dictionaries with 'topic' and 'context' keys")
-        for item in data:
-            if 'topic' not in item or 'context' not in item:
+        for item in iter_items(file_path):
+            if not isinstance(item, dict) or 'topic' not in item or 'context' not in item:
                 raise ValueError("Each item in the input JSON must contain 'topic' and 'context' keys")
-        return data
+            yield item
     except Exception as e:
         logging.error(f"Error loading input data from {file_path}: {e}")
         sys.exit(1)
 
+def compact_checkpoint(checkpoint_path: str, input_path: str, model_names: list):
+    """チェックポイントの結果を入力と同じ順序の出力項目として1件ずつ返します。"""
+    with JsonlIndex(checkpoint_path, key=lambda record: (record['id'], record['model'])) as bundles:
+        for index, input_item in enumerate(iter_input_data(input_path)):
+            item_key = input_item.get('id', index)
+            result_item = {
+                'topic': input_item['topic'],
+                'affirmative_argument': input_item['context'],
+                'counterarguments': {},
+                'evaluation_results': {}
+            }
+            if 'id' in input_item:
+                result_item = {"id": input_item['id'], **result_item}
+            for model_name in model_names:
+                bundle = bundles.get((item_key, model_name))
+                if bundle is None:
+                    continue
+                result_item['counterarguments'][model_name] = bundle['counterarguments']
+                if bundle.get('evaluation_results') is not None:
+                    result_item['evaluation_results'][model_name] = bundle['evaluation_results']
+            yield result_item
+
 def main():
     setup_logging()
     prompts = load_prompts(prompt_path)
     evaluation_criteria = load_evaluation_index(evaluation_index_path)
+    evaluation_prompts = load_evaluation_prompts(evaluation_prompt_path)
 
     parser = argparse.ArgumentParser(description="Counter-Argument Generator")
     parser.add_argument("--models", nargs='+', required=True, help="AI models to use")
     parser.add_argument("--temperature", type=float, required=True, help="Temperature for generation")
     parser.add_argument("--max-tokens", type=int, required=True, help="Max tokens for generation")
-    parser.add_argument("--conditions", nargs='+', required=True, help="Conditions to use (x1, x2, x3, x4)")
-    parser.add_argument("--input", type=str, required=True, help="Path to input JSON file")
-    parser.add_argument("--output", type=str, default='output.json', help="Path to output JSON file")
+    parser.add_argument("--conditions", nargs='+', required=True, help="Conditions to use (x1, x2, x3, x4, x5, x6, x7)")
+    parser.add_argument("--input", type=str, required=True, help="Path to input JSON or JSONL file")
+    parser.add_argument("--output", type=str, default='output.json', help="Path to output JSON file (written as JSONL if it ends with .jsonl)")
     parser.add_argument("--evaluation-model", type=str, default='gpt-4o-2024-08-06', help="Model to use for evaluation")
     parser.add_argument("--criteria-ids", nargs='+', type=int, required=True, help="IDs of evaluation criteria to use")
+    parser.add_argument("--evaluation-max-tokens", type=int, default=1000, help="Max tokens for evaluation")
+    parser.add_argument("--samples", type=int, default=1, help="Number of counterarguments to sample from the final step of each chain (earlier steps are shared)")
+    parser.add_argument("--generation-workers", type=int, default=4, help="Number of (item, model) bundles generated in parallel")
+    parser.add_argument("--evaluation-workers", type=int, default=4, help="Number of generated bundles evaluated in parallel")
+    parser.add_argument("--criteria-concurrency", type=int, default=1, help="Number of per-criterion calls to run in parallel after the shared analysis")
+    parser.add_argument("--queue-size", type=int, default=8, help="Maximum number of generated bundles waiting for evaluation")
+    parser.add_argument("--checkpoint", type=str, help="Path to the append-only JSONL checkpoint (default: <output>.checkpoint.jsonl)")
+    parser.add_argument("--resume", action="store_true", help="Skip (item, model) bundles already recorded in the checkpoint")
+    add_premise_index_arguments(parser)
+    add_layout_arguments(parser)
+    add_cache_arguments(parser)
+    add_request_arguments(parser)
+    add_client_arguments(parser)
+    add_token_budget_arguments(parser)
+    add_tracing_arguments(parser)
     args = parser.parse_args()
+    configure_cache_from_args(args)
+    configure_requests_from_args(args)
+    configure_clients_from_args(args)
+    configure_tracing_from_args(args)
+    configure_token_budget_from_args(args)
 
     # APIキーの設定
     os.environ['OPENAI_API_KEY'] = openai_api_key
@@ -55,86 +111,183 @@ def main():
         if model_name not in models:
             raise ValueError(f"Unsupported model: {model_name}")
 
-    input_data = load_input_data(args.input)
+    conditions = []
+    for condition in args.conditions:
+        if condition not in CONDITION_STEPS:
+            logging.warning(f"Skipping invalid condition: {condition}")
+            continue
+        conditions.append(condition)
 
-    all_results = []
+    try:
+        validate_prompts(prompts, conditions)
+    except ValueError as e:
+        logging.error(f"Invalid prompts in {prompt_path}: {e}")
+        sys.exit(1)
 
-    for input_item in input_data:
-        topic = input_item['topic']
-        affirmative_argument = input_item['context']
+    try:
+        validate_evaluation_prompts(evaluation_prompts)
+    except ValueError as e:
+        logging.error(f"Invalid evaluation prompts in {evaluation_prompt_path}: {e}")
+        sys.exit(1)
 
-        result_item = {
-            'topic': topic,
-            'affirmative_argument': affirmative_argument,
-            'counterarguments': {},
-            'evaluation_results': {}
-        }
-
-        # 各モデルについて反論を生成
-        for model_name in args.models:
-            model_info = models[model_name]
-            client = get_ai_client(model_info['client_type'], {
-                'openai_api_key': openai_api_key,
-                'groq_api_key': groq_api_key
-            })
-
-            counterarguments = {}
-            # 反論を生成
-            for condition in args.conditions:
-                if condition not in ["x1", "x2", "x3", "x4", "x5", "x6"]:
-                    logging.warning(f"Skipping invalid condition: {condition}")
-                    continue
+    # 指定された評価指標のみを使用
+    selected_criteria = [crit for crit in evaluation_criteria['evaluation_criteria'] if crit['id'] in args.criteria_ids]
+    if not selected_criteria:
+        logging.error(f"No evaluation criteria matched the specified IDs: {args.criteria_ids}")
+        sys.exit(1)
 
-                print(f"Generating counterargument using {model_name} with condition {condition} for topic '{topic}'...")
+    # 入力の主張を文に分割した前提の索引を用意する（保存済みの索引があれば再利用する）
+    configure_premise_index_from_args(args, (input_item['context'] for input_item in iter_input_data(args.input)))
 
-                try:
-                    counterargument = generate_counterargument(
+    api_keys = {'openai_api_key': openai_api_key, 'groq_api_key': groq_api_key}
+    eval_client = get_ai_client("openai", api_keys)
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.jsonl"
+    completed = set()
+    generated = set()
+    if args.resume:
+        # 評価まで済んだ組は飛ばし、生成だけ済んだ組（evaluation_results が null）は生成済みの反論を評価だけやり直す
+        for record in read_jsonl(checkpoint_path):
+            (completed if record.get('evaluation_results') is not None else generated).add((record['id'], record['model']))
+        generated -= completed
+        logging.info(f"Resuming from {checkpoint_path}: {len(completed)} bundles already completed, {len(generated)} generated bundles to evaluate")
+
+    # 生成ワーカーが (item, model) ごとの反論をキューに入れ、評価ワーカーがすぐに取り出して評価する。
+    # キューの長さを制限することで、評価が遅れた場合は生成側が待つ
+    work_queue = queue.Queue(maxsize=args.generation_workers * 2)
+    bundle_queue = queue.Queue(maxsize=args.queue_size)
+
+    def generate_bundle(item_key, input_item, model_name):
+        """全ての条件の反論を生成します。失敗した条件があれば None を返します（チェックポイントに残さず --resume で生成からやり直す）。"""
+        model_info = models[model_name]
+        client = get_ai_client(model_info['client_type'], api_keys)
+        topic = input_item['topic']
+        affirmative_argument = input_item['context']
+
+        counterarguments = {}
+        failed = False
+        for condition in conditions:
+            print(f"Generating counterargument using {model_name} with condition {condition} for topic '{topic}'...")
+            try:
+                with trace_tags(item=item_key, model_name=model_name, condition=condition):
+                    result = generate_counterargument(
                         client, topic, affirmative_argument, prompts,
-                        model_info['model'], args.temperature, args.max_tokens, condition
+                        model_info['model'], args.temperature, args.max_tokens, condition,
+                        samples=args.samples, layout=args.message_layout
                     )
-                    counterarguments[condition] = counterargument
-                    print(f"Successfully generated counterargument for condition {condition} using model {model_name}")
-                except Exception as e:
-                    error_message = f"An error occurred for condition {condition} using model {model_name}: {e}\n"
-                    logging.error(error_message)
+                counterarguments[condition] = {
+                    "counterargument": result["counterargument"],
+                    "steps": result["steps"]
+                }
+                if "samples" in result:
+                    counterarguments[condition]["samples"] = result["samples"]
+                print(f"Successfully generated counterargument for condition {condition} using model {model_name}")
+            except Exception as e:
+                error_message = f"An error occurred for condition {condition} using model {model_name}: {e}\n"
+                logging.error(error_message)
+                failed = True
+        if failed:
+            logging.warning(f"Skipping evaluation for model {model_name} on topic '{topic}' because generation failed; it will be retried with --resume")
+            return None
+        return counterarguments
 
-            result_item['counterarguments'][model_name] = counterarguments
+    def evaluate_bundle(item_key, input_item, model_name, counterarguments):
+        topic = input_item['topic']
+        counter_arguments_text = build_counter_arguments_text(counterarguments, model_name, topic)
+        if counter_arguments_text is None:
+            return None
+        try:
+            with trace_tags(item=item_key, model_name=model_name):
+                evaluation_results = evaluate_arguments(
+                    eval_client, args.evaluation_model, topic, input_item['context'],
+                    counter_arguments_text, selected_criteria, evaluation_prompts,
+                    temperature=args.temperature, max_tokens=args.evaluation_max_tokens,
+                    max_workers=args.criteria_concurrency, layout=args.message_layout,
+                    num_counter_arguments=count_counter_arguments(counterarguments)
+                )
+            print(f"Evaluation completed for model {model_name} on topic '{topic}'")
+            return evaluation_results
+        except Exception as e:
+            error_message = f"An error occurred during evaluation for model {model_name}: {e}\n"
+            logging.error(error_message)
+            return None
 
-        # 評価用にカウンターアーギュメントをテキスト形式で整形
-        for model_name, counterarguments in result_item['counterarguments'].items():
-            counter_arguments_text = ""
-            for idx, (cond, cnt_arg) in enumerate(counterarguments.items(), start=1):
-                counter_arguments_text += f"{idx}. {cnt_arg}\n"
+    # ワーカーのスレッドが例外で終了すると、キューに入れる側が待ち続けてしまうため、例外はワーカー内で捕まえて次の仕事に進む
+    def generation_worker():
+        while True:
+            task = work_queue.get()
+            if task is _DONE:
+                return
+            item_key, input_item, model_name = task
+            try:
+                counterarguments = generate_bundle(item_key, input_item, model_name)
+            except Exception as e:
+                logging.error(f"Generation worker failed for model {model_name} on item {item_key}: {e}")
+                continue
+            if counterarguments is None:
+                continue
+            # 評価に失敗しても --resume で生成をやり直さないよう、生成が済んだ時点でチェックポイントに書く
+            try:
+                sink.write({"id": item_key, "model": model_name, "counterarguments": counterarguments, "evaluation_results": None})
+            except Exception as e:
+                logging.error(f"Could not checkpoint generated counterarguments for model {model_name} on item {item_key}: {e}")
+            bundle_queue.put((item_key, input_item, model_name, counterarguments))
 
-            # 指定された評価指標のみを使用
-            selected_criteria = [crit for crit in evaluation_criteria['evaluation_criteria'] if crit['id'] in args.criteria_ids]
+    def evaluation_worker():
+        while True:
+            bundle = bundle_queue.get()
+            if bundle is _DONE:
+                return
+            item_key, input_item, model_name, counterarguments = bundle
+            try:
+                evaluation_results = evaluate_bundle(item_key, input_item, model_name, counterarguments)
+                # 評価に失敗した組は生成済みの記録だけが残り、--resume で評価だけを再実行する
+                if evaluation_results is None:
+                    continue
+                sink.write({
+                    "id": item_key,
+                    "model": model_name,
+                    "counterarguments": counterarguments,
+                    "evaluation_results": evaluation_results
+                })
+            except Exception as e:
+                logging.error(f"Evaluation worker failed for model {model_name} on item {item_key}: {e}")
 
-            if not selected_criteria:
-                logging.warning(f"No evaluation criteria matched the specified IDs: {args.criteria_ids}")
-                continue
+    # --resume で評価だけやり直す組の生成済みの反論は、チェックポイントから読み込む
+    with JsonlIndex(checkpoint_path if generated else os.devnull, key=lambda record: (record['id'], record['model'])) as generated_bundles, \
+            JsonlSink(checkpoint_path, resume=args.resume) as sink:
+        generation_threads = [threading.Thread(target=generation_worker, daemon=True) for _ in range(args.generation_workers)]
+        evaluation_threads = [threading.Thread(target=evaluation_worker, daemon=True) for _ in range(args.evaluation_workers)]
+        for thread in generation_threads + evaluation_threads:
+            thread.start()
 
-            # 評価を実行
-            if counterarguments:
-                eval_client = get_ai_client("openai", {'openai_api_key': openai_api_key})
-                eval_model = args.evaluation_model
+        for index, input_item in enumerate(iter_input_data(args.input)):
+            item_key = input_item.get('id', index)
+            for model_name in args.models:
+                if (item_key, model_name) in completed:
+                    continue
+                bundle = generated_bundles.get((item_key, model_name)) if (item_key, model_name) in generated else None
+                # 条件が足りない記録（以前の版が書いた生成に失敗した組や、--conditions を変えた場合）は生成からやり直す
+                if bundle is not None and all(condition in bundle['counterarguments'] for condition in conditions):
+                    bundle_queue.put((item_key, input_item, model_name, bundle['counterarguments']))
+                else:
+                    work_queue.put((item_key, input_item, model_name))
 
-                try:
-                    evaluation_results = evaluate_arguments(
-                        eval_client, eval_model, topic, affirmative_argument,
-                        counter_arguments_text, selected_criteria,
-                        temperature=args.temperature, max_tokens=args.max_tokens
-                    )
-                    result_item['evaluation_results'][model_name] = evaluation_results
-                    print(f"Evaluation completed for model {model_name} on topic '{topic}'")
-                except Exception as e:
-                    error_message = f"An error occurred during evaluation for model {model_name}: {e}\n"
-                    logging.error(error_message)
+        for _ in generation_threads:
+            work_queue.put(_DONE)
+        for thread in generation_threads:
+            thread.join()
+        for _ in evaluation_threads:
+            bundle_queue.put(_DONE)
+        for thread in evaluation_threads:
+            thread.join()
 
-        all_results.append(result_item)
+    log_cache_stats()
+    log_truncation_stats()
+    finish_tracing(args)
 
-    # 結果を出力
-    with open(args.output, 'w', encoding='utf-8') as f:
-        json.dump(all_results, f, ensure_ascii=False, indent=2)
+    # チェックポイントを入力と同じ順序の出力ファイルにまとめる
+    write_items(args.output, compact_checkpoint(checkpoint_path, args.input, args.models))
     print(f"Output written to {args.output}")
 
 if __name__ == "__main__":
@@ -13,17 +13,31 @@ MAX_TOKENS=1500
 # 使用する条件
 CONDITIONS="x1 x2 x3 x4"
 
+# 入力ファイルと出力ファイル
+INPUT_FILE="input.json"
+OUTPUT_FILE="output.json"
+
 # 評価に使用するモデル
 EVALUATION_MODEL="gpt-4o-2024-08-06"
 
 # 評価に使用する指標のID（スペース区切りで指定）
 CRITERIA_IDS="1 2 3 4 5 6 7 8"  # 例としてID 1, 2, 3を指定
 
+# 並列に生成・評価する (入力, モデル) の数
+GENERATION_WORKERS=4
+EVALUATION_WORKERS=4
+
+# 1件の評価内で並列に実行する指標の数
+CRITERIA_CONCURRENCY=4
+
+# 評価待ちの生成結果の上限（超えると生成側が待つ）
+QUEUE_SIZE=8
+
 # モデル名をスペース区切りの文字列に変換
 MODELS_STR="${MODELS[@]}"
 
 # main.pyを実行
-python main.py \
+python3 whole/main.py \
   --models $MODELS_STR \
   --temperature "$TEMPERATURE" \
   --max-tokens "$MAX_TOKENS" \
@@ -31,4 +45,8 @@ python main.py \
   --input "$INPUT_FILE" \
   --output "$OUTPUT_FILE" \
   --evaluation-model "$EVALUATION_MODEL" \
-  --criteria-ids $CRITERIA_IDS
+  --criteria-ids $CRITERIA_IDS \
+  --generation-workers "$GENERATION_WORKERS" \
+  --evaluation-workers "$EVALUATION_WORKERS" \
+  --criteria-concurrency "$CRITERIA_CONCURRENCY" \
+  --queue-size "$QUEUE_SIZE"